@@ -2,28 +2,74 @@ import telebot
 from telebot import types
 import time
 import config
-import requests
+import metrics
 import threading
+import signal
+import sys
 from utils import *
-from chat_handler import handle_chat_message, handle_prompt_command
-from image_handler import handle_image_command, handle_image_input
+from chat_handler import handle_chat_message, handle_group_batch, handle_prompt_command, handle_voice_command, chat_endpoints, chat_report
+from image_handler import handle_image_command, handle_image_input, image_report, image_providers
 from tts_handler import handle_say_command, handle_tts_input
 from callback_handler import *
-
-# Initialize bot
-bot = telebot.TeleBot(config.BOT_TOKEN)
-
-# Global state tracking
-chat_mode = set()
-user_waiting_for_chat = set()
-user_waiting_for_image = set()
-user_waiting_for_tts = set()
-user_database = set()
+from tts_cache import cache_report
+from tts_handler import TTS_UPSTREAM
+from media import download_report, image_prep_report, relay_request_sender
+from session_store import sessions, session_report
+from job_queue import jobs, queue_report
+from update_dedup import DedupTeleBot, SeenUpdates, dedup_report
+from deadline import deadline_report
+from retry import retry_report
+from limiter import limiter_report
+from health import prober, register_default_targets, health_report
+from generation_policy import policy_report
+from group_batcher import MentionBatcher, batching_report
+from outbound import outbound_report
+from broadcast import broadcaster, payload_from_message, broadcast_report
+
+# Stream media uploads straight from their source instead of buffering multipart bodies
+if config.MEDIA_STREAMING_UPLOADS:
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = relay_request_sender
+if config.TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = config.TELEGRAM_API_URL
+
+# Initialize bot (under supervisor.py, updates are deduplicated before sharding)
+seen_updates = None
+if config.UPDATE_DEDUP_ENABLED and config.WORKER_INDEX is None:
+    seen_updates = SeenUpdates(config.UPDATE_DEDUP_FILE, config.UPDATE_DEDUP_WINDOW)
+bot = DedupTeleBot(config.BOT_TOKEN, seen_updates=seen_updates)
+
+# Global state tracking: one expiring session record per user, exposed to
+# handlers as set-like views of its modes
+chat_mode = sessions.view("chat")
+user_waiting_for_chat = sessions.view("waiting_chat")
+user_waiting_for_image = sessions.view("image")
+user_waiting_for_tts = sessions.view("tts")
+state = get_state_backend()  # premium users, usage counters and the user registry
 bot_start_time = time.time()
 
 # Initialize usage tracker
 usage_tracker = UsageTracker()
 
+# Under supervisor.py, worker 0 alone runs the job workers, broadcast resume and
+# the health prober; the other workers queue jobs and read its probe results
+lead_process = config.WORKER_INDEX in (None, 0)
+
+# Image and TTS jobs run on the durable queue's workers, not in handler threads
+jobs.start(bot, usage_tracker, workers=lead_process)
+
+# Owner broadcasts; one interrupted by a restart is resumed by a single process
+broadcaster.start(bot, state, resume=lead_process)
+
+# Upstream health is probed in the background; any incoming message resets the idle backoff
+register_default_targets(chat_endpoints, image_providers, config.TTS_API_BASE)
+bot.set_update_listener(lambda messages: prober.touch())
+if config.WORKER_INDEX is None:
+    prober.start()
+elif lead_process:
+    prober.start(publish_to=config.HEALTH_SNAPSHOT_FILE)
+else:
+    prober.follow(config.HEALTH_SNAPSHOT_FILE)
+
 # Start message handler
 @bot.message_handler(commands=['start'])
 def start_command(message):
@@ -33,7 +79,7 @@ def start_command(message):
     first_name = message.from_user.first_name or "User"
     
     # Add user to database
-    user_database.add(user_id)
+    state.register_user(user_id)
     
     # Log interaction
     log_user_interaction(message.from_user, "/start", "DM" if message.chat.type == "private" else "Group")
@@ -102,7 +148,7 @@ def help_command(message):
 • Natural voice synthesis
 • Multiple voice options
 • High-quality audio output
-• Usage: `/say`
+• Usage: `/say`, or `/voice` for spoken answers
 
 📊 Your Status: """ + ("💎 Premium User" if is_premium else "🆓 Free User") + """
 
@@ -162,6 +208,11 @@ def say_command(message):
     """Handle TTS command"""
     handle_say_command(bot, message, usage_tracker)
 
+@bot.message_handler(commands=['voice'])
+def voice_command(message):
+    """Handle voice reply command"""
+    handle_voice_command(bot, message, usage_tracker)
+
 @bot.message_handler(commands=['prompt'])
 def prompt_command(message):
     """Handle prompt enhancement command"""
@@ -203,9 +254,39 @@ def myinfo_command(message):
     bot.send_message(message.chat.id, info_text, reply_markup=keyboard, parse_mode="Markdown")
 
 # Premium management commands (owners only)
+def read_user_ids(message):
+    """
+    User ids given to /addpro or /removepro: after the command, and/or in a
+    .txt/.csv file sent with the command as caption or replied to.
+    Returns (user_ids, invalid tokens, error message or None).
+    """
+    text = message.text or message.caption or ""
+    parts = text.split(maxsplit=1)
+    content = parts[1] if len(parts) > 1 else ""
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if document:
+        if document.file_size and document.file_size > config.PREMIUM_IMPORT_MAX_BYTES:
+            return [], [], f"File too large (max {config.PREMIUM_IMPORT_MAX_BYTES // 1024} KB)."
+        try:
+            data = bot.download_file(bot.get_file(document.file_id).file_path)
+        except Exception as e:
+            return [], [], f"Could not download the file: {e}"
+        content += "\n" + data[:config.PREMIUM_IMPORT_MAX_BYTES].decode("utf-8", errors="replace")
+    user_ids, invalid = parse_user_ids(content)
+    return user_ids, invalid, None
+
+def premium_change_report(title, changed_label, changed, skipped_label, skipped, invalid, elapsed):
+    """Counts of one bulk premium change"""
+    lines = [title, f"• {changed_label}: `{changed}`", f"• {skipped_label}: `{skipped}`", f"• Invalid: `{len(invalid)}`"]
+    if invalid:
+        examples = ", ".join(token[:20].replace("`", "'") for token in invalid[:5])
+        lines.append(f"  e.g. `{examples}`" + (" ..." if len(invalid) > 5 else ""))
+    lines.append(f"• Time: `{elapsed * 1000:.0f} ms`")
+    return "\n".join(lines)
+
 @bot.message_handler(commands=['addpro'])
 def add_premium_command(message):
-    """Add user to premium (owners only)"""
+    """Add users to premium (owners only)"""
     user_id = message.from_user.id
     
     if not is_owner(user_id):
@@ -213,30 +294,30 @@ def add_premium_command(message):
         return
     
     try:
-        # Get target user ID from command
-        parts = message.text.split()
-        if len(parts) != 2:
-            bot.reply_to(message, """**Usage:** `/addpro [user_id]`
+        t0 = time.perf_counter()
+        target_ids, invalid, error = read_user_ids(message)
+        if error:
+            bot.reply_to(message, f"❌ **Error:** {error}", parse_mode="Markdown")
+            return
+        if not target_ids and not invalid:
+            bot.reply_to(message, """**Usage:** `/addpro [user_id ...]`
 
-**Example:** `/addpro 123456789`""", parse_mode="Markdown")
+Separate IDs with spaces, commas or new lines, or send a .txt/.csv file of IDs with `/addpro` as its caption (or reply to one).
+
+**Example:** `/addpro 123456789 987654321`""", parse_mode="Markdown")
             return
         
-        target_user_id = int(parts[1])
-        
-        if is_premium_user(target_user_id):
-            bot.reply_to(message, f"ℹ️ User `{target_user_id}` is already a premium user.", parse_mode="Markdown")
-        else:
-            add_premium_user(target_user_id)
-            bot.reply_to(message, f"✅ **Success!** User `{target_user_id}` has been added to premium.", parse_mode="Markdown")
+        added = add_premium_users(target_ids)
+        report = premium_change_report("✅ **Premium updated**", "Added", added, "Already premium",
+                                       len(target_ids) - added, invalid, time.perf_counter() - t0)
+        bot.reply_to(message, report, parse_mode="Markdown")
             
-    except ValueError:
-        bot.reply_to(message, "❌ **Error:** Please provide a valid user ID.", parse_mode="Markdown")
     except Exception as e:
         bot.reply_to(message, f"❌ **Error:** {str(e)}", parse_mode="Markdown")
 
 @bot.message_handler(commands=['removepro'])
 def remove_premium_command(message):
-    """Remove user from premium (owners only)"""
+    """Remove users from premium (owners only)"""
     user_id = message.from_user.id
     
     if not is_owner(user_id):
@@ -244,27 +325,36 @@ def remove_premium_command(message):
         return
     
     try:
-        # Get target user ID from command
-        parts = message.text.split()
-        if len(parts) != 2:
-            bot.reply_to(message, """**Usage:** `/removepro [user_id]`
+        t0 = time.perf_counter()
+        target_ids, invalid, error = read_user_ids(message)
+        if error:
+            bot.reply_to(message, f"❌ **Error:** {error}", parse_mode="Markdown")
+            return
+        if not target_ids and not invalid:
+            bot.reply_to(message, """**Usage:** `/removepro [user_id ...]`
+
+Separate IDs with spaces, commas or new lines, or send a .txt/.csv file of IDs with `/removepro` as its caption (or reply to one).
 
-**Example:** `/removepro 123456789`""", parse_mode="Markdown")
+**Example:** `/removepro 123456789 987654321`""", parse_mode="Markdown")
             return
         
-        target_user_id = int(parts[1])
-        
-        if not is_premium_user(target_user_id):
-            bot.reply_to(message, f"ℹ️ User `{target_user_id}` is not a premium user.", parse_mode="Markdown")
-        else:
-            remove_premium_user(target_user_id)
-            bot.reply_to(message, f"✅ **Success!** User `{target_user_id}` has been removed from premium.", parse_mode="Markdown")
+        removed = remove_premium_users(target_ids)
+        report = premium_change_report("✅ **Premium updated**", "Removed", removed, "Not premium",
+                                       len(target_ids) - removed, invalid, time.perf_counter() - t0)
+        bot.reply_to(message, report, parse_mode="Markdown")
             
-    except ValueError:
-        bot.reply_to(message, "❌ **Error:** Please provide a valid user ID.", parse_mode="Markdown")
     except Exception as e:
         bot.reply_to(message, f"❌ **Error:** {str(e)}", parse_mode="Markdown")
 
+@bot.message_handler(content_types=['document'],
+                     func=lambda message: (message.caption or "").split("@")[0].split()[:1] in (["/addpro"], ["/removepro"]))
+def premium_file_command(message):
+    """/addpro or /removepro as the caption of a file of user IDs"""
+    if message.caption.startswith("/addpro"):
+        add_premium_command(message)
+    else:
+        remove_premium_command(message)
+
 @bot.message_handler(commands=['stats'])
 def stats_command(message):
     """Show bot statistics (owners only)"""
@@ -275,8 +365,9 @@ def stats_command(message):
         return
     
     # Calculate stats
-    total_users = len(user_database)
-    premium_count = len([uid for uid in user_database if is_premium_user(uid)])
+    # Aggregates are maintained incrementally by the state backend (O(1))
+    total_users = state.user_count()
+    premium_count = state.registered_premium_count()
     chat_active = len(chat_mode)
     
     stats_text = f"""📊 **BrahMos AI Statistics**
@@ -302,25 +393,27 @@ from utils import format_uptime
 def ping_command(message):
     chat_id = message.chat.id
 
-    # measure Bot API round-trip latency using getMe
-    t0 = time.perf_counter()
-    api_ok = False
-    try:
-        resp = requests.get(f"https://api.telegram.org/bot{config.BOT_TOKEN}/getMe", timeout=5)
-        api_ok = resp.ok and resp.json().get("ok", False)
-    except Exception:
-        api_ok = False
-    latency_ms = (time.perf_counter() - t0) * 1000.0
+    # Bot API latency and upstream health come from the background prober: no network call here
+    telegram = prober.stats("telegram")
+    latency = f"{telegram['p50']:.0f} ms (p95 {telegram['p95']:.0f} ms)" if telegram else "measuring..."
+    upstreams = ", ".join(f"{name} {'✅' if prober.healthy(name) else '⚠️'}"
+                          for name in prober.targets if name != "telegram")
 
     # uptime from existing bot_start_time
     uptime = format_uptime(bot_start_time)
 
-    status = "✅ Operational" if api_ok else "⚠️ Degraded"
+    if telegram is None:
+        status = "⏳ Starting up"
+    elif all(prober.healthy(name) for name in prober.targets):
+        status = "✅ Operational"
+    else:
+        status = "⚠️ Degraded"
     msg = (
         "🎯 Pong!\n\n"
-        f"• Latency: {latency_ms:.0f} ms\n"
+        f"• Latency: {latency}\n"
         f"• Uptime: {uptime}\n"
-        f"• Status: {status}\n\n"
+        f"• Status: {status}\n"
+        f"• Upstreams: {upstreams}\n\n"
         f" Bot Is Fucntional and Ready-To-Use 🚀"
     )
     bot.send_message(chat_id, msg)
@@ -337,32 +430,134 @@ def debug_command(message):
     debug_text = f"""🔧 **BrahMos AI Debug Info**
 
 **🌐 API Endpoints:**
-• Chat: `{config.CHAT_API_ENDPOINT}`
-• Image: `{config.IMAGE_API_URL}`
+• Chat: `{", ".join(e.url for e in chat_endpoints)}`
+• Image: `{", ".join(p.url for p in image_providers)}`
 • TTS: `{config.TTS_API_ENDPOINT}`
 
 **🤖 Models:**
-• Chat: `{config.CHAT_MODEL}`
+• Chat: `{", ".join(e.model for e in chat_endpoints)}`
 • TTS: `{config.TTS_MODEL}`
 
 **📊 System Status:**
 • Bot Uptime: `{format_uptime(bot_start_time)}`
-• Total Users: `{len(user_database)}`
-• Premium Users: `{len([uid for uid in user_database if is_premium_user(uid)])}`
+• Total Users: `{state.user_count()}`
+• Premium Users: `{state.registered_premium_count()}` registered / `{state.premium_count()}` total
 • Chat Mode Active: `{len(chat_mode)}`
+• Process: `{process_report()}`
+
+**⚡ Performance:**
+• Chat Upstreams: `{chat_report()}`
+• Chat Generation: `{policy_report()}`
+• TTS Cache: `{cache_report()}`
+• Image: `{image_report()}`
+• Image Uploads: `{image_prep_report()}`
+• TTS Download: `{download_report(TTS_UPSTREAM)}`
+• Usage Flush: `{usage_flush_report()}`
+• Outbound: `{outbound_report()}`
+• Sessions: `{session_report()}`
+• Group Mentions: `{batching_report()}`
+• Jobs: `{queue_report()}`
+• Broadcast: `{broadcast_report()}`
+• Updates: `{dedup_report()}`
+• Deadlines: `{deadline_report()}`
+• Retries: `{retry_report()}`
+• Upstream Limits: `{limiter_report()}`
+• Health: `{health_report()}`
 
 **🔒 Access Control:**
 • Owners: `{config.OWNER_IDS}`
 • Your ID: `{user_id}`
 
-**📝 Files:**
-• Premium Users: `{config.PREMIUM_USERS_FILE}`
-• Usage Data: `{config.USAGE_DATA_FILE}`
+**📝 State:**
+• Backend: `{state.describe()}`
 
 ✅ **All systems operational!**"""
     
     bot.reply_to(message, debug_text, parse_mode="Markdown")
 
+def process_report():
+    """Which process answered, for /debug"""
+    import os
+    if config.WORKER_INDEX is None:
+        return f"single process (pid {os.getpid()})"
+    return f"worker {config.WORKER_INDEX + 1}/{config.SUPERVISOR_WORKERS} (pid {os.getpid()})"
+
+def usage_flush_report():
+    """One-line write-behind summary for /debug"""
+    flush_ms = metrics.window_stats("usage.flush_ms")
+    flush_bytes = metrics.window_stats("usage.flush_bytes")
+    return (f"{metrics.get('usage.flushes')} flushes for {metrics.get('usage.flushed_changes')} changes, "
+            f"p95 {flush_ms['p95']:.1f} ms, last ~{flush_bytes['mean'] / 1024:.1f} KB")
+
+@bot.message_handler(commands=['queue'])
+def queue_command(message):
+    """Generation queue depth and job age (owners only)"""
+    user_id = message.from_user.id
+    
+    if not is_owner(user_id):
+        bot.reply_to(message, "❌ **Access Denied:** This command is for owners only.", parse_mode="Markdown")
+        return
+    
+    depth = jobs.depth()
+    lines = [f"• {kind}: `{d.get('queued', 0)}` queued, `{d.get('running', 0)}` running" for kind, d in sorted(depth.items())]
+    wait = metrics.window_stats("jobs.wait_ms")
+    run = metrics.window_stats("jobs.run_ms")
+    queue_text = f"""📬 **Generation Queue**
+
+**📊 Depth:**
+{chr(10).join(lines) or "• Empty"}
+• Oldest waiting: `{jobs.oldest_queued_age():.0f}s`
+
+**⏱️ Timing (recent):**
+• Wait: p50 `{wait['p50'] / 1000:.1f}s`, p95 `{wait['p95'] / 1000:.1f}s`
+• Run: p50 `{run['p50'] / 1000:.1f}s`, p95 `{run['p95'] / 1000:.1f}s`
+
+**🔁 Since start:**
+• Submitted: `{metrics.get('jobs.submitted')}`, done: `{metrics.get('jobs.done')}`
+• Retries: `{metrics.get('jobs.retried')}`, failed: `{metrics.get('jobs.failed')}`, duplicates: `{metrics.get('jobs.duplicates')}`"""
+    
+    bot.reply_to(message, queue_text, parse_mode="Markdown")
+
+@bot.message_handler(commands=['broadcast'])
+def broadcast_command(message):
+    """Send a message to every user (owners only)"""
+    user_id = message.from_user.id
+    
+    if not is_owner(user_id):
+        bot.reply_to(message, "❌ **Access Denied:** This command is for owners only.", parse_mode="Markdown")
+        return
+    
+    parts = message.text.split(maxsplit=1)
+    argument = parts[1].strip() if len(parts) > 1 else ""
+    
+    if argument.lower() == "status":
+        bot.reply_to(message, f"📣 Broadcast {broadcaster.describe()}")
+        return
+    if argument.lower() == "cancel":
+        if broadcaster.cancel():
+            bot.reply_to(message, "🛑 Broadcast cancelled after the messages in flight.")
+        else:
+            bot.reply_to(message, "ℹ️ No broadcast is running.")
+        return
+    
+    if message.reply_to_message:
+        payload = payload_from_message(message.reply_to_message)
+    elif argument:
+        payload = {"type": "text", "text": argument, "entities": []}
+    else:
+        payload = None
+    if payload is None:
+        bot.reply_to(message, """**Usage:** reply to a text, photo, video, animation, document, audio or voice message with `/broadcast`, or `/broadcast [text]`
+
+`/broadcast status` - progress of the current broadcast
+`/broadcast cancel` - stop it""", parse_mode="Markdown")
+        return
+    
+    status = bot.reply_to(message, f"📣 Broadcasting to {state.user_count()} users...")
+    if not broadcaster.send(payload, message.chat.id, status.message_id):
+        safe_edit_message(bot, message.chat.id, status.message_id,
+                          f"ℹ️ A broadcast is already running: {broadcaster.describe()}")
+
 # Callback handlers for inline keyboards
 @bot.callback_query_handler(func=lambda call: True)
 def callback_handler(call):
@@ -393,21 +588,31 @@ def callback_handler(call):
         bot.answer_callback_query(call.id, "Error processing request.")
 
 # Message handlers
-@bot.message_handler(func=lambda message: message.from_user.id in user_waiting_for_image)
+@bot.message_handler(func=lambda message: sessions.route(message.from_user.id) == "image")
 def handle_image_waiting(message):
     """Handle image generation when user is waiting"""
     handle_image_input(bot, message, user_waiting_for_image, usage_tracker)
 
-@bot.message_handler(func=lambda message: message.from_user.id in user_waiting_for_tts)
+@bot.message_handler(func=lambda message: sessions.route(message.from_user.id) == "tts")
 def handle_tts_waiting(message):
     """Handle TTS when user is waiting"""
     handle_tts_input(bot, message, user_waiting_for_tts, usage_tracker)
 
-@bot.message_handler(func=lambda message: message.from_user.id in chat_mode)
+@bot.message_handler(func=lambda message: sessions.route(message.from_user.id) == "chat")
 def handle_chat_mode(message):
     """Handle chat mode messages"""
+    chat_mode.add(message.from_user.id)  # activity refreshes the idle TTL
     handle_chat_message(bot, message, chat_mode, user_waiting_for_chat)
 
+def answer_group_mentions(messages):
+    """One mention gets the normal chat answer; a burst gets one batched answer"""
+    if len(messages) == 1:
+        handle_chat_message(bot, messages[0], chat_mode, user_waiting_for_chat)
+    else:
+        handle_group_batch(bot, messages, user_waiting_for_chat)
+
+mention_batcher = MentionBatcher(answer_group_mentions, bot)
+
 @bot.message_handler(func=lambda message: message.chat.type in ['group', 'supergroup'])
 def handle_group_messages(message):
     """Handle group messages - only respond if mentioned or replied to"""
@@ -424,7 +629,10 @@ def handle_group_messages(message):
         is_reply_to_bot = True
     
     if is_mentioned or is_reply_to_bot:
-        handle_chat_message(bot, message, chat_mode, user_waiting_for_chat)
+        if config.GROUP_BATCHING_ENABLED:
+            mention_batcher.submit(message)
+        else:
+            handle_chat_message(bot, message, chat_mode, user_waiting_for_chat)
 
 @bot.message_handler(func=lambda message: message.chat.type == 'private')
 def handle_private_messages(message):
@@ -432,9 +640,7 @@ def handle_private_messages(message):
     user_id = message.from_user.id
     
     # If user is not in any special mode, treat as chat
-    if (user_id not in user_waiting_for_image and 
-        user_id not in user_waiting_for_tts and 
-        user_id not in chat_mode):
+    if sessions.route(user_id) is None:
         # Auto-activate chat mode for private messages
         chat_mode.add(user_id)
         handle_chat_message(bot, message, chat_mode, user_waiting_for_chat)
@@ -445,9 +651,14 @@ if __name__ == "__main__":
     print(f"👥 Owners: {config.OWNER_IDS}")
     print("✅ Bot is running! Press Ctrl+C to stop.")
     
+    # Dynos stop with SIGTERM: turn it into a normal exit so pending state is flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
     try:
         bot.infinity_polling(none_stop=True, interval=0)
     except KeyboardInterrupt:
         print("\n🛑 Bot stopped by user.")
     except Exception as e:
-        print(f"❌ Bot error: {e}")
\ No newline at end of file
+        print(f"❌ Bot error: {e}")
+    finally:
+        usage_tracker.flush()
\ No newline at end of file
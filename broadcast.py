@@ -0,0 +1,306 @@
+import json
+import os
+import threading
+import time
+
+from telebot import apihelper, types
+
+import config
+import metrics
+from utils import atomic_write_json
+
+MEDIA_TYPES = ("photo", "video", "animation", "document", "audio", "voice")
+
+# Bot API answers meaning the user can never be reached again
+GONE_ERRORS = ("bot was blocked by the user", "user is deactivated", "chat not found",
+               "bot was kicked", "bot can't initiate conversation")
+
+def payload_from_message(message):
+    """
+    What a broadcast sends: a text with its formatting entities, or an
+    already uploaded media file by file_id (so nothing is uploaded again)
+    with its caption. None for messages that cannot be broadcast.
+    """
+    if message.content_type == "text":
+        return {"type": "text", "text": message.text,
+                "entities": [e.to_dict() for e in message.entities or []]}
+    if message.content_type in MEDIA_TYPES:
+        media = getattr(message, message.content_type)
+        if message.content_type == "photo":
+            media = media[-1]  # largest size
+        return {"type": message.content_type, "file_id": media.file_id, "caption": message.caption,
+                "entities": [e.to_dict() for e in message.caption_entities or []]}
+    return None
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes}m" if hours else f"{minutes}m {seconds}s"
+
+class Broadcaster:
+    """
+    Fans one message out to every registered user. BROADCAST_WORKERS threads
+    send in user id order, paced together at BROADCAST_RATE messages per
+    second; a 429 pauses every worker for its retry_after. Users that blocked
+    the bot or were deactivated are pruned from the registry. Every delivery
+    is appended to a journal next to BROADCAST_CHECKPOINT_FILE, so a restarted
+    bot resumes with the users not reached yet (only messages in flight at
+    the crash can arrive twice). A cancel is written to a marker file next to
+    the checkpoint, so a worker process other than the sending one can stop it.
+    """
+
+    def __init__(self, path):
+        self.bot = None
+        self.state = None
+        self.path = path
+        self.job = None  # checkpointed state of the current or last broadcast
+        self._thread = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._next_send = 0.0  # monotonic time of the next paced send slot
+
+    # ---------- control ----------
+    def start(self, bot, state, resume=True):
+        """Attach the bot and user registry; continues a broadcast interrupted by a restart"""
+        self.bot = bot
+        self.state = state
+        if resume:
+            self._resume()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def send(self, payload, owner_chat_id, status_message_id=None):
+        """Begin a broadcast; False if one is already running (here or in another worker)"""
+        with self._lock:
+            saved = self._load()
+            if self.running() or (saved and not saved.get("finished")):
+                return False
+            self.job = {"payload": payload, "owner_chat_id": owner_chat_id,
+                        "status_message_id": status_message_id, "total": self.state.user_count(),
+                        "sent": 0, "failed": 0, "pruned": 0, "elapsed": 0.0, "started": time.time(),
+                        "finished": None}
+            self._save()
+            self._launch(resumed=False)
+            return True
+
+    def _resume(self):
+        with self._lock:
+            saved = self._load()
+            if self.running() or not saved or saved.get("finished"):
+                return False
+            self.job = saved
+            print(f"[DEBUG] Resuming broadcast ({saved['sent']} sent before the restart)")
+            self._launch(resumed=True)
+            return True
+
+    def cancel(self):
+        """Stop the running broadcast (in any worker) after the messages in flight; False if none is running"""
+        with self._lock:
+            saved = self._load()
+            if not saved or saved.get("finished"):
+                return False
+            try:
+                with open(self.path + ".cancel", "w") as f:
+                    f.write(str(saved["started"]))
+            except OSError as e:
+                print(f"[DEBUG] Error saving broadcast cancel: {e}")
+                return False
+            if self.running():
+                self._cancel.set()
+            return True
+
+    def _cancel_requested(self, job):
+        """Whether /broadcast cancel was sent (in any process) for this broadcast"""
+        try:
+            with open(self.path + ".cancel", "r") as f:
+                return f.read().strip() == str(job["started"])
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            print(f"[DEBUG] Error reading broadcast cancel: {e}")
+            return False
+
+    def _launch(self, resumed):
+        self._cancel.clear()
+        self._thread = threading.Thread(target=self._run, args=(resumed,), name="broadcast", daemon=True)
+        self._thread.start()
+
+    # ---------- checkpoint ----------
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"[DEBUG] Error loading {self.path}: {e}")
+        return None
+
+    def _save(self):
+        try:
+            atomic_write_json(self.path, self.job)
+        except Exception as e:
+            print(f"[DEBUG] Error saving broadcast checkpoint: {e}")
+
+    # ---------- fan-out ----------
+    def _journal(self):
+        """user id -> outcome of every delivery logged so far in this broadcast"""
+        outcomes = {}
+        try:
+            with open(self.path + ".log", "r") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        outcomes[int(fields[0])] = fields[1]
+        except FileNotFoundError:
+            pass
+        return outcomes
+
+    def _run(self, resumed):
+        job = self.job
+        outcomes = self._journal() if resumed else {}
+        for outcome in ("sent", "failed", "pruned"):
+            job[outcome] = sum(1 for o in outcomes.values() if o == outcome)
+        gone = [uid for uid, o in outcomes.items() if o == "pruned"]  # may not have reached the registry
+        users = [uid for uid in self.state.list_users() if uid not in outcomes]
+        job["total"] = len(outcomes) + len(users)
+        resumed_elapsed = job["elapsed"]
+        run_started = time.monotonic()
+        progress_lock = threading.Lock()
+        pending = iter(users)
+        journal = open(self.path + ".log", "a" if resumed else "w")
+
+        def worker():
+            while not self._cancel.is_set():
+                with progress_lock:
+                    user_id = next(pending, None)
+                if user_id is None:
+                    return
+                outcome = self._deliver(user_id)
+                with progress_lock:
+                    job[outcome] += 1
+                    if outcome == "pruned":
+                        gone.append(user_id)
+                    journal.write(f"{user_id} {outcome}\n")
+                    journal.flush()
+
+        def checkpoint():
+            with progress_lock:
+                pruned = gone[:]
+                del gone[:]
+                job["elapsed"] = resumed_elapsed + time.monotonic() - run_started
+            if self._cancel_requested(job):
+                self._cancel.set()
+            if pruned:
+                self.state.remove_users(pruned)
+                self.state.flush()
+            self._save()
+
+        checkpoint()
+        workers = [threading.Thread(target=worker, name=f"broadcast-{i}", daemon=True)
+                   for i in range(config.BROADCAST_WORKERS)]
+        for t in workers:
+            t.start()
+        last_report = 0.0
+        while any(t.is_alive() for t in workers):
+            wake = time.monotonic() + config.BROADCAST_CHECKPOINT_INTERVAL
+            for t in workers:
+                t.join(max(0.0, wake - time.monotonic()))
+            checkpoint()
+            if time.monotonic() - last_report >= config.BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                self._report()
+        journal.close()
+        job["finished"] = "cancelled" if self._cancel.is_set() else "done"
+        checkpoint()
+        metrics.observe("broadcast.rate", self.rate())
+        print(f"[DEBUG] Broadcast {self.describe()}")
+        self._report()
+
+    def _pace(self):
+        """Wait for this sender's slot under the shared rate"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_send)
+            self._next_send = slot + 1.0 / config.BROADCAST_RATE
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _deliver(self, user_id):
+        """Send the payload to one user: "sent", "pruned" or "failed" """
+        attempts = 0
+        while not self._cancel.is_set():
+            self._pace()
+            try:
+                self._send(user_id)
+                metrics.incr("broadcast.sent")
+                return "sent"
+            except apihelper.ApiTelegramException as e:
+                description = (e.description or "").lower()
+                if e.error_code == 429:
+                    retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+                    metrics.incr("broadcast.throttled")
+                    with self._lock:
+                        self._next_send = max(self._next_send, time.monotonic() + retry_after)
+                    continue  # throttling is not the user's fault: no attempt used
+                if e.error_code in (400, 403) and any(reason in description for reason in GONE_ERRORS):
+                    metrics.incr("broadcast.pruned")
+                    return "pruned"
+                if e.error_code < 500:
+                    break
+            except Exception as e:
+                print(f"[DEBUG] Broadcast to {user_id} failed: {e}")
+            attempts += 1
+            if attempts >= config.BROADCAST_MAX_ATTEMPTS:
+                break
+        metrics.incr("broadcast.failed")
+        return "failed"
+
+    def _send(self, chat_id):
+        payload = self.job["payload"]
+        entities = [types.MessageEntity.de_json(e) for e in payload.get("entities") or []] or None
+        if payload["type"] == "text":
+            self.bot.send_message(chat_id, payload["text"], entities=entities)
+        else:
+            send = getattr(self.bot, f"send_{payload['type']}")
+            send(chat_id, payload["file_id"], caption=payload.get("caption"), caption_entities=entities)
+
+    # ---------- progress ----------
+    def rate(self):
+        job = self.job
+        handled = job["sent"] + job["failed"] + job["pruned"]
+        return handled / job["elapsed"] if job["elapsed"] else 0.0
+
+    def describe(self):
+        job = self.job
+        if job is None:
+            job = self.job = self._load()
+            if job is None:
+                return "no broadcast yet"
+        handled = job["sent"] + job["failed"] + job["pruned"]
+        rate = self.rate()
+        text = (f"{handled}/{job['total']} users ({100.0 * handled / max(1, job['total']):.0f}%), "
+                f"{job['sent']} sent, {job['failed']} failed, {job['pruned']} pruned; "
+                f"{rate:.1f} msg/s over {_duration(job['elapsed'])}")
+        if job.get("finished"):
+            return f"{job['finished']}: {text}"
+        if rate:
+            text += f", ETA {_duration((job['total'] - handled) / rate)}"
+        return f"running: {text}"
+
+    def _report(self):
+        """Edit the owner's status message with the live progress"""
+        job = self.job
+        if not job.get("status_message_id"):
+            return
+        try:
+            self.bot.edit_message_text(f"📣 Broadcast {self.describe()}", job["owner_chat_id"], job["status_message_id"])
+        except Exception as e:
+            if "message is not modified" not in str(e):
+                print(f"[DEBUG] Broadcast progress edit failed: {e}")
+
+broadcaster = Broadcaster(config.BROADCAST_CHECKPOINT_FILE)
+
+def broadcast_report():
+    """One-line summary for /debug"""
+    return broadcaster.describe()
@@ -25,6 +25,7 @@ def handle_help_callback(bot, call, usage_tracker):
 • Multiple voice options
 • High-quality audio output
 • Usage: `/say <prompt>`
+• Spoken answers: `/voice <prompt>`
 
 🚀 Prompt Enhancer
 • Enhances Prompt 
@@ -1,12 +1,109 @@
 import requests
 import json
 import re
+import threading
+import time
+from urllib.parse import urlparse
 import config
+import deadline
+import metrics
+import outbound
+import retry
+from generation_policy import policy
 from utils import AnimatedLoader
 
 # Global conversation memory
 conversation_memory = {}
 
+# ---------- Endpoints ----------
+class ChatEndpoint:
+    """One OpenAI-compatible chat upstream with its model, latency EWMA and circuit breaker.
+
+    closed: requests flow; CHAT_BREAKER_FAILURES consecutive failures open it.
+    open: skipped instantly for CHAT_BREAKER_COOLDOWN seconds.
+    half-open: one live request probes the endpoint; success closes, failure reopens.
+    """
+
+    def __init__(self, url, model):
+        self.url = url
+        self.model = model
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.latency_ms = None  # EWMA of time to response headers
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return urlparse(self.url).netloc or self.url
+
+    def allow(self):
+        """May a request go to this endpoint now? Claims the probe slot when half-open."""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < config.CHAT_BREAKER_COOLDOWN:
+                    return False
+                self.state = "half-open"
+            if self.state == "half-open":
+                if self.probing:
+                    return False
+                self.probing = True
+            return True
+
+    def record(self, ok, latency_ms=None):
+        with self._lock:
+            self.probing = False
+            if ok:
+                if self.state != "closed":
+                    print(f"[DEBUG] Chat breaker for {self.name} closed")
+                self.state = "closed"
+                self.failures = 0
+                if latency_ms is not None:
+                    self.latency_ms = latency_ms if self.latency_ms is None else 0.8 * self.latency_ms + 0.2 * latency_ms
+                return
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= config.CHAT_BREAKER_FAILURES:
+                if self.state != "open":
+                    metrics.incr("chat.breaker_opened")
+                    print(f"[DEBUG] Chat breaker for {self.name} opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def describe(self):
+        with self._lock:
+            if self.state == "open":
+                left = config.CHAT_BREAKER_COOLDOWN - (time.monotonic() - self.opened_at)
+                return f"{self.name}: open ({max(0, left):.0f}s)"
+            latency = f"{self.latency_ms:.0f} ms" if self.latency_ms is not None else "no data"
+            failures = f", {self.failures} failures" if self.failures else ""
+            return f"{self.name}: {self.state}, {latency}{failures}"
+
+def _configured_endpoints():
+    """CHAT_API_BASE is one base URL or an ordered list of URLs / (URL, model) pairs"""
+    bases = config.CHAT_API_BASE
+    if isinstance(bases, str):
+        return [ChatEndpoint(config.CHAT_API_ENDPOINT, config.CHAT_MODEL)]
+    endpoints = []
+    for entry in bases:
+        base, model = (entry, config.CHAT_MODEL) if isinstance(entry, str) else entry
+        endpoints.append(ChatEndpoint(f"{base.rstrip('/')}/chat/completions", model))
+    return endpoints
+
+chat_endpoints = _configured_endpoints()
+
+def _route():
+    """Endpoints with fewest recent failures first, then fastest (unmeasured ones get
+    tried early); list order breaks ties"""
+    return sorted(chat_endpoints, key=lambda e: (e.failures, e.latency_ms or 0.0))
+
+def chat_report():
+    """Breaker state and latency per endpoint, for /debug"""
+    return " | ".join(e.describe() for e in chat_endpoints)
+
+class ChatUpstreamError(Exception):
+    """The endpoint answered, but not with a usable reply; str() is the user-facing text"""
+
 def _append_delta_text_from_chunk(obj, buf):
     """
     Safely extract streamed text from an OpenAI-compatible SSE JSON object.
@@ -37,11 +134,14 @@ def _append_delta_text_from_chunk(obj, buf):
             if isinstance(content, str):
                 buf.append(content)
 
-def parse_streaming_response(response):
-    """Robust SSE parser tolerant to proxies and concatenated or array chunks."""
+def parse_streaming_response(response, on_delta=None):
+    """Robust SSE parser tolerant to proxies and concatenated or array chunks.
+    If on_delta is given it is called with each new piece of text as it arrives.
+    When the request deadline passes mid-stream, the text received so far is returned."""
     out_parts = []
     try:
         for raw in response.iter_lines(decode_unicode=True):
+            seen = len(out_parts)
             if not raw or raw.startswith(":"):
                 continue
             if raw.startswith("data:"):
@@ -73,13 +173,161 @@ def parse_streaming_response(response):
                     out_parts.append(p)
                     continue
                 _append_delta_text_from_chunk(obj, out_parts)
+            if on_delta and len(out_parts) > seen:
+                on_delta("".join(out_parts[seen:]))
+            if deadline.expired():
+                metrics.incr("deadline.expired.stream")
+                response.close()
+                return _partial(out_parts)
         return "".join(out_parts).strip()
     except Exception as e:
         print(f"[DEBUG] Streaming parse error: {e}")
+        if deadline.expired():
+            # The read timeout is capped by the deadline: this is the same cut-off
+            metrics.incr("deadline.expired.stream")
+            return _partial(out_parts)
+        return None
+
+def _partial(out_parts):
+    """Text streamed before the deadline, marked as cut short (None if nothing arrived)"""
+    text = "".join(out_parts).strip()
+    if not text:
         return None
+    metrics.incr("deadline.partial_replies")
+    return text + " …"
+
+def _error_text(error):
+    """User-facing text for a failed chat attempt"""
+    if isinstance(error, ChatUpstreamError):
+        return str(error)
+    if isinstance(error, requests.exceptions.HTTPError):
+        return f"🐞 **HTTP Error:** {error}"
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return "🔌 **Connection Error:** Unable to reach API endpoint."
+    if isinstance(error, requests.exceptions.Timeout):
+        return "⏳ **Timeout Error:** API response took too long."
+    return f"💥 **Error:** {str(error)[:100]}..."
+
+def _stream_from(endpoint, messages, on_delta, params=None):
+    """One attempt against endpoint; returns the reply text or raises"""
+    headers = {"Content-Type": "application/json"}
+    payload = {
+        "model": endpoint.model,
+        "messages": messages,
+        "max_tokens": 1000,
+        "temperature": 0.8,
+        "stream": True
+    }
+    payload.update(params or {})
+
+    print(f"[DEBUG] Sending request to: {endpoint.url}")
+    t0 = time.perf_counter()
+
+    def send():
+        nonlocal t0
+        t0 = time.perf_counter()  # latency is measured per attempt, not across retries
+        return retry.raise_for_retryable(requests.post(
+            endpoint.url,
+            json=payload,
+            headers=headers,
+            stream=True,
+            timeout=deadline.timeouts(endpoint.name, config.UPSTREAM_CONNECT_TIMEOUT, config.CHAT_READ_TIMEOUT)
+        ))
 
-def get_ai_response(user_message, user_name="User", chat_id=None, message_context=None):
-    """Get AI response with streaming support and conversation memory"""
+    try:
+        response = retry.call(endpoint.name, send)
+    except requests.exceptions.Timeout:
+        if deadline.expired():
+            metrics.incr("deadline.expired.ttfb")
+        raise
+    ttfb_ms = (time.perf_counter() - t0) * 1000.0
+
+    response.raise_for_status()
+    content_type = response.headers.get('Content-Type', '').lower().strip()
+
+    if "text/event-stream" in content_type or content_type == "" or "event-stream" in content_type:
+        ai_response = parse_streaming_response(response, on_delta)
+        if not ai_response:
+            raise ChatUpstreamError("🔄 **Streaming Error:** Unable to parse response.")
+        result = ai_response
+    elif "application/json" in content_type:
+        data = response.json()
+        # Non-streaming JSON format
+        try:
+            if "choices" in data and data["choices"]:
+                choice0 = data["choices"][0]
+                msg = choice0.get("message", {})
+                result = (msg.get("content") or "").strip() or "🔍 **Response Error:** Empty content."
+                if on_delta and msg.get("content"):
+                    on_delta(result)
+            else:
+                raise ChatUpstreamError("🔍 **Response Error:** Invalid response structure.")
+        except ChatUpstreamError:
+            raise
+        except Exception as e:
+            raise ChatUpstreamError(f"🔍 **Response Error:** {e}")
+    else:
+        # Try SSE parsing anyway if mislabeled
+        ai_response = parse_streaming_response(response, on_delta)
+        if not ai_response:
+            raise ChatUpstreamError(f"🚨 **API Error:** Unexpected content type: {content_type}")
+        result = ai_response
+    deadline.observe(endpoint.name, ttfb_ms=ttfb_ms, total_ms=(time.perf_counter() - t0) * 1000.0)
+    return result, ttfb_ms
+
+def _ask_endpoints(messages, on_delta, decision=None):
+    """Try endpoints fastest-first, skipping open breakers; fail over until one answers.
+    decision (from the generation policy) sets the parameters and receives the outcome."""
+    emitted = []
+    t0 = time.perf_counter()
+    params = policy.params(decision) if decision else None
+
+    def relay(piece):
+        emitted.append(piece)
+        on_delta(piece)
+
+    last_error = None
+    for endpoint in _route():
+        if deadline.expired():
+            last_error = last_error or requests.exceptions.Timeout()
+            break
+        if not endpoint.allow():
+            continue
+        try:
+            result, ttfb_ms = _stream_from(endpoint, messages, relay if on_delta else None, params)
+        except Exception as e:
+            endpoint.record(False)
+            metrics.incr("chat.failures")
+            last_error = e
+            print(f"[DEBUG] Chat endpoint {endpoint.name} failed: {e}")
+            if emitted:
+                # Part of the answer already went out; a second endpoint would repeat it
+                break
+            metrics.incr("chat.failovers")
+            continue
+        endpoint.record(True, ttfb_ms)
+        metrics.observe("chat.ttfb_ms", ttfb_ms)
+        if decision:
+            policy.record(decision, True, total_ms=(time.perf_counter() - t0) * 1000.0, ttfb_ms=ttfb_ms,
+                          output_chars=len(result), endpoint=endpoint.name)
+        return result
+    if decision:
+        policy.record(decision, False, total_ms=(time.perf_counter() - t0) * 1000.0)
+    if emitted:
+        # Keep the part of the answer that already went out; the error is a separate notice
+        metrics.incr("chat.truncated")
+        if not outbound.notice(f"⚠️ The answer was cut off. {_error_text(last_error)}"):
+            print(f"[DEBUG] Chat answer truncated: {last_error}")
+        return "".join(emitted).strip() + " (truncated)"
+    if last_error is None:
+        metrics.incr("chat.short_circuited")
+        return "🔌 **Connection Error:** The chat service is temporarily unavailable. Please try again shortly."
+    return _error_text(last_error)
+
+def get_ai_response(user_message, user_name="User", chat_id=None, message_context=None, on_delta=None, policy_context="dm"):
+    """Get AI response with streaming support and conversation memory.
+    on_delta receives streamed text pieces while the answer is still generating.
+    policy_context (dm, reply, group, voice, prompt) selects the generation parameters."""
     result = ""
     current_message = f"{user_name}: {user_message}"
 
@@ -99,53 +347,7 @@ def get_ai_response(user_message, user_name="User", chat_id=None, message_contex
 
         messages.append({"role": "user", "content": current_message})
 
-        headers = {"Content-Type": "application/json"}
-        payload = {
-            "model": config.CHAT_MODEL,
-            "messages": messages,
-            "max_tokens": 1000,
-            "temperature": 0.8,
-            "stream": True
-        }
-
-        print(f"[DEBUG] Sending request to: {config.CHAT_API_ENDPOINT}")
-        response = requests.post(
-            config.CHAT_API_ENDPOINT,
-            json=payload,
-            headers=headers,
-            stream=True,
-            timeout=60
-        )
-
-        response.raise_for_status()
-        content_type = response.headers.get('Content-Type', '').lower().strip()
-
-        if "text/event-stream" in content_type or content_type == "" or "event-stream" in content_type:
-            ai_response = parse_streaming_response(response)
-            result = ai_response if ai_response else "🔄 **Streaming Error:** Unable to parse response."
-        elif "application/json" in content_type:
-            data = response.json()
-            # Non-streaming JSON format
-            try:
-                if "choices" in data and data["choices"]:
-                    choice0 = data["choices"]
-                    msg = choice0.get("message", {})
-                    result = (msg.get("content") or "").strip() or "🔍 **Response Error:** Empty content."
-                else:
-                    result = "🔍 **Response Error:** Invalid response structure."
-            except Exception as e:
-                result = f"🔍 **Response Error:** {e}"
-        else:
-            # Try SSE parsing anyway if mislabeled
-            ai_response = parse_streaming_response(response)
-            result = ai_response if ai_response else f"🚨 **API Error:** Unexpected content type: {content_type}"
-
-    except requests.exceptions.HTTPError as http_err:
-        result = f"🐞 **HTTP Error:** {http_err}"
-    except requests.exceptions.ConnectionError:
-        result = "🔌 **Connection Error:** Unable to reach API endpoint."
-    except requests.exceptions.Timeout:
-        result = "⏳ **Timeout Error:** API response took too long."
+        result = _ask_endpoints(messages, on_delta, policy.decide(policy_context))
     except Exception as ex:
         result = f"💥 **Error:** {str(ex)[:100]}..."
 
@@ -175,13 +377,16 @@ def handle_chat_message(bot, message, chat_mode_users, user_waiting_for_chat):
 
     # Prepare message context
     context = None
+    policy_context = "dm"
     if message.reply_to_message:
         context = "Replying to previous message"
+        policy_context = "reply"
     elif message.chat.type in ['group', 'supergroup']:
         context = "Group conversation"
+        policy_context = "group"
 
     # Get AI response with conversation memory
-    ai_response = get_ai_response(message.text, user_name, message.chat.id, context)
+    ai_response = get_ai_response(message.text, user_name, message.chat.id, context, policy_context=policy_context)
 
     # Send the response
     try:
@@ -190,6 +395,106 @@ def handle_chat_message(bot, message, chat_mode_users, user_waiting_for_chat):
         print(f"[DEBUG] Failed to send chat response: {e}")
         bot.send_message(message.chat.id, ai_response)
 
+def handle_group_batch(bot, messages, user_waiting_for_chat):
+    """Answer several group mentions with one completion and one reply"""
+    from utils import log_user_interaction, get_user_mention
+
+    chat_id = messages[0].chat.id
+    users = {}
+    lines = []
+    for number, message in enumerate(messages, 1):
+        log_user_interaction(message.from_user, "chat", "Group")
+        user_waiting_for_chat.discard(message.from_user.id)
+        users.setdefault(message.from_user.id, message.from_user)
+        lines.append(f"{number}. {message.from_user.first_name or 'User'}: {message.text}")
+
+    question = ("Several people in this group mentioned you at almost the same time. "
+                "Answer each of them in turn in one message, starting each answer with their name and a colon.\n"
+                + "\n".join(lines))
+    ai_response = get_ai_response(question, "Group members", chat_id, "Group conversation", policy_context="group_batch")
+
+    text = f"💬 {', '.join(get_user_mention(user) for user in users.values())}\n\n{ai_response}"
+    reply_to = messages[-1].message_id
+    try:
+        bot.send_message(chat_id, text, parse_mode="Markdown", reply_to_message_id=reply_to)
+    except Exception as e:
+        print(f"[DEBUG] Failed to send batched group response: {e}")
+        bot.send_message(chat_id, text, reply_to_message_id=reply_to)
+
+def handle_voice_command(bot, message, usage_tracker):
+    """Handle /voice: answer with speech, voicing sentences while the reply streams"""
+    from utils import log_user_interaction
+    from tts_handler import SpeechPipeline, TTS_LIMIT_TEXT
+
+    user_id = message.from_user.id
+    user_name = message.from_user.first_name or "User"
+    log_user_interaction(message.from_user, "/voice", "DM" if message.chat.type == "private" else "Group")
+
+    question = (message.text or "").partition(" ")[2].strip()
+    if not question:
+        bot.reply_to(message, """🗣️ **Voice Reply Help**
+
+**Usage:** `/voice [message]`
+
+**Example:** `/voice tell me a fun fact about space`
+
+**💡 I'll answer out loud with a voice message!**""", parse_mode="Markdown")
+        return
+
+    # Chunk mode bills every voiced segment: hold one credit per segment the
+    # reply may voice, and voice no more than the user has credits for
+    max_segments = config.VOICE_REPLY_MAX_SEGMENTS
+    cost_limit = 1
+    if config.TTS_QUOTA_MODE == "chunk":
+        max_segments = cost_limit = min(max_segments, usage_tracker.get_remaining_tts(user_id))
+    reservation = usage_tracker.reserve(user_id, "tts", cost_limit) if cost_limit else None
+    if reservation is None:
+        bot.reply_to(message, TTS_LIMIT_TEXT, parse_mode="Markdown")
+        return
+
+    context = "Replying to previous message" if message.reply_to_message else None
+    if message.chat.type in ['group', 'supergroup'] and not context:
+        context = "Group conversation"
+
+    with reservation:
+        loader = AnimatedLoader(bot, message.chat.id, "Thinking out loud", "tts")
+        loader.start()
+        pipeline = SpeechPipeline(max_segments=max_segments)
+        t0 = time.perf_counter()
+        try:
+            ai_response = get_ai_response(question, user_name, message.chat.id, context, on_delta=pipeline.feed,
+                                          policy_context="voice")
+            llm_ms = (time.perf_counter() - t0) * 1000.0
+            audio_data = pipeline.finish()
+        finally:
+            loader.stop()
+        total_ms = (time.perf_counter() - t0) * 1000.0
+        metrics.observe("voice_reply.llm_ms", llm_ms)
+        metrics.observe("voice_reply.total_ms", total_ms)
+        print(f"[DEBUG] Voice reply: {pipeline.segments} segments{' (capped)' if pipeline.capped else ''}, LLM {llm_ms:.0f} ms, total {total_ms:.0f} ms")
+
+        if not audio_data:
+            # Upstream error strings and failed synthesis fall back to a text answer
+            try:
+                bot.reply_to(message, ai_response, parse_mode="Markdown")
+            except Exception:
+                bot.reply_to(message, ai_response)
+            return
+
+        caption = ai_response if len(ai_response) <= 1000 else ai_response[:997] + "..."
+        try:
+            bot.send_voice(message.chat.id, audio_data, caption=caption, parse_mode="Markdown", reply_to_message_id=message.message_id)
+        except Exception as e:
+            print(f"[DEBUG] Failed to send voice reply with Markdown: {e}")
+            bot.send_voice(message.chat.id, audio_data, caption=caption, reply_to_message_id=message.message_id)
+        reservation.commit(min(pipeline.segments, cost_limit))
+        if pipeline.capped and caption != ai_response:
+            # Only the start was voiced and the caption is cut short: the whole answer as text
+            try:
+                bot.reply_to(message, ai_response, parse_mode="Markdown")
+            except Exception:
+                bot.reply_to(message, ai_response)
+
 def handle_prompt_command(bot, message):
     """Handle /prompt command for enhancing prompts with animation"""
     from utils import log_user_interaction, AnimatedLoader
@@ -266,7 +571,7 @@ Now rewrite this prompt and ONLY output the final enhanced result:
 
     try:
         # Get enhanced response
-        enhanced = get_ai_response(enhanced_prompt, user_name, message.chat.id)
+        enhanced = get_ai_response(enhanced_prompt, user_name, message.chat.id, policy_context="prompt")
 
         # Stop loader
         loader.stop()
@@ -10,6 +10,20 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "8363910268:AAH7Hg9OdhD6IEm2GgfzuJo89_LE0zKhL
 # Owner IDs (Telegram user IDs of developers/admins)
 OWNER_IDS = [7673097445, 5666606072]
 
+# Bot API base URL override ("http://host:port/bot{0}/{1}"), e.g. a local
+# Bot API server or fake_upstreams.py; None uses api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Redelivered updates (after a restart or polling hiccup) are dropped before any
+# handler runs: processed update_ids are kept in a persisted ring bitmap
+# covering the last UPDATE_DEDUP_WINDOW ids. Telegram keeps undelivered updates
+# for 24 hours and restarts update_ids from a random value after a week without
+# updates, so the index is discarded after UPDATE_DEDUP_MAX_AGE seconds idle.
+UPDATE_DEDUP_ENABLED = True
+UPDATE_DEDUP_FILE = "seen_updates.bin"
+UPDATE_DEDUP_WINDOW = 100000
+UPDATE_DEDUP_MAX_AGE = 24 * 60 * 60
+
 # ==============================================
 # 📝 BOT NAMES FOR TRIGGERING IN GROUPS
 # ==============================================
@@ -27,7 +41,34 @@ BOT_NAMES = ["BrahMos", "Brahmos", "brahMos", "brahmos",
 #   - Bot requests: https://akashiverse.com/api/imagev2.php?prompt=cyberpunk samurai
 #   - API returns raw image (binary, no JSON, no key required)
 #   - Bot sends that image back
+#
+# IMAGE_API_URL may also be a list of provider URLs; requests go to a
+# health-weighted pick and fail over to the others.
 IMAGE_API_URL = "https://akashiverse.com/api/imagev2.php"
+IMAGE_REQUEST_TIMEOUT = 120
+
+# Hedged requests: if the first attempt is slower than the observed
+# IMAGE_HEDGE_PERCENTILE latency, a duplicate is sent and the first result wins.
+IMAGE_HEDGE_ENABLED = True
+IMAGE_HEDGE_PERCENTILE = 95
+IMAGE_HEDGE_MIN_SAMPLES = 20
+IMAGE_HEDGE_DEFAULT_DELAY = 20  # seconds, until enough samples are observed
+IMAGE_HEDGE_MIN_DELAY = 5  # seconds
+IMAGE_POOL_SIZE = 32
+# /image x<count> <prompt>: variations are generated concurrently (bounded
+# fan-out) and delivered together as one media group
+IMAGE_MAX_BATCH = 4
+IMAGE_BATCH_FANOUT = 4
+# Media preparation before upload: images over IMAGE_TARGET_BYTES or Telegram's
+# photo limits are recompressed to JPEG in a process pool (needs Pillow), or
+# sent as a document when that is not possible.
+IMAGE_RECOMPRESS = True
+IMAGE_TARGET_BYTES = 5 * 1024 * 1024
+IMAGE_MAX_SIDE = 4096
+IMAGE_RECOMPRESS_WORKERS = 2
+IMAGE_RECOMPRESS_TIMEOUT = 30  # seconds
+# Hard cap on a downloaded image; bodies are streamed and type-checked by magic bytes
+IMAGE_MAX_BYTES = 20 * 1024 * 1024
 
 # ==============================================
 # 💬 CHAT API (OpenAI-compatible proxy)
@@ -40,6 +81,49 @@ CHAT_API_BASE = "https://long-boat-1fcb.akaegs.workers.dev/v1"
 CHAT_API_ENDPOINT = f"{CHAT_API_BASE}/chat/completions"
 CHAT_MODEL = "gpt-4"
 
+# CHAT_API_BASE may also be an ordered list of OpenAI-compatible bases, each a
+# URL (uses CHAT_MODEL) or a (URL, model) pair, e.g.
+#   CHAT_API_BASE = ["https://a.example/v1", ("https://b.example/v1", "gpt-4o-mini")]
+# Requests go to the fastest healthy endpoint and fail over to the next one.
+# Each endpoint has a circuit breaker: CHAT_BREAKER_FAILURES consecutive
+# failures open it, and after CHAT_BREAKER_COOLDOWN seconds one live request
+# probes it again.
+CHAT_BREAKER_FAILURES = 5
+CHAT_BREAKER_COOLDOWN = 30
+
+# Generation parameters per context. When the p95 time to a complete reply
+# over the last CHAT_SLO_WINDOW replies exceeds CHAT_LATENCY_SLO_MS, every
+# max_tokens is scaled down by CHAT_SLO_TIGHTEN (not below CHAT_SLO_MIN_SCALE);
+# once p95 is comfortably under the SLO the scale recovers by CHAT_SLO_RELAX_STEP.
+# Every decision and its outcome is appended to CHAT_DECISION_LOG (JSON lines).
+CHAT_GENERATION_PROFILES = {
+    "dm": {"max_tokens": 1000, "temperature": 0.8},
+    "reply": {"max_tokens": 700, "temperature": 0.8},
+    "group": {"max_tokens": 400, "temperature": 0.8},
+    "group_batch": {"max_tokens": 900, "temperature": 0.8},  # several mentions answered at once
+    "voice": {"max_tokens": 350, "temperature": 0.8},  # spoken answers stay short
+    "prompt": {"max_tokens": 500, "temperature": 0.8},
+}
+CHAT_LATENCY_SLO_MS = 12000
+CHAT_SLO_WINDOW = 20
+CHAT_SLO_TIGHTEN = 0.75
+CHAT_SLO_RELAX_STEP = 0.1
+CHAT_SLO_MIN_SCALE = 0.3
+CHAT_MIN_MAX_TOKENS = 64
+CHAT_DECISION_LOG = "chat_decisions.jsonl"
+CHAT_DECISION_LOG_MAX_BYTES = 5 * 1024 * 1024  # rotated to .1 beyond this
+
+# Group mentions: a mention is answered GROUP_DEBOUNCE_WINDOW seconds after it
+# arrives. Mentions that come in meanwhile, or while GROUP_MAX_CONCURRENT_GENERATIONS
+# answers are already running for that group, are merged into one completion
+# and answered in a single reply. Answers run on GROUP_BATCH_WORKERS threads
+# shared by all groups.
+GROUP_BATCHING_ENABLED = True
+GROUP_DEBOUNCE_WINDOW = 1.5
+GROUP_MAX_CONCURRENT_GENERATIONS = 1
+GROUP_MAX_BATCH = 8
+GROUP_BATCH_WORKERS = 32
+
 # ==============================================
 # 🎤 TEXT-TO-SPEECH API
 # ==============================================
@@ -47,6 +131,133 @@ CHAT_MODEL = "gpt-4"
 TTS_API_BASE = "https://reflexai-j0ro.onrender.com/v1"
 TTS_API_ENDPOINT = "https://reflexai-j0ro.onrender.com/v1/audio/speech"
 TTS_MODEL = "gpt-4o-mini-tts"
+# Hard cap on a downloaded audio clip (must sniff as MP3 or Ogg/Opus)
+TTS_MAX_BYTES = 20 * 1024 * 1024
+
+# Synthesized audio is cached by (normalized text, voice, model, format, speed)
+# in memory and on disk, with LRU eviction by total bytes.
+TTS_CACHE_ENABLED = True
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MEMORY_BYTES = 16 * 1024 * 1024
+TTS_CACHE_DISK_BYTES = 256 * 1024 * 1024
+
+# Long-form TTS: text over TTS_CHUNK_CHARS is split at sentence boundaries and
+# the chunks are synthesized concurrently, then joined into one voice message.
+TTS_CHUNK_CHARS = 500
+TTS_LONG_MAX_CHARS = 5000
+TTS_MAX_PARALLEL_CHUNKS = 4
+# "job": one TTS credit per request, "chunk": one credit per synthesized chunk
+TTS_QUOTA_MODE = "job"
+
+# Voice replies (/voice): streamed chat sentences are voiced while the answer is
+# still generating; short sentences are grouped up to this many characters.
+VOICE_REPLY_MIN_SEGMENT_CHARS = 120
+# At most this many segments of an answer are voiced; the rest stays text only.
+# In "chunk" quota mode a voice reply holds one credit per segment it may voice
+# (fewer when the user has fewer left) and is charged per voiced segment.
+VOICE_REPLY_MAX_SEGMENTS = 8
+
+# ==============================================
+# ⏱️ DEADLINES & TIMEOUTS
+# ==============================================
+# Every update gets REQUEST_DEADLINE seconds from ingestion (generation jobs get
+# JOB_DEADLINE from when a worker starts them); upstream and Telegram calls are
+# capped by what is left. A chat stream cut off by its deadline is sent as is.
+REQUEST_DEADLINE = 60
+JOB_DEADLINE = 180
+TELEGRAM_MIN_TIMEOUT = 10  # Bot API calls always get this long, even past the deadline
+
+# Upstream timeouts start at these defaults and, after ADAPTIVE_TIMEOUT_MIN_SAMPLES
+# calls, follow observed time to first byte: read = ADAPTIVE_READ_FACTOR x p99,
+# connect = ADAPTIVE_CONNECT_FACTOR x p50 (not below ADAPTIVE_TIMEOUT_FLOOR).
+UPSTREAM_CONNECT_TIMEOUT = 5
+CHAT_READ_TIMEOUT = 60
+TTS_READ_TIMEOUT = 60
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 20
+ADAPTIVE_READ_FACTOR = 3
+ADAPTIVE_CONNECT_FACTOR = 3
+ADAPTIVE_TIMEOUT_FLOOR = 2
+
+# ==============================================
+# 🔁 UPSTREAM RETRIES & CONCURRENCY
+# ==============================================
+# Chat, image and TTS calls retry connect errors, 429/5xx answers and (for
+# idempotent GETs) timeouts, up to RETRY_MAX_ATTEMPTS tries with full-jitter
+# exponential backoff. Each call earns RETRY_BUDGET_RATIO retry tokens (up to
+# RETRY_BUDGET_BURST), so retries stay around 10% of traffic during an outage.
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.25  # seconds; the backoff cap doubles per retry
+RETRY_MAX_DELAY = 4
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_BURST = 10
+
+# Per-upstream concurrency limits for the image and TTS APIs, discovered with
+# AIMD: +1 per round of calls answered within LIMITER_LATENCY_TOLERANCE x the
+# no-load latency, x LIMITER_BACKOFF on errors or slowdowns. Requests over the
+# limit queue up to LIMITER_QUEUE_TIMEOUT seconds, or are shed when
+# LIMITER_MAX_QUEUE are already waiting.
+LIMITER_INITIAL = 8
+LIMITER_MIN = 1
+LIMITER_MAX = 64
+LIMITER_BACKOFF = 0.7
+LIMITER_LATENCY_TOLERANCE = 2.0
+LIMITER_QUEUE_TIMEOUT = 10
+LIMITER_MAX_QUEUE = 100
+
+# ==============================================
+# 🩺 HEALTH PROBES
+# ==============================================
+# A background prober checks Telegram and every upstream each
+# HEALTH_PROBE_INTERVAL seconds for /ping and /debug. After HEALTH_IDLE_AFTER
+# seconds without messages the interval doubles per round, up to
+# HEALTH_PROBE_MAX_INTERVAL. Above HEALTH_MAX_ERROR_RATE % failed probes
+# an upstream is reported as degraded. Chat and TTS are probed with
+# GET /models; a request to the image API would generate an image, so an
+# image provider counts as up while the success score of its real requests
+# stays at or above HEALTH_MIN_IMAGE_SCORE (0-1).
+HEALTH_PROBE_ENABLED = True
+HEALTH_PROBE_INTERVAL = 30
+HEALTH_PROBE_MAX_INTERVAL = 600
+HEALTH_IDLE_AFTER = 300
+HEALTH_PROBE_TIMEOUT = 5
+HEALTH_MAX_ERROR_RATE = 20
+HEALTH_MIN_IMAGE_SCORE = 0.5
+# Under supervisor.py worker 0 probes and writes its results here; the other
+# workers read them (and touch HEALTH_SNAPSHOT_FILE.active when they see traffic)
+HEALTH_SNAPSHOT_FILE = "health_state.json"
+
+# ==============================================
+# 📬 GENERATION JOB QUEUE
+# ==============================================
+# /image, /say and the waiting-mode inputs enqueue a job in JOB_QUEUE_DB and
+# return; JOB_WORKERS threads run jobs under a lease, retrying failed attempts
+# with exponential backoff. Jobs interrupted by a restart run again.
+JOB_QUEUE_ENABLED = True
+JOB_QUEUE_DB = "jobs.db"
+JOB_WORKERS = 16
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5  # seconds before the first retry, doubled per attempt
+JOB_POLL_INTERVAL = 1  # seconds between checks for delayed or recovered jobs
+JOB_RETENTION_HOURS = 24  # finished jobs are kept this long
+
+# ==============================================
+# 📣 BROADCASTS
+# ==============================================
+# /broadcast (as a reply to the message to send) fans it out to every
+# registered user: BROADCAST_WORKERS senders share a pace of BROADCAST_RATE
+# messages per second (Telegram allows about 30/s to different chats), and a
+# 429 pauses them all for its retry_after. Media go out by file_id, so nothing
+# is uploaded again. Progress is checkpointed every BROADCAST_CHECKPOINT_INTERVAL
+# seconds and an interrupted broadcast resumes on restart; users that blocked
+# the bot or were deactivated are removed from the registry. `/broadcast
+# cancel` works from any worker process: it stops at the next checkpoint.
+BROADCAST_RATE = 25
+BROADCAST_WORKERS = 8
+BROADCAST_MAX_ATTEMPTS = 3  # per user, not counting 429s
+BROADCAST_CHECKPOINT_FILE = "broadcast_state.json"
+BROADCAST_CHECKPOINT_INTERVAL = 2
+BROADCAST_PROGRESS_INTERVAL = 5  # seconds between edits of the owner's status message
 
 # ==============================================
 # 🔗 DEVELOPER & COMMUNITY LINKS
@@ -76,11 +287,63 @@ Give professional answers without being overly messy in formatting.
 FREE_IMAGE_LIMIT = 100
 FREE_TTS_LIMIT = 100
 
-# File paths for data storage
+# /addpro and /removepro also read user IDs from an attached .txt/.csv file
+# of at most this size; the whole batch is saved with a single write.
+PREMIUM_IMPORT_MAX_BYTES = 1024 * 1024
+
+# Quota is reserved before upstream work and committed/refunded afterwards;
+# per-user reservation counters are guarded by this many striped locks.
+QUOTA_LOCK_STRIPES = 64
+
+# State backend for premium users, usage counters and the user registry:
+#   "json"   - the JSON files below (single process)
+#   "sqlite" - STATE_DB_FILE in WAL mode (constant-time ops, shareable
+#              between processes); seeded from the JSON files on first run
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json")
+STATE_DB_FILE = "brahmos.db"
+USAGE_RETENTION_DAYS = 30  # day-partitioned usage rows kept in SQLite
+
+# File paths for data storage (json backend)
 PREMIUM_USERS_FILE = "premium_users.json"
 USAGE_DATA_FILE = "usage_data.json"
+USERS_FILE = "users.json"
+
+# Usage counters are written behind: flushed every USAGE_FLUSH_INTERVAL
+# seconds, or sooner once USAGE_FLUSH_DIRTY_THRESHOLD changes are pending.
+USAGE_FLUSH_INTERVAL = 5
+USAGE_FLUSH_DIRTY_THRESHOLD = 200
+
+# Ephemeral session state (chat mode, waiting for image/TTS input) lives in
+# memory with idle TTLs; a timer-wheel sweeper ticks every SESSION_SWEEP_INTERVAL
+# seconds and at most SESSION_MAX_ENTRIES users are tracked (LRU beyond that).
+SESSION_CHAT_TTL = 6 * 60 * 60
+SESSION_WAITING_TTL = 15 * 60
+SESSION_MAX_ENTRIES = 100000
+SESSION_SWEEP_INTERVAL = 30
 
 # ==============================================
 # 🔧 CONSTANTS
 # ==============================================
 MAX_CAPTION_LENGTH = 1024
+MAX_MESSAGE_LENGTH = 4096
+
+# Media relay: upstream bodies are spooled in memory up to this size (then to
+# a temp file) and streamed into Telegram uploads without extra copies.
+MEDIA_SPOOL_THRESHOLD = 1024 * 1024
+MEDIA_STREAMING_UPLOADS = True
+
+# ==============================================
+# 🧩 WORKER PROCESSES (supervisor.py)
+# ==============================================
+# `python3 supervisor.py` (the Procfile's `bot` process) polls Telegram once and
+# shards updates by chat_id to SUPERVISOR_WORKERS bot processes over local
+# queues; workers share state through the sqlite backend and are restarted if
+# they crash. Worker 0 also runs the job workers (JOB_WORKERS threads), the
+# health prober and broadcast resume; the others only queue jobs, which worker
+# 0 picks up within JOB_POLL_INTERVAL. `python3 brahmos.py` still runs the
+# whole bot in one process (SUPERVISOR_WORKERS=1 is close to that).
+SUPERVISOR_WORKERS = int(os.getenv("SUPERVISOR_WORKERS", os.cpu_count() or 2))
+SUPERVISOR_QUEUE_SIZE = 1000  # updates buffered per worker before polling blocks
+SUPERVISOR_WORKER_PREFETCH = 8  # updates a worker takes ahead of its handler threads
+SUPERVISOR_MAX_RESTART_DELAY = 30  # seconds; restart delay doubles per crash
+WORKER_INDEX = None  # set inside worker processes
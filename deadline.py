@@ -0,0 +1,103 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+import metrics
+
+# Per-request deadlines. A Deadline is stamped on every update when it is
+# ingested (REQUEST_DEADLINE) or when a generation job starts (JOB_DEADLINE),
+# installed for the handler thread, and consulted by every upstream and
+# Telegram call made on its behalf.
+
+_local = threading.local()
+
+class Deadline:
+    """Point in time by which the user should have an answer"""
+
+    def __init__(self, seconds):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+def current():
+    """The deadline of the request being handled on this thread, or None"""
+    return getattr(_local, "deadline", None)
+
+@contextmanager
+def scope(deadline):
+    """Make deadline current for the duration of a handler or job"""
+    previous = current()
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = previous
+
+def bind(fn):
+    """Wrap fn so it runs under the caller's deadline on another thread (pool workers)"""
+    deadline = current()
+    if deadline is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with scope(deadline):
+            return fn(*args, **kwargs)
+    return run
+
+def expired():
+    deadline = current()
+    return deadline is not None and deadline.expired()
+
+def remaining(default=None):
+    deadline = current()
+    return deadline.remaining() if deadline is not None else default
+
+def observe(upstream, ttfb_ms=None, total_ms=None):
+    """Record time to first byte and total time of one upstream call, separately"""
+    if ttfb_ms is not None:
+        metrics.observe(f"upstream.ttfb_ms.{upstream}", ttfb_ms)
+    if total_ms is not None:
+        metrics.observe(f"upstream.total_ms.{upstream}", total_ms)
+
+def timeouts(upstream, connect_default, read_default):
+    """
+    (connect, read) timeouts for one call to upstream. Once enough samples
+    exist they follow the observed time to first byte (read: a multiple of
+    p99, connect: a multiple of p50, never above the defaults); both are
+    then capped by what is left of the current deadline.
+    """
+    connect, read = connect_default, read_default
+    name = f"upstream.ttfb_ms.{upstream}"
+    stats = metrics.window_stats(name)
+    if stats["count"] >= config.ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+        p99 = metrics.percentile(name, 99) / 1000.0
+        connect = min(connect_default, max(config.ADAPTIVE_TIMEOUT_FLOOR, config.ADAPTIVE_CONNECT_FACTOR * stats["p50"] / 1000.0))
+        read = min(read_default, max(config.ADAPTIVE_TIMEOUT_FLOOR, config.ADAPTIVE_READ_FACTOR * p99))
+    left = remaining()
+    if left is not None:
+        left = max(left, 0.5)
+        connect, read = min(connect, left), min(read, left)
+    return connect, read
+
+def telegram_timeout(timeout):
+    """Cap a Bot API (connect, read) timeout by the current deadline, but never below
+    TELEGRAM_MIN_TIMEOUT so the final reply still goes out when time is nearly up"""
+    left = remaining()
+    if left is None or timeout is None:
+        return timeout
+    cap = max(left, config.TELEGRAM_MIN_TIMEOUT)
+    if isinstance(timeout, tuple):
+        return tuple(min(t, cap) if t is not None else cap for t in timeout)
+    return min(timeout, cap)
+
+def deadline_report():
+    """One-line summary for /debug"""
+    return (f"{metrics.get('deadline.expired.ttfb')} TTFB / {metrics.get('deadline.expired.stream')} stream / "
+            f"{metrics.get('deadline.expired.download')} download expiries, "
+            f"{metrics.get('deadline.partial_replies')} partial replies sent")
@@ -0,0 +1,210 @@
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+# A tiny PNG header is enough for the media sniffers; the rest is filler
+FAKE_PNG = b"\x89PNG\r\n\x1a\n" + b"\x00\x00\x00\rIHDR" + (64).to_bytes(4, "big") * 2 + b"\x08\x02\x00\x00\x00" + b"\x00" * 2048
+FAKE_MP3 = b"ID3\x03\x00\x00\x00\x00\x00\x00" + b"\xff\xfb\x90\x00" * 512
+
+class FakeUpstreams:
+    """
+    Local stand-ins for the Telegram Bot API and the chat, image and TTS
+    upstreams, so the bot (single process or supervisor.py) can be driven
+    end to end on one machine. Every upstream answers after `latency` seconds.
+    Chats in `blocked` answer sends with 403; with `send_rate` set, sends
+    beyond that many per second across chats get a 429 like Telegram's.
+    """
+
+    def __init__(self, latency=0.05, host="127.0.0.1", port=0):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._updates = []
+        self._new_updates = threading.Condition(self._lock)
+        self._next_update_id = 1
+        self.calls = {}  # Bot API method -> count
+        self.replies = 0  # messages, photos and voices sent back to chats
+        self.upstream_calls = {}  # "chat" / "image" / "tts" -> count
+        self.blocked = set()  # chat ids that blocked the bot
+        self.send_rate = None
+        self._send_times = []
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self.base = f"http://{host}:{self._server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-upstreams", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def overrides(self):
+        """config values that point the bot at these fakes"""
+        return {
+            "TELEGRAM_API_URL": self.base + "/bot{0}/{1}",
+            "CHAT_API_ENDPOINT": self.base + "/v1/chat/completions",
+            "IMAGE_API_URL": self.base + "/image",
+            "TTS_API_BASE": self.base + "/v1",
+            "TTS_API_ENDPOINT": self.base + "/v1/audio/speech",
+        }
+
+    def push_message(self, chat_id, text, user_id=None, chat_type="private"):
+        """Queue a text message for getUpdates"""
+        user_id = user_id or chat_id
+        with self._lock:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append({"update_id": update_id, "message": {
+                "message_id": update_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": chat_type},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            }})
+            self._new_updates.notify_all()
+        return update_id
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        wait = min(float(params.get("long_polling_timeout", 0) or 0), 1.0)
+        with self._lock:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and wait:
+                self._new_updates.wait(wait)
+            return self._updates[:int(params.get("limit", 100) or 100)]
+
+    def _bot_method(self, method, params):
+        """(HTTP status, Bot API response) of one call"""
+        chat_id = int(params.get("chat_id", 0) or 0)
+        is_send = method.startswith("send") and method != "sendChatAction"
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if is_send and self.send_rate:
+                now = time.monotonic()
+                self._send_times = [t for t in self._send_times if now - t < 1.0]
+                if len(self._send_times) >= self.send_rate:
+                    self.calls["throttled"] = self.calls.get("throttled", 0) + 1
+                    return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                 "parameters": {"retry_after": 1}}
+                self._send_times.append(now)
+            if is_send and chat_id in self.blocked:
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+            if method in ("sendMessage", "sendPhoto", "sendVoice", "sendDocument", "sendMediaGroup"):
+                self.replies += 1
+        return 200, {"ok": True, "result": self._bot_result(method, chat_id, params)}
+
+    def _bot_result(self, method, chat_id, params):
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "BrahMos", "username": "brahmos_fake_bot"}
+        if method in ("answerCallbackQuery", "deleteMessage", "sendChatAction"):
+            return True
+        message = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        return [message] if method == "sendMediaGroup" else message
+
+    def _handler(self):
+        fakes = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body, content_type, status=200):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client went away (e.g. a worker killed by a crash test)
+
+            def _params(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                content_type = self.headers.get("Content-Type", "")
+                if "application/x-www-form-urlencoded" in content_type:
+                    params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+                elif "application/json" in content_type and body:
+                    params.update(json.loads(body))
+                return url.path, params
+
+            def do_GET(self):
+                if self.path.endswith("/models"):
+                    # Health probes: OpenAI-compatible model list
+                    body = {"object": "list", "data": [{"id": "fake", "object": "model"}]}
+                    self._send(json.dumps(body).encode(), "application/json")
+                    return
+                self.do_POST()
+
+            def do_POST(self):
+                path, params = self._params()
+                if path.startswith("/bot"):
+                    status, response = fakes._bot_method(path.rsplit("/", 1)[-1], params)
+                    self._send(json.dumps(response).encode(), "application/json", status)
+                    return
+                kind = "chat" if path.endswith("/chat/completions") else "tts" if path.endswith("/audio/speech") else "image"
+                with fakes._lock:
+                    fakes.upstream_calls[kind] = fakes.upstream_calls.get(kind, 0) + 1
+                time.sleep(fakes.latency)
+                if path.endswith("/chat/completions"):
+                    chunks = [{"choices": [{"delta": {"content": word + " "}}]} for word in ("Hello", "from", "the", "fake", "upstream.")]
+                    body = "".join(f"data: {json.dumps(c)}\n\n" for c in chunks) + "data: [DONE]\n\n"
+                    self._send(body.encode(), "text/event-stream")
+                elif path.endswith("/audio/speech"):
+                    self._send(FAKE_MP3, "audio/mpeg")
+                elif path.startswith("/image"):
+                    self._send(FAKE_PNG, "image/png")
+                else:
+                    self._send(b"not found", "text/plain", 404)
+
+        return Handler
+
+def load_test(workers, updates, chats=200, kill_after=None):
+    """Drive supervisor.py with `updates` private messages and report throughput"""
+    from supervisor import Supervisor
+
+    fakes = FakeUpstreams().start()
+    workdir = tempfile.mkdtemp(prefix="brahmos-load-")
+    overrides = fakes.overrides()
+    overrides.update(STATE_BACKEND="sqlite", STATE_DB_FILE=os.path.join(workdir, "brahmos.db"),
+                     JOB_QUEUE_DB=os.path.join(workdir, "jobs.db"),
+                     UPDATE_DEDUP_FILE=os.path.join(workdir, "seen_updates.bin"), TTS_CACHE_DIR=os.path.join(workdir, "tts_cache"),
+                     HEALTH_SNAPSHOT_FILE=os.path.join(workdir, "health_state.json"))
+    supervisor = Supervisor(workers, overrides)
+    thread = threading.Thread(target=supervisor.run, daemon=True)
+    thread.start()
+    while fakes.calls.get("getUpdates", 0) < 1 or not all(p and p.is_alive() for p in supervisor.procs):
+        time.sleep(0.1)
+    time.sleep(3)  # workers import the bot before serving
+
+    started = time.monotonic()
+    for i in range(updates):
+        fakes.push_message(1000 + i % chats, f"hello {i}")
+    killed = False
+    progress, last_progress = 0, time.monotonic()
+    while fakes.replies < updates and time.monotonic() - last_progress < 10:
+        if kill_after and not killed and fakes.replies >= kill_after:
+            supervisor.procs[0].kill()
+            killed = True
+        if fakes.replies != progress:
+            progress, last_progress = fakes.replies, time.monotonic()
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+    supervisor.stop()
+    fakes.stop()
+    print(f"[LOAD] workers={workers} updates={updates} replies={fakes.replies} "
+          f"elapsed={elapsed:.2f}s throughput={fakes.replies / elapsed:.1f}/s restarts={supervisor.restarts}")
+
+if __name__ == "__main__":
+    # python3 fake_upstreams.py [workers] [updates] [kill_after]
+    args = [int(a) for a in sys.argv[1:]]
+    load_test(args[0] if args else 2, args[1] if len(args) > 1 else 500, kill_after=args[2] if len(args) > 2 else None)
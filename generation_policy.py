@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+import time
+
+import config
+import metrics
+
+class GenerationPolicy:
+    """
+    Picks chat generation parameters per context (dm, reply, group, voice,
+    prompt) from CHAT_GENERATION_PROFILES, scaled by a shared factor that
+    drops when the p95 time to a complete reply breaks CHAT_LATENCY_SLO_MS
+    and recovers slowly once latency is back under it. Every decision is
+    logged with its outcome so the trade-off can be tuned from data.
+    """
+
+    def __init__(self, log_path=None):
+        self.scale = 1.0
+        self.log_path = log_path
+        self._samples = []  # reply latencies since the last SLO evaluation
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+    def decide(self, context):
+        """Generation parameters for one request in context"""
+        profile = config.CHAT_GENERATION_PROFILES.get(context) or config.CHAT_GENERATION_PROFILES["dm"]
+        with self._lock:
+            scale = self.scale
+        max_tokens = max(config.CHAT_MIN_MAX_TOKENS, int(profile["max_tokens"] * scale))
+        metrics.incr(f"chat.policy.{context}")
+        return {"context": context, "scale": round(scale, 3), "max_tokens": max_tokens,
+                "temperature": profile["temperature"], "started": time.time()}
+
+    def params(self, decision):
+        """The request body fields of a decision"""
+        return {"max_tokens": decision["max_tokens"], "temperature": decision["temperature"]}
+
+    def record(self, decision, ok, total_ms=None, ttfb_ms=None, output_chars=0, endpoint=None):
+        """Outcome of a decision: feeds the SLO and appends to the decision log"""
+        if total_ms is not None:
+            # Failed requests count too: timeouts are the slowest answers the SLO has to see
+            metrics.observe(f"chat.total_ms.{decision['context']}", total_ms)
+            self._observe(total_ms)
+        entry = dict(decision, ok=ok, total_ms=_round(total_ms), ttfb_ms=_round(ttfb_ms),
+                     output_chars=output_chars, endpoint=endpoint)
+        self._log(entry)
+
+    def _observe(self, total_ms):
+        with self._lock:
+            self._samples.append(total_ms)
+            if len(self._samples) < config.CHAT_SLO_WINDOW:
+                return
+            samples = sorted(self._samples)
+            self._samples = []
+            p95 = samples[int(round(0.95 * (len(samples) - 1)))]
+            previous = self.scale
+            if p95 > config.CHAT_LATENCY_SLO_MS:
+                self.scale = max(config.CHAT_SLO_MIN_SCALE, self.scale * config.CHAT_SLO_TIGHTEN)
+            elif p95 < 0.7 * config.CHAT_LATENCY_SLO_MS:
+                self.scale = min(1.0, self.scale + config.CHAT_SLO_RELAX_STEP)
+        if self.scale != previous:
+            metrics.incr("chat.policy.tightened" if self.scale < previous else "chat.policy.relaxed")
+            print(f"[DEBUG] Chat p95 {p95:.0f} ms vs SLO {config.CHAT_LATENCY_SLO_MS} ms: "
+                  f"generation scale {previous:.2f} -> {self.scale:.2f}")
+
+    def _log(self, entry):
+        if not self.log_path:
+            return
+        try:
+            with self._log_lock:
+                if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > config.CHAT_DECISION_LOG_MAX_BYTES:
+                    os.replace(self.log_path, self.log_path + ".1")
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f"[DEBUG] Error writing {self.log_path}: {e}")
+
+def _round(value):
+    return None if value is None else round(value, 1)
+
+policy = GenerationPolicy(config.CHAT_DECISION_LOG)
+
+def policy_report():
+    """One-line summary for /debug"""
+    contexts = ", ".join(
+        f"{context} p95 {metrics.window_stats(f'chat.total_ms.{context}')['p95'] / 1000:.1f}s"
+        for context in config.CHAT_GENERATION_PROFILES if metrics.get(f"chat.policy.{context}")
+    )
+    return (f"scale {policy.scale:.2f} (SLO p95 {config.CHAT_LATENCY_SLO_MS / 1000:g}s, "
+            f"{metrics.get('chat.policy.tightened')} tightenings); {contexts or 'no replies yet'}")
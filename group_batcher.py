@@ -0,0 +1,110 @@
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import deadline
+import metrics
+import outbound
+
+class _Group:
+    __slots__ = ("pending", "running", "timer")
+
+    def __init__(self):
+        self.pending = []
+        self.running = 0
+        self.timer = None  # monotonic time of the scheduled flush
+
+class MentionBatcher:
+    """
+    Debounces bot mentions per group chat. Answers run on a pool of
+    GROUP_BATCH_WORKERS threads so handler threads stay free, each with a
+    fresh REQUEST_DEADLINE from when it starts and an outbound scope like a
+    handler's. A mention waits GROUP_DEBOUNCE_WINDOW; mentions that arrive
+    meanwhile, or while the group already has GROUP_MAX_CONCURRENT_GENERATIONS
+    answers in progress, are merged and handed to handler(messages) as one
+    batch (at most GROUP_MAX_BATCH) once a generation slot frees up.
+    """
+
+    def __init__(self, handler, bot=None):
+        self.handler = handler
+        self.bot = bot  # sends notices left over when a batch ends
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=config.GROUP_BATCH_WORKERS, thread_name_prefix="group")
+        self._due = []  # (monotonic time, chat_id) of scheduled flushes
+        self._due_changed = threading.Condition(self._lock)
+        threading.Thread(target=self._scheduler, name="group-scheduler", daemon=True).start()
+
+    def submit(self, message):
+        metrics.incr("group.mentions")
+        chat_id = message.chat.id
+        with self._lock:
+            group = self._groups.setdefault(chat_id, _Group())
+            group.pending.append(message)
+            self._schedule(chat_id, group, config.GROUP_DEBOUNCE_WINDOW)
+
+    def _schedule(self, chat_id, group, delay):
+        """Flush the group's pending mentions after delay (called with the lock held)"""
+        if group.timer is None:
+            group.timer = time.monotonic() + delay
+            heapq.heappush(self._due, (group.timer, chat_id))
+            self._due_changed.notify()
+
+    def _scheduler(self):
+        """One thread hands due flushes to the pool, instead of a timer thread per group"""
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._due and self._due[0][0] <= now:
+                    _, chat_id = heapq.heappop(self._due)
+                    self._pool.submit(self._flush, chat_id)
+                self._due_changed.wait(self._due[0][0] - now if self._due else None)
+
+    def _flush(self, chat_id):
+        with self._lock:
+            group = self._groups.get(chat_id)
+            if group is None:
+                return
+            group.timer = None
+            if not group.pending or group.running >= config.GROUP_MAX_CONCURRENT_GENERATIONS:
+                return  # the answer in progress flushes the batch when it finishes
+            batch = group.pending[:config.GROUP_MAX_BATCH]
+            group.pending = group.pending[config.GROUP_MAX_BATCH:]
+            group.running += 1
+        self._run(chat_id, batch)
+
+    def _run(self, chat_id, batch):
+        # Leftover notices are sent as a reply to the last mention, which the answer replies to
+        request = outbound.Outbound("update", self.bot, batch[-1])
+        with deadline.scope(deadline.Deadline(config.REQUEST_DEADLINE)), outbound.scope(request):
+            self._answer(chat_id, batch)
+
+    def _answer(self, chat_id, batch):
+        metrics.incr("group.completions")
+        if len(batch) > 1:
+            metrics.incr("group.batches")
+            metrics.incr("group.batched_mentions", len(batch))
+            metrics.observe("group.batch_size", len(batch))
+        try:
+            self.handler(batch)
+        except Exception as e:
+            print(f"[DEBUG] Group {chat_id} mention batch failed: {e}")
+        finally:
+            with self._lock:
+                group = self._groups[chat_id]
+                group.running -= 1
+                if group.pending:
+                    self._schedule(chat_id, group, 0)
+                elif not group.running and group.timer is None:
+                    del self._groups[chat_id]
+
+def batching_report():
+    """One-line summary for /debug"""
+    mentions = metrics.get("group.mentions")
+    completions = metrics.get("group.completions")
+    sizes = metrics.window_stats("group.batch_size")
+    return (f"{mentions} mentions answered in {completions} completions "
+            f"({metrics.get('group.batches')} batches, p95 size {sizes['p95']}); "
+            f"saved {max(0, mentions - completions)} upstream calls and replies")
@@ -0,0 +1,199 @@
+import json
+import os
+import threading
+import time
+
+import requests
+from telebot import apihelper
+
+import config
+import metrics
+from utils import atomic_write_json
+
+class HealthProber:
+    """
+    Background thread that probes Telegram (getMe) and the chat and TTS
+    upstreams (GET /models; only a model list counts as up) into rolling
+    metrics windows, so /ping and /debug read cached results instead of
+    making network calls. Image providers have no cheap endpoint, so their
+    health comes from live requests instead. The probe interval doubles
+    while the bot sees no traffic, up to HEALTH_PROBE_MAX_INTERVAL.
+
+    Under supervisor.py only one process probes and publishes its results to
+    a snapshot file; the other workers follow() it instead of probing.
+    """
+
+    def __init__(self):
+        self.targets = {}  # name -> probe callable; raises or returns False when down
+        self.last_activity = time.monotonic()
+        self.interval = config.HEALTH_PROBE_INTERVAL
+        self.last_probe = {}  # name -> (monotonic time, ok)
+        self.passive = set()  # targets judged from live traffic, not probed
+        self._wake = threading.Event()
+        self._session = requests.Session()
+        self._thread = None
+        self.publish_to = None  # snapshot file written after each round (probing process)
+        self.follow_from = None  # snapshot file read instead of probing (other workers)
+        self._snapshot = {}
+        self._snapshot_mtime = None
+        self._activity_signalled = 0.0
+
+    def add(self, name, probe):
+        self.targets[name] = probe
+
+    def add_models(self, name, base_url):
+        """
+        Probe an OpenAI-compatible upstream with GET {base_url}/models. Only a
+        2xx model list counts as up: a 401/403/404 means real requests fail too.
+        """
+        url = base_url.rstrip("/") + "/models"
+
+        def probe():
+            resp = self._session.get(url, timeout=config.HEALTH_PROBE_TIMEOUT, allow_redirects=False)
+            try:
+                if not 200 <= resp.status_code < 300:
+                    print(f"[DEBUG] Health probe {name}: HTTP {resp.status_code}")
+                    return False
+                return isinstance(resp.json().get("data"), list)
+            finally:
+                resp.close()
+        self.add(name, probe)
+
+    def add_passive(self, name, check):
+        """A target whose health check() reads from live traffic (no request is sent)"""
+        self.passive.add(name)
+        self.add(name, check)
+
+    def touch(self):
+        """Note user traffic: probing goes back to its normal pace"""
+        self.last_activity = time.monotonic()
+        if self.follow_from:
+            # Tell the probing process, at most once per probe interval
+            if self.last_activity - self._activity_signalled > config.HEALTH_PROBE_INTERVAL:
+                self._activity_signalled = self.last_activity
+                try:
+                    with open(self._activity_path(self.follow_from), "a"):
+                        pass
+                    os.utime(self._activity_path(self.follow_from))
+                except OSError as e:
+                    print(f"[DEBUG] Health activity signal failed: {e}")
+        elif self.interval > config.HEALTH_PROBE_INTERVAL:
+            self.interval = config.HEALTH_PROBE_INTERVAL
+            self._wake.set()
+
+    def start(self, publish_to=None):
+        """Probe in a background thread; with publish_to, also write each round's results there"""
+        self.publish_to = publish_to
+        if self._thread is None and config.HEALTH_PROBE_ENABLED:
+            self._thread = threading.Thread(target=self._loop, name="health-prober", daemon=True)
+            self._thread.start()
+
+    def follow(self, path):
+        """Serve the results another process publishes to path instead of probing"""
+        self.follow_from = path
+
+    @staticmethod
+    def _activity_path(path):
+        return f"{path}.active"
+
+    def probe_all(self):
+        for name, probe in list(self.targets.items()):
+            t0 = time.perf_counter()
+            try:
+                ok = bool(probe())
+            except Exception as e:
+                print(f"[DEBUG] Health probe {name} failed: {e}")
+                ok = False
+            latency_ms = (time.perf_counter() - t0) * 1000.0
+            metrics.observe(f"health.up.{name}", 1 if ok else 0)
+            if ok and name not in self.passive:
+                metrics.observe(f"health.ms.{name}", latency_ms)
+            self.last_probe[name] = (time.monotonic(), ok)
+
+    def _idle(self):
+        if time.monotonic() - self.last_activity <= config.HEALTH_IDLE_AFTER:
+            return False
+        if self.publish_to:
+            # Traffic seen by the workers that follow this process
+            try:
+                return time.time() - os.path.getmtime(self._activity_path(self.publish_to)) > config.HEALTH_IDLE_AFTER
+            except OSError:
+                pass
+        return True
+
+    def _publish(self):
+        snapshot = {"interval": self.interval, "targets": {name: self.stats(name) for name in self.targets}}
+        try:
+            atomic_write_json(self.publish_to, snapshot)
+        except OSError as e:
+            print(f"[DEBUG] Health snapshot write failed: {e}")
+
+    def _loop(self):
+        while True:
+            self.probe_all()
+            if self._idle():
+                self.interval = min(config.HEALTH_PROBE_MAX_INTERVAL, self.interval * 2)
+            else:
+                self.interval = config.HEALTH_PROBE_INTERVAL
+            if self.publish_to:
+                self._publish()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _followed(self):
+        """Latest snapshot of the probing process (re-read when the file changes)"""
+        try:
+            mtime = os.path.getmtime(self.follow_from)
+            if mtime != self._snapshot_mtime:
+                with open(self.follow_from, encoding="utf-8") as f:
+                    self._snapshot = json.load(f)
+                self._snapshot_mtime = mtime
+        except (OSError, ValueError) as e:
+            print(f"[DEBUG] Health snapshot read failed: {e}")
+        return self._snapshot
+
+    def probe_interval(self):
+        if self.follow_from:
+            return self._followed().get("interval", self.interval)
+        return self.interval
+
+    def stats(self, name):
+        """Rolling {p50, p95, error_rate, samples, ok} of one target (None before its first probe)"""
+        if self.follow_from:
+            return self._followed().get("targets", {}).get(name)
+        if name not in self.last_probe:
+            return None
+        up = metrics.window_stats(f"health.up.{name}")
+        latency = metrics.window_stats(f"health.ms.{name}")
+        return {"p50": latency["p50"], "p95": latency["p95"], "error_rate": 100.0 * (1 - up["mean"]),
+                "samples": up["count"], "ok": self.last_probe[name][1]}
+
+    def healthy(self, name):
+        stats = self.stats(name)
+        return stats is not None and stats["ok"] and stats["error_rate"] <= config.HEALTH_MAX_ERROR_RATE
+
+    def describe(self, name):
+        stats = self.stats(name)
+        if stats is None:
+            return f"{name}: not probed yet"
+        state = "up" if stats["ok"] else "DOWN"
+        if name in self.passive:
+            return f"{name}: {state} (live traffic), {stats['error_rate']:.0f}% of checks failing"
+        return (f"{name}: {state}, p50 {stats['p50']:.0f} ms / p95 {stats['p95']:.0f} ms, "
+                f"{stats['error_rate']:.0f}% errors")
+
+prober = HealthProber()
+
+def register_default_targets(endpoints, image_providers, tts_base):
+    """Telegram plus every configured chat endpoint, image provider and the TTS API"""
+    prober.add("telegram", lambda: apihelper.get_me(config.BOT_TOKEN) is not None)
+    for endpoint in endpoints:
+        prober.add_models(f"chat {endpoint.name}", endpoint.url.rsplit("/chat/completions", 1)[0])
+    for provider in image_providers:
+        # A request to the image API generates an image: use the success rate of real ones
+        prober.add_passive(f"image {provider.name}", lambda provider=provider: provider.health >= config.HEALTH_MIN_IMAGE_SCORE)
+    prober.add_models("tts", tts_base)
+
+def health_report():
+    """One-line summary for /debug"""
+    return f"every {prober.probe_interval()}s; " + "; ".join(prober.describe(name) for name in prober.targets)
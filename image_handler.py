@@ -1,8 +1,20 @@
-import io
 import re
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
 import requests
+from telebot import types
 import config
+import deadline
+import metrics
+import outbound
+import retry
+from limiter import limiter, UpstreamOverloaded
+from media import read_media, download_report, prepare_image, rewind, release, IMAGE_TYPES
 from utils import AnimatedLoader
+from job_queue import jobs
 
 # ---------- MarkdownV2 escaping ----------
 # Per Telegram MarkdownV2 rules, escape: _ * [ ] ( ) ~ ` > # + - = | { } . !
@@ -20,11 +32,191 @@ def truncate(text: str, limit: int = 1024) -> str:
         return ""
     return text if len(text) <= limit else text[: limit - 3] + "..."
 
+# ---------- Providers ----------
+class ImageProvider:
+    """One image upstream with its learned HTTP method and rolling health"""
+
+    def __init__(self, url):
+        self.url = url
+        self.preferred_method = None  # learned: "GET" or "POST"
+        self.health = 1.0  # EWMA of attempt success
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return urlparse(self.url).netloc or self.url
+
+    def methods(self):
+        """Methods to try, learned preference first"""
+        first = self.preferred_method or "GET"
+        return [first, "POST" if first == "GET" else "GET"]
+
+    def record(self, method, ok, latency_ms):
+        with self._lock:
+            self.health = 0.8 * self.health + 0.2 * (1.0 if ok else 0.0)
+            if ok:
+                self.preferred_method = method
+        if ok:
+            metrics.observe(f"image.latency_ms.{self.name}", latency_ms)
+            metrics.observe("image.latency_ms", latency_ms)
+
+def _configured_urls():
+    urls = config.IMAGE_API_URL
+    return [urls] if isinstance(urls, str) else list(urls)
+
+image_providers = [ImageProvider(url) for url in _configured_urls()]
+_image_pool = ThreadPoolExecutor(max_workers=config.IMAGE_POOL_SIZE, thread_name_prefix="image")
+
+def _plan_attempts():
+    """Ordered (provider, method) attempts; the second entry is the hedge target"""
+    providers = list(image_providers)
+    primary = random.choices(providers, weights=[max(0.05, p.health) for p in providers])[0]
+    others = sorted((p for p in providers if p is not primary), key=lambda p: p.health, reverse=True)
+    first, second = primary.methods()
+    if primary.preferred_method is None:
+        # Method not learned yet: race GET and POST instead of paying a full timeout on the wrong one
+        plan = [(primary, first), (primary, second)]
+    else:
+        # Known method: hedge on the healthiest other provider, or duplicate the primary
+        hedge = (others[0], others[0].methods()[0]) if others else (primary, first)
+        plan = [(primary, first), hedge]
+    for attempt in [(primary, second)] + [(p, m) for p in others for m in p.methods()]:
+        if attempt not in plan:
+            plan.append(attempt)
+    return plan
+
+def _hedge_delay():
+    """Seconds to wait before sending a hedged duplicate, from observed latency"""
+    if metrics.window_stats("image.latency_ms")["count"] < config.IMAGE_HEDGE_MIN_SAMPLES:
+        return config.IMAGE_HEDGE_DEFAULT_DELAY
+    p = metrics.percentile("image.latency_ms", config.IMAGE_HEDGE_PERCENTILE)
+    return max(config.IMAGE_HEDGE_MIN_DELAY, p / 1000.0)
+
+def _attempt(provider, method, params, queue_timeout=None):
+    """Single request to one provider; returns image bytes, None for a bad answer,
+    or raises the transient error (timeout, connection, 429/5xx, shedding).
+    queue_timeout=0 gives up at once when the provider is at its concurrency limit."""
+    t0 = time.perf_counter()
+    ok = False
+    permit = None  # limiter slot of the current try, held until the body is read
+    shed = False
+
+    def send():
+        nonlocal t0, permit
+        permit = limiter(provider.name).hold(queue_timeout)
+        t0 = time.perf_counter()
+        timeout = deadline.timeouts(provider.name, config.UPSTREAM_CONNECT_TIMEOUT, config.IMAGE_REQUEST_TIMEOUT)
+        try:
+            if method == "GET":
+                resp = requests.get(provider.url, params=params, timeout=timeout, stream=True)
+            else:
+                resp = requests.post(
+                    provider.url,
+                    json=params,
+                    headers={"Content-Type": "application/json"},
+                    timeout=timeout,
+                    stream=True,
+                )
+            resp = retry.raise_for_retryable(resp)
+        except Exception:
+            permit.release(False)
+            raise
+        if resp.status_code != 200:
+            permit.release(None)  # e.g. the wrong method: says nothing about load
+        return resp
+
+    try:
+        resp = retry.call(provider.name, send, idempotent=method == "GET")
+        ttfb_ms = (time.perf_counter() - t0) * 1000.0
+        if resp.status_code != 200:
+            resp.close()
+            return None
+        body, _ = read_media(resp, provider.name, IMAGE_TYPES, config.IMAGE_MAX_BYTES, spool=True)
+        ok = body is not None
+        permit.release(ok)
+        deadline.observe(provider.name, ttfb_ms=ttfb_ms, total_ms=(time.perf_counter() - t0) * 1000.0)
+        return body
+    except requests.exceptions.Timeout:
+        print(f"[DEBUG] Image {method} timeout at {provider.name}")
+        if deadline.expired():
+            metrics.incr("deadline.expired.ttfb")
+        raise
+    except requests.exceptions.ConnectionError:
+        print(f"[DEBUG] Image {method} connection error at {provider.name}")
+        raise
+    except requests.exceptions.HTTPError as e:
+        print(f"[DEBUG] Image {method} failed at {provider.name}: {e}")
+        raise
+    except UpstreamOverloaded as e:
+        print(f"[DEBUG] Image {method} shed: {e}")
+        shed = permit is None  # shed locally before any request reached the provider
+        raise
+    finally:
+        if permit is not None:
+            permit.release(False)  # the body read failed; no-op once released
+        if not shed:
+            provider.record(method, ok, (time.perf_counter() - t0) * 1000.0)
+
+def _release_result(future):
+    """Drop the spooled body of an attempt that lost the race"""
+    if not future.cancelled() and future.exception() is None:
+        release(future.result())
+
+def _record_hedge_savings(win_time):
+    """Callback for the losing primary: how much later it finished than the hedge"""
+    def _done(_future):
+        metrics.observe("image.hedge_saved_ms", (time.perf_counter() - win_time) * 1000.0)
+    return _done
+
+def _fetch_hedged(params, raise_transient=False):
+    """Run the attempt plan; after the hedge delay a duplicate races the primary.
+    When every attempt fails, raise_transient=True raises the last transient error."""
+    plan = iter(_plan_attempts())
+    failure = None
+    attempt = deadline.bind(_attempt)
+    primary = _image_pool.submit(attempt, *next(plan), params)
+    pending = {primary}
+    hedged = not config.IMAGE_HEDGE_ENABLED
+    hedge_at = time.perf_counter() + _hedge_delay()
+    while pending:
+        timeout = None if hedged else max(0.0, hedge_at - time.perf_counter())
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            # Primary is slower than the learned p95: send the hedge
+            nxt = next(plan, None) if not deadline.expired() else None
+            hedged = True
+            if nxt:
+                # A hedge only helps when the provider has spare capacity: never queue for it
+                metrics.incr("image.hedges")
+                pending.add(_image_pool.submit(attempt, *nxt, params, 0))
+            continue
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                result, failure = None, e
+            if result:
+                if future is not primary and primary in pending:
+                    metrics.incr("image.hedge_wins")
+                    primary.add_done_callback(_record_hedge_savings(time.perf_counter()))
+                for loser in pending:
+                    loser.add_done_callback(_release_result)
+                return result
+        if not pending:
+            # Attempt failed outright: fall back to the next planned attempt immediately
+            nxt = next(plan, None) if not deadline.expired() else None
+            if nxt:
+                pending.add(_image_pool.submit(attempt, *nxt, params))
+    if raise_transient and failure is not None:
+        raise failure
+    return None
+
 # ---------- API call ----------
-def generate_image(full_prompt: str, bot=None, chat_id=None):
+def generate_image(full_prompt: str, bot=None, chat_id=None, seed=None, raise_transient=False):
     """
     Always send the FULL prompt to the API.
-    Returns image bytes or None.
+    Returns the image as a spooled file (relayed to Telegram as-is) or None.
+    raise_transient=True raises timeouts, 429/5xx and shedding instead of returning None.
     """
     loader = None
     try:
@@ -33,141 +225,251 @@ def generate_image(full_prompt: str, bot=None, chat_id=None):
             loader.start()
 
         params = {"prompt": full_prompt, "render": "true"}
-
-        # Try GET
-        resp = requests.get(config.IMAGE_API_URL, params=params, timeout=120)
-        if _looks_like_image(resp):
-            return resp.content
-
-        # Fallback to POST JSON
-        resp = requests.post(
-            config.IMAGE_API_URL,
-            json=params,
-            headers={"Content-Type": "application/json"},
-            timeout=120,
-        )
-        if _looks_like_image(resp):
-            return resp.content
-
-        return None
-    except requests.exceptions.Timeout:
-        print("[DEBUG] Image generation timeout")
-        return None
-    except requests.exceptions.ConnectionError:
-        print("[DEBUG] Image generation connection error")
-        return None
+        if seed is not None:
+            params["seed"] = str(seed)
+        metrics.incr("image.requests")
+        return _fetch_hedged(params, raise_transient)
     except Exception as e:
         print(f"[DEBUG] Image generation error: {e}")
+        if raise_transient and retry.transient(e):
+            raise
         return None
     finally:
         if loader:
             loader.stop()
 
-def _looks_like_image(resp: requests.Response) -> bool:
-    if not resp or resp.status_code != 200:
-        return False
-    ctype = (resp.headers.get("Content-Type") or "").lower()
-    if ctype.startswith("image/"):
-        return True
-    # Accept large binary that is not JSON
-    return len(resp.content or b"") > 1000 and not ctype.startswith("application/json")
+def generate_image_batch(full_prompt: str, count: int, bot=None, chat_id=None, raise_transient=False):
+    """Generate count variations concurrently; returns a list with None for failed ones.
+    raise_transient=True raises a transient error instead when every variation failed."""
+    loader = None
+    try:
+        if bot and chat_id:
+            loader = AnimatedLoader(bot, chat_id, "Creating your masterpieces", "image")
+            loader.start()
+        seeds = random.sample(range(1, 2 ** 31), count)
+        workers = max(1, min(count, config.IMAGE_BATCH_FANOUT))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-batch") as pool:
+            futures = [pool.submit(deadline.bind(generate_image), full_prompt, seed=seed, raise_transient=raise_transient)
+                       for seed in seeds]
+        images, failures = [], []
+        for future in futures:
+            try:
+                images.append(future.result())
+            except Exception as e:
+                images.append(None)
+                failures.append(e)
+        if failures and not any(images):
+            raise failures[0]
+        return images
+    finally:
+        if loader:
+            loader.stop()
+
+def image_report():
+    """One-line hedging summary for /debug"""
+    saved = metrics.window_stats("image.hedge_saved_ms")
+    learned = ", ".join(f"{p.name}={p.preferred_method or '?'}@{p.health:.2f} ({download_report(p.name)})" for p in image_providers)
+    return (f"hedge rate {metrics.ratio('image.hedges', 'image.requests'):.1f}%, "
+            f"{metrics.get('image.hedge_wins')} wins, saved p50 {saved['p50'] / 1000:.1f}s; {learned}")
 
 # ---------- Telegram send helpers ----------
-def safe_send_photo(bot, chat_id, image_bytes: bytes, caption: str, reply_to=None):
+def _doc_name(info):
+    return "brahmos." + {"image/jpeg": "jpg", "image/webp": "webp"}.get(info["type"], "png")
+
+def safe_send_photo(bot, chat_id, image, caption: str, reply_to=None):
+    """Prepare an image (bytes or spooled file) and send it as a photo, or as a document when too large.
+    Returns True once the image is delivered."""
+    payload, as_document, info = prepare_image(image)
+
+    def send(text, parse_mode):
+        if as_document:
+            bot.send_document(chat_id, rewind(payload), caption=text, parse_mode=parse_mode,
+                              reply_to_message_id=reply_to, visible_file_name=_doc_name(info))
+        else:
+            bot.send_photo(chat_id, rewind(payload), caption=text, parse_mode=parse_mode, reply_to_message_id=reply_to)
+
+    t0 = time.perf_counter()
     try:
-        bot.send_photo(
-            chat_id,
-            io.BytesIO(image_bytes),
-            caption=caption,
-            parse_mode="MarkdownV2",
-            reply_to_message_id=reply_to,
-        )
+        send(caption, "MarkdownV2")
+        return True
     except Exception as e:
         print(f"[DEBUG] Failed to send photo: {e}")
         # Fallback: send without parse_mode
         try:
-            bot.send_photo(
-                chat_id,
-                io.BytesIO(image_bytes),
-                caption=caption.replace("\\", ""),  # loosen escaping on fallback
-                reply_to_message_id=reply_to,
-            )
+            send(caption.replace("\\", ""), None)  # loosen escaping on fallback
+            return True
         except Exception as e2:
             print(f"[DEBUG] Fallback photo send failed: {e2}")
             bot.send_message(chat_id, f"❌ Failed to send image\nError: {e2}")
+            return False
+    finally:
+        metrics.observe(f"image.upload_ms.{'optimized' if info['optimized'] else 'raw'}", (time.perf_counter() - t0) * 1000.0)
+
+def safe_send_media_group(bot, chat_id, images, caption: str, reply_to=None):
+    """Deliver several images in one sendMediaGroup call, caption on the first item.
+    Returns True once the group is delivered."""
+    prepared = [prepare_image(img) for img in images]
+    # A media group cannot mix photos and documents
+    as_document = any(doc for _, doc, _ in prepared)
+    media_cls = types.InputMediaDocument if as_document else types.InputMediaPhoto
+
+    def build(parse_mode, text):
+        return [
+            media_cls(rewind(payload), caption=text if i == 0 else None, parse_mode=parse_mode if i == 0 else None)
+            for i, (payload, _, _) in enumerate(prepared)
+        ]
+    t0 = time.perf_counter()
+    try:
+        bot.send_media_group(chat_id, build("MarkdownV2", caption), reply_to_message_id=reply_to)
+        return True
+    except Exception as e:
+        print(f"[DEBUG] Failed to send media group: {e}")
+        try:
+            bot.send_media_group(chat_id, build(None, caption.replace("\\", "")), reply_to_message_id=reply_to)
+            return True
+        except Exception as e2:
+            print(f"[DEBUG] Fallback media group send failed: {e2}")
+            bot.send_message(chat_id, f"❌ Failed to send images\nError: {e2}")
+            return False
+    finally:
+        optimized = any(info["optimized"] for _, _, info in prepared)
+        metrics.observe(f"image.upload_ms.{'optimized' if optimized else 'raw'}", (time.perf_counter() - t0) * 1000.0)
+
+_COUNT_TOKEN = re.compile(r"[xX×]([0-9]{1,2})")
+
+def parse_image_count(prompt: str):
+    """
+    Split an explicit variation count off a prompt: 'x4 cyberpunk samurai' ->
+    (4, 'cyberpunk samurai'). Plain numbers stay in the prompt ('12 angry men').
+    """
+    first, _, rest = prompt.partition(" ")
+    match = _COUNT_TOKEN.fullmatch(first)
+    if match and rest.strip():
+        return int(match.group(1)), rest.strip()
+    return 1, prompt
 
 # ---------- Handlers ----------
+IMAGE_LIMIT_TEXT = "🚫 Daily Image Limit Reached\n\nUpgrade to Premium for unlimited generations.\nContact @Rystrix to upgrade!"
+
+def _reserve_images(bot, message, usage_tracker, count):
+    """Reserve quota for count images before any upstream work; replies and returns None if short"""
+    reservation = usage_tracker.reserve(message.from_user.id, "image", count)
+    if reservation is None:
+        remaining = usage_tracker.get_remaining_images(message.from_user.id)
+        if remaining and count > 1:
+            bot.reply_to(message, f"🚫 Only {remaining} image generations left today, not enough for {count} variations.", parse_mode="Markdown")
+        else:
+            bot.reply_to(message, IMAGE_LIMIT_TEXT, parse_mode="Markdown")
+    return reservation
+
+def _generate_and_deliver(bot, message, full_prompt, count, reservation, usage_tracker, final=True):
+    """Generate count images, deliver them, and settle the quota reservation.
+    Unless this is the final attempt, transient upstream errors are raised for the job queue to retry."""
+    with reservation:
+        # The loader is ours, not generate_image's: on failure it turns into the error message
+        loader = AnimatedLoader(bot, message.chat.id, "Creating your masterpiece", "image")
+        loader.start()
+        try:
+            if count == 1:
+                images = [generate_image(full_prompt, raise_transient=not final)]
+            else:
+                images = generate_image_batch(full_prompt, count, raise_transient=not final)
+        except Exception:
+            loader.stop()
+            raise
+        images = [img for img in images if img]
+        if not images:
+            failure = outbound.merge("❌ Image Generation Failed\nPlease try a different prompt.", config.MAX_MESSAGE_LENGTH)
+            if not loader.stop(final_message=failure, parse_mode="Markdown"):
+                bot.reply_to(message, failure, parse_mode="Markdown")
+            return
+        loader.stop()
+
+        shown = truncate(full_prompt, 900)  # leave headroom for the rest of caption after escaping
+        safe_shown = escape_markdown_v2(shown)
+
+        if not reservation.unlimited:
+            # Reserved units already count as used; hand back the ones that failed
+            remaining = usage_tracker.get_remaining_images(message.from_user.id) + count - len(images)
+            tail = f"\n\n📊 Remaining today: {remaining}/100"
+        else:
+            tail = "\n\n💎 Premium User - Unlimited Access!"
+        if count > 1:
+            cost = "" if reservation.unlimited else f" ({len(images)} image credits)"
+            tail = f"\n🖼️ Variations: {len(images)}/{count}{cost}" + tail
+
+        title = "Generated Images" if len(images) > 1 else "Generated Image"
+        cap = f"🎨 *{title}*\n\n📝 *Prompt:* `{safe_shown}`\n\n✨ *Created by BrahMos AI*{escape_markdown_v2(tail)}"
+        cap = outbound.merge(cap, config.MAX_CAPTION_LENGTH, render=escape_markdown_v2)
+        try:
+            if len(images) > 1:
+                delivered = safe_send_media_group(bot, message.chat.id, images, cap, reply_to=message.message_id)
+            else:
+                delivered = safe_send_photo(bot, message.chat.id, images[0], cap, reply_to=message.message_id)
+        finally:
+            for img in images:
+                release(img)
+        # Commit only what reached the user; failed variations are refunded
+        if delivered:
+            reservation.commit(len(images))
+
+def run_image_job(bot, payload, reservation, usage_tracker):
+    """Job runner: generate and deliver a queued image request"""
+    message = types.Message.de_json(payload["message"])
+    if reservation is None:
+        bot.reply_to(message, IMAGE_LIMIT_TEXT, parse_mode="Markdown")
+        return
+    _generate_and_deliver(bot, message, payload["prompt"], payload["count"], reservation, usage_tracker,
+                          final=payload.get("final_attempt", True))
+
+jobs.register("image", run_image_job)
+
 def handle_image_command(bot, message, user_waiting_for_image, usage_tracker):
-    from utils import log_user_interaction, is_premium_user
+    from utils import log_user_interaction
 
-    user_id = message.from_user.id
     log_user_interaction(message.from_user, "/image", "DM" if message.chat.type == "private" else "Group")
 
     text = (message.text or "").strip()
     if len(text.split()) <= 1:
         bot.reply_to(
             message,
-            "🎨 Image Generation Help\n\nUsage: `/image [description]`\n\nExamples:\n• `/image cyberpunk samurai warrior`\n• `/image sunset over mountains`\n• `/image cute cat in space suit`\n\nTip: Be descriptive for better results!",
+            f"🎨 Image Generation Help\n\nUsage: `/image [xN] [description]`\n\nExamples:\n• `/image cyberpunk samurai warrior`\n• `/image sunset over mountains`\n• `/image x4 cute cat in space suit` (up to {config.IMAGE_MAX_BATCH} variations, one credit each)\n\nTip: Be descriptive for better results!",
             parse_mode="Markdown",
         )
         return
 
     full_prompt = text[6:].strip()  # FULL prompt goes to API
-
-    # Usage gates
-    if not is_premium_user(user_id):
-        if not usage_tracker.can_use_image(user_id):
-            bot.reply_to(
-                message,
-                "🚫 Daily Image Limit Reached\n\nUpgrade to Premium for unlimited generations.\nContact @Rystrix to upgrade!",
-                parse_mode="Markdown",
-            )
-            return
-        remaining = usage_tracker.get_remaining_images(user_id)
-        if remaining <= 10:
-            bot.reply_to(message, f"⚠️ Only {remaining} image generations left today!", parse_mode="Markdown")
-
-    img = generate_image(full_prompt, bot, message.chat.id)
-    if not img:
-        bot.reply_to(message, "❌ Image Generation Failed\nPlease try a different prompt.", parse_mode="Markdown")
+    count, full_prompt = parse_image_count(full_prompt)
+    if not 1 <= count <= config.IMAGE_MAX_BATCH:
+        bot.reply_to(message, f"❌ You can request x1 to x{config.IMAGE_MAX_BATCH} variations at once.", parse_mode="Markdown")
         return
 
-    shown = truncate(full_prompt, 900)  # leave headroom for the rest of caption after escaping
-    safe_shown = escape_markdown_v2(shown)
-
-    if not is_premium_user(user_id):
-        usage_tracker.use_image(user_id)
-        remaining = usage_tracker.get_remaining_images(user_id)
-        tail = f"\n\n📊 Remaining today: {remaining}/100"
-    else:
-        tail = "\n\n💎 Premium User - Unlimited Access!"
+    # Usage gates: quota is reserved before generation, committed on delivery
+    reservation = _reserve_images(bot, message, usage_tracker, count)
+    if reservation is None:
+        return
+    if not reservation.unlimited:
+        remaining = usage_tracker.get_remaining_images(message.from_user.id)
+        if remaining <= 10:
+            warning = f"⚠️ Only {remaining} image generations left today!"
+            if not outbound.notice(warning):  # rides along with the image when possible
+                bot.reply_to(message, warning, parse_mode="Markdown")
 
-    cap = f"🎨 *Generated Image*\n\n📝 *Prompt:* `{safe_shown}`\n\n✨ *Created by BrahMos AI*{escape_markdown_v2(tail)}"
-    safe_send_photo(bot, message.chat.id, img, cap, reply_to=message.message_id)
+    jobs.submit("image", message, {"prompt": full_prompt, "count": count}, reservation)
 
 def handle_image_input(bot, message, user_waiting_for_image, usage_tracker):
-    from utils import is_premium_user
-
     uid = message.from_user.id
     if uid not in user_waiting_for_image:
         return
-    user_waiting_for_image.discard(uid)
 
     full_prompt = (message.text or "").strip()
-    img = generate_image(full_prompt, bot, message.chat.id)
-    if not img:
-        bot.send_message(message.chat.id, "❌ Image Generation Failed\nPlease try a different prompt.", parse_mode="Markdown")
+    if not full_prompt:
+        # Stickers, photos or blank text: nothing to draw, keep waiting for a description
+        bot.reply_to(message, "✍️ Please describe the image you want in a text message.")
         return
+    user_waiting_for_image.discard(uid)
 
-    shown = truncate(full_prompt, 900)
-    safe_shown = escape_markdown_v2(shown)
-
-    if not is_premium_user(uid):
-        usage_tracker.use_image(uid)
-        remaining = usage_tracker.get_remaining_images(uid)
-        tail = f"\n\n📊 Remaining today: {remaining}/100"
-    else:
-        tail = "\n\n💎 Premium User - Unlimited Access!"
-
-    cap = f"🎨 *Generated Image*\n\n📝 *Prompt:* `{safe_shown}`\n\n✨ *Created by BrahMos AI*{escape_markdown_v2(tail)}"
-    safe_send_photo(bot, message.chat.id, img, cap, reply_to=message.message_id)
+    reservation = _reserve_images(bot, message, usage_tracker, 1)
+    if reservation is None:
+        return
+    jobs.submit("image", message, {"prompt": full_prompt, "count": 1}, reservation)
@@ -0,0 +1,262 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from telebot import types
+
+import config
+import deadline
+import metrics
+import outbound
+
+class JobQueue:
+    """
+    Durable queue for image and TTS generation. Handlers submit() a job and
+    return; worker threads claim jobs under a lease, so a job held by a
+    crashed or restarted process runs again once its lease expires
+    (at-least-once). The idempotency key of each job (kind:chat:message)
+    turns a redelivered update into a no-op. The database is opened (and
+    created) on first use, not when the module is imported.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        held INTEGER NOT NULL DEFAULT 0,
+        run_after REAL NOT NULL,
+        lease_owner TEXT,
+        lease_until REAL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        last_error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs(status, run_after);
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        self._runners = {}
+        self._reservations = {}  # job id -> QuotaReservation taken by the submitting handler
+        self._reservations_lock = threading.Lock()
+        self._work_ready = threading.Condition()
+        self._last_prune = 0.0
+        self.bot = None
+        self.usage_tracker = None
+        self._schema_ready = False
+
+    def _db(self):
+        """Per-thread (and per-process) connection; the first one creates the schema"""
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path or config.JOB_QUEUE_DB, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                db.executescript(self.SCHEMA)
+                self._schema_ready = True
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def register(self, kind, runner):
+        """runner(bot, payload, reservation, usage_tracker) runs one job; raising schedules a retry.
+        payload["final_attempt"] tells the runner to report failures itself instead."""
+        self._runners[kind] = runner
+
+    def start(self, bot, usage_tracker, workers=True):
+        """Start the generation workers (jobs left by a previous run are picked up too).
+        With workers=False, submit() only queues jobs for another process's workers."""
+        self.bot = bot
+        self.usage_tracker = usage_tracker
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        if not workers:
+            return
+        self._reclaim_orphans()
+        for i in range(config.JOB_WORKERS):
+            threading.Thread(target=self._work_loop, name=f"job-worker-{i}", daemon=True).start()
+
+    def submit(self, kind, message, payload, reservation):
+        """Queue a job for message; returns False (and releases the reservation) for a duplicate"""
+        # Notices held by the handler travel with the job and join its final message
+        held_notices = outbound.current().take_notices() if outbound.current() else []
+        payload = dict(payload, message=message.json, notices=held_notices,
+                       quota=[reservation.user_id, reservation.kind, reservation.count])
+        if not config.JOB_QUEUE_ENABLED or self.bot is None:
+            with outbound.scope(outbound.Outbound(kind, self.bot, message, held_notices)):
+                self._runners[kind](self.bot, payload, reservation, self.usage_tracker)
+            return True
+        key = f"{kind}:{message.chat.id}:{message.message_id}"
+        held = reservation.count if reservation.tracker.shared and not reservation.unlimited else 0
+        now = time.time()
+        # Register the reservation first: a worker may claim the job as soon as it is inserted
+        with self._reservations_lock:
+            cursor = self._db().execute(
+                "INSERT OR IGNORE INTO jobs(idempotency_key, kind, payload, held, run_after, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, json.dumps(payload), held, now, now, now),
+            )
+            if cursor.rowcount != 1:
+                reservation.refund()
+                metrics.incr("jobs.duplicates")
+                return False
+            if not reservation.tracker.shared:
+                # Shared backends hold the units in the database, so any process can adopt them
+                self._reservations[cursor.lastrowid] = reservation
+        metrics.incr("jobs.submitted")
+        with self._work_ready:
+            self._work_ready.notify()
+        return True
+
+    # ---------- workers ----------
+    def _reclaim_orphans(self):
+        """Expire leases held by dead processes on this host so their jobs rerun now"""
+        host = socket.gethostname()
+        rows = self._db().execute("SELECT DISTINCT lease_owner FROM jobs WHERE status = 'running'").fetchall()
+        for (owner,) in rows:
+            owner_host, _, pid = (owner or "").rpartition(":")
+            if owner_host == host and pid.isdigit() and not _pid_alive(int(pid)):
+                self._db().execute("UPDATE jobs SET lease_until = 0 WHERE status = 'running' AND lease_owner = ?", (owner,))
+
+    def _claim(self):
+        now = time.time()
+        return self._db().execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, lease_until = ?, updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+            "            OR (status = 'running' AND lease_until < ?) ORDER BY id LIMIT 1) "
+            "RETURNING id, kind, payload, attempts, held, created_at",
+            (self.owner, now + config.JOB_LEASE_SECONDS, now, now, now),
+        ).fetchone()
+
+    def _work_loop(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"[DEBUG] Job claim error: {e}")
+                job = None
+            if job is None:
+                self._maybe_prune()
+                with self._work_ready:
+                    self._work_ready.wait(config.JOB_POLL_INTERVAL)
+                continue
+            self._run(*job)
+
+    def _take_reservation(self, job_id, held, quota):
+        """The submitting handler's reservation, or a fresh one for a recovered or retried job"""
+        with self._reservations_lock:
+            reservation = self._reservations.pop(job_id, None)
+        if reservation is not None:
+            return reservation
+        user_id, kind, count = quota
+        if held:
+            # Charged in the shared backend by a process that died mid-job
+            return self.usage_tracker.adopt(user_id, kind, held)
+        return self.usage_tracker.reserve(user_id, kind, count)
+
+    def _run(self, job_id, kind, payload, attempts, held, created_at):
+        payload = json.loads(payload)
+        payload["final_attempt"] = attempts >= config.JOB_MAX_ATTEMPTS
+        if attempts == 1:
+            metrics.observe("jobs.wait_ms", (time.time() - created_at) * 1000)
+        else:
+            metrics.incr("jobs.retried")
+        started = time.perf_counter()
+        try:
+            reservation = self._take_reservation(job_id, held, payload["quota"])
+            if attempts > config.JOB_MAX_ATTEMPTS:
+                # Lease expired on the last attempt (the process died): give the quota back
+                if reservation is not None:
+                    reservation.refund()
+                raise RuntimeError(f"gave up after {attempts - 1} attempts")
+            job_outbound = outbound.Outbound(kind, self.bot, types.Message.de_json(payload["message"]),
+                                             payload.get("notices", ()))
+            with deadline.scope(deadline.Deadline(config.JOB_DEADLINE)), outbound.scope(job_outbound):
+                try:
+                    self._runners[kind](self.bot, payload, reservation, self.usage_tracker)
+                except Exception:
+                    if not payload["final_attempt"]:
+                        job_outbound.take_notices()  # they travel with the retry
+                    raise
+        except Exception as e:
+            self._fail(job_id, kind, payload, attempts, e)
+        else:
+            self._db().execute("UPDATE jobs SET status = 'done', held = 0, updated_at = ? WHERE id = ?", (time.time(), job_id))
+            metrics.incr("jobs.done")
+        metrics.observe("jobs.run_ms", (time.perf_counter() - started) * 1000)
+
+    def _fail(self, job_id, kind, payload, attempts, error):
+        print(f"[DEBUG] Job {job_id} ({kind}) attempt {attempts} failed: {error}")
+        now = time.time()
+        # The runner settled its reservation on the way out; a retry reserves again
+        if attempts < config.JOB_MAX_ATTEMPTS:
+            delay = config.JOB_RETRY_DELAY * 2 ** (attempts - 1)
+            self._db().execute(
+                "UPDATE jobs SET status = 'queued', held = 0, run_after = ?, updated_at = ?, last_error = ? WHERE id = ?",
+                (now + delay, now, str(error)[:500], job_id),
+            )
+            return
+        self._db().execute(
+            "UPDATE jobs SET status = 'failed', held = 0, updated_at = ?, last_error = ? WHERE id = ?",
+            (now, str(error)[:500], job_id),
+        )
+        metrics.incr("jobs.failed")
+        try:
+            message = types.Message.de_json(payload["message"])
+            self.bot.reply_to(message, "❌ Sorry, this request could not be completed. Please try again later.")
+        except Exception as e:
+            print(f"[DEBUG] Could not notify about failed job {job_id}: {e}")
+
+    def _maybe_prune(self):
+        now = time.time()
+        if now - self._last_prune < 3600:
+            return
+        self._last_prune = now
+        self._db().execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                           (now - config.JOB_RETENTION_HOURS * 3600,))
+
+    # ---------- visibility ----------
+    def depth(self):
+        """{kind: {status: count}} for queued and running jobs"""
+        rows = self._db().execute(
+            "SELECT kind, status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY kind, status"
+        ).fetchall()
+        depth = {}
+        for kind, status, count in rows:
+            depth.setdefault(kind, {})[status] = count
+        return depth
+
+    def oldest_queued_age(self):
+        """Seconds the oldest waiting job has been queued (0 if none)"""
+        row = self._db().execute("SELECT MIN(created_at) FROM jobs WHERE status = 'queued'").fetchone()
+        return time.time() - row[0] if row and row[0] else 0.0
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Global queue shared by the image and TTS handlers (JOB_QUEUE_DB is read on first use)
+jobs = JobQueue()
+
+def queue_report():
+    """One-line summary for /debug"""
+    depth = jobs.depth()
+    queued = sum(d.get("queued", 0) for d in depth.values())
+    running = sum(d.get("running", 0) for d in depth.values())
+    wait = metrics.window_stats("jobs.wait_ms")
+    return (f"{queued} queued, {running} running, oldest {jobs.oldest_queued_age():.0f}s, "
+            f"wait p95 {wait['p95'] / 1000:.1f}s, {metrics.get('jobs.retried')} retries, {metrics.get('jobs.failed')} failed")
@@ -0,0 +1,129 @@
+import threading
+import time
+
+import config
+import deadline
+import metrics
+
+class UpstreamOverloaded(Exception):
+    """Raised when a request is shed instead of queueing for an upstream"""
+
+class ConcurrencyLimiter:
+    """
+    Client-side cap on simultaneous requests to one upstream, discovered
+    with AIMD. Each call that finishes fast (within LIMITER_LATENCY_TOLERANCE
+    of the no-load latency) adds 1/limit, i.e. about +1 per round of calls.
+    An error, or a call slowed down by queueing upstream, multiplies the
+    limit by LIMITER_BACKOFF, at most once per round trip. Calls over the
+    limit wait up to LIMITER_QUEUE_TIMEOUT (and the request deadline), and
+    are shed once LIMITER_MAX_QUEUE are already waiting.
+    """
+
+    def __init__(self, name, initial=None, min_limit=None, max_limit=None):
+        self.name = name
+        self.limit = float(initial or config.LIMITER_INITIAL)
+        self.min_limit = min_limit or config.LIMITER_MIN
+        self.max_limit = max_limit or config.LIMITER_MAX
+        self.in_flight = 0
+        self.waiting = 0
+        self.baseline_ms = None  # slowly rising minimum latency: the no-load estimate
+        self._last_drop = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Take a slot; False if none frees up in time (or the queue is full)"""
+        if timeout is None:
+            timeout = config.LIMITER_QUEUE_TIMEOUT
+        timeout = min(timeout, deadline.remaining(timeout))
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            if timeout <= 0 or self.waiting >= config.LIMITER_MAX_QUEUE:
+                return self._shed()
+            self.waiting += 1
+            t0 = time.perf_counter()
+            try:
+                ok = self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout)
+            finally:
+                self.waiting -= 1
+            if not ok:
+                return self._shed()
+            self.in_flight += 1
+            metrics.observe(f"limiter.queued_ms.{self.name}", (time.perf_counter() - t0) * 1000.0)
+            return True
+
+    def _shed(self):
+        metrics.incr(f"limiter.shed.{self.name}")
+        return False
+
+    def release(self, ok, latency_ms):
+        """Return a slot and adjust the limit from how the call went"""
+        now = time.monotonic()
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+            if ok is None:
+                return
+            if ok:
+                if self.baseline_ms is None or latency_ms < self.baseline_ms:
+                    self.baseline_ms = latency_ms
+                else:
+                    self.baseline_ms += (latency_ms - self.baseline_ms) * 0.01
+            congested = not ok or latency_ms > config.LIMITER_LATENCY_TOLERANCE * self.baseline_ms
+            if not congested:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            elif now - self._last_drop > latency_ms / 1000.0:
+                # Calls that were already in flight report the same congestion: count it once
+                self._last_drop = now
+                self.limit = max(self.min_limit, self.limit * config.LIMITER_BACKOFF)
+                metrics.incr(f"limiter.decreases.{self.name}")
+
+    def hold(self, timeout=None):
+        """
+        Take a slot for one call and return its Permit. Release the permit
+        once the whole call is over, response body included. Raises
+        UpstreamOverloaded when the call is shed.
+        """
+        if not self.acquire(timeout):
+            raise UpstreamOverloaded(f"{self.name} is at its concurrency limit ({int(self.limit)})")
+        return Permit(self)
+
+    def describe(self):
+        with self._cond:
+            return (f"{self.name}: {self.in_flight}/{int(self.limit)} in flight, {self.waiting} waiting, "
+                    f"{metrics.get(f'limiter.shed.{self.name}')} shed")
+
+class Permit:
+    """A slot held in a ConcurrencyLimiter; the call's latency runs until release()"""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.started = time.perf_counter()
+        self.released = False
+
+    def release(self, ok):
+        """
+        Return the slot (later calls do nothing). ok=False for a failed call,
+        None for an answer that says nothing about load (e.g. a 4xx)
+        """
+        if not self.released:
+            self.released = True
+            self.limiter.release(ok, (time.perf_counter() - self.started) * 1000.0)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter(upstream):
+    """The limiter of one upstream (created on first use)"""
+    with _limiters_lock:
+        found = _limiters.get(upstream)
+        if found is None:
+            found = _limiters[upstream] = ConcurrencyLimiter(upstream)
+        return found
+
+def limiter_report():
+    """One-line summary for /debug"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return "; ".join(l.describe() for l in limiters) or "no upstream calls yet"
@@ -0,0 +1,343 @@
+import io
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import requests
+from telebot import apihelper
+import config
+import deadline
+import metrics
+import outbound
+
+try:
+    from PIL import Image
+except ImportError:  # recompression is optional
+    Image = None
+
+# Magic-byte signatures for the media types upstreams are allowed to return
+IMAGE_TYPES = ("image/png", "image/jpeg", "image/webp")
+AUDIO_TYPES = ("audio/mpeg", "audio/ogg")
+
+SNIFF_BYTES = 16
+CHUNK_SIZE = 64 * 1024
+
+EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp", "audio/ogg": "ogg", "audio/mpeg": "mp3"}
+
+def sniff_media_type(head):
+    """Identify the media type from the first bytes of a payload, or None"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"OggS"):
+        return "audio/ogg"
+    if head.startswith(b"ID3"):
+        return "audio/mpeg"
+    # Bare MPEG audio frame: 11-bit sync word, valid layer bits
+    if len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0 and (head[1] & 0x06):
+        return "audio/mpeg"
+    return None
+
+def read_media(resp, upstream, allowed_types, max_bytes, spool=False):
+    """
+    Stream a media response body with a hard size cap.
+    The type is sniffed from the first chunk and anything else (HTML/JSON
+    error pages, oversized bodies) is aborted before it is buffered.
+    With spool=True the body is written straight into a spooled temp file
+    (in memory up to MEDIA_SPOOL_THRESHOLD, then on disk) that can be handed
+    to a Telegram upload without further copies.
+    The download is abandoned once the current request deadline passes.
+    Returns (body, media_type) or (None, None).
+    """
+    t0 = time.perf_counter()
+    sink = tempfile.SpooledTemporaryFile(max_size=config.MEDIA_SPOOL_THRESHOLD) if spool else []
+    ok = False
+    try:
+        declared = resp.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > max_bytes:
+            return _reject(upstream, f"declared size {declared} over cap")
+
+        head = b""
+        total = 0
+        media_type = None
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            if not chunk:
+                continue
+            if deadline.expired():
+                metrics.incr("deadline.expired.download")
+                return _reject(upstream, f"request deadline passed after {total} bytes")
+            total += len(chunk)
+            if total > max_bytes:
+                return _reject(upstream, f"body over {max_bytes} bytes")
+            if media_type is None:
+                head = (head + chunk)[:SNIFF_BYTES]
+                if len(head) >= SNIFF_BYTES:
+                    media_type = sniff_media_type(head)
+                    if media_type not in allowed_types:
+                        return _reject(upstream, f"unexpected payload {head!r}")
+            if spool:
+                sink.write(chunk)
+            else:
+                sink.append(chunk)
+        if media_type is None:
+            media_type = sniff_media_type(head)
+            if media_type not in allowed_types:
+                return _reject(upstream, f"short or unknown payload ({total} bytes)")
+
+        elapsed = max(time.perf_counter() - t0, 1e-6)
+        metrics.incr(f"download.bytes.{upstream}", total)
+        metrics.observe(f"download.kbps.{upstream}", total / 1024.0 / elapsed)
+        ok = True
+        if spool:
+            sink.seek(0)
+            return sink, media_type
+        return b"".join(sink), media_type
+    finally:
+        resp.close()
+        if spool and not ok:
+            sink.close()
+
+def _reject(upstream, reason):
+    metrics.incr(f"download.rejected.{upstream}")
+    print(f"[DEBUG] {upstream} download aborted: {reason}")
+    return None, None
+
+def download_report(upstream):
+    """One-line download summary for /debug"""
+    rate = metrics.window_stats(f"download.kbps.{upstream}")
+    return (f"{metrics.get(f'download.bytes.{upstream}') // 1024} KB, "
+            f"p50 {rate['p50']:.0f} KB/s, {metrics.get(f'download.rejected.{upstream}')} rejected")
+
+# ---------- Image preparation before upload ----------
+# Telegram sendPhoto limits
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+PHOTO_MAX_SIDES = 10000  # width + height
+PHOTO_MAX_RATIO = 20
+HEADER_BYTES = 64 * 1024
+
+def image_dimensions(head):
+    """(width, height) from PNG/JPEG/WebP header bytes, or None"""
+    try:
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            chunk = head[12:16]
+            if chunk == b"VP8 ":
+                w, h = struct.unpack("<HH", head[26:30])
+                return w & 0x3FFF, h & 0x3FFF
+            if chunk == b"VP8L":
+                b = head[21:25]
+                w = 1 + (((b[1] & 0x3F) << 8) | b[0])
+                h = 1 + (((b[3] & 0x0F) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6))
+                return w, h
+            if chunk == b"VP8X":
+                return 1 + int.from_bytes(head[24:27], "little"), 1 + int.from_bytes(head[27:30], "little")
+        if head.startswith(b"\xff\xd8"):
+            # Walk JPEG segments up to the first start-of-frame marker
+            i = 2
+            while i + 9 < len(head):
+                if head[i] != 0xFF:
+                    i += 1
+                    continue
+                marker = head[i + 1]
+                if marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                    h, w = struct.unpack(">HH", head[i + 5:i + 9])
+                    return w, h
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                    i += 2
+                    continue
+                i += 2 + struct.unpack(">H", head[i + 2:i + 4])[0]
+    except (struct.error, IndexError):
+        pass
+    return None
+
+def _payload_info(payload):
+    """(size, header bytes) of bytes or a seekable file without reading it all"""
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload), bytes(payload[:HEADER_BYTES])
+    payload.seek(0, os.SEEK_END)
+    size = payload.tell()
+    payload.seek(0)
+    head = payload.read(HEADER_BYTES)
+    payload.seek(0)
+    return size, head
+
+def fits_photo_limits(size, dims):
+    if size > PHOTO_MAX_BYTES:
+        return False
+    if dims:
+        w, h = dims
+        if w + h > PHOTO_MAX_SIDES or max(w, h) > PHOTO_MAX_RATIO * max(1, min(w, h)):
+            return False
+    return True
+
+def _recompress(data, target_bytes, max_side):
+    """Runs in a worker process: downscale and re-encode as JPEG under target_bytes"""
+    img = Image.open(io.BytesIO(data))
+    img = img.convert("RGB")
+    if max(img.size) > max_side:
+        img.thumbnail((max_side, max_side))
+    out = b""
+    for quality in (90, 82, 74, 66, 58, 50):
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+        out = buf.getvalue()
+        if len(out) <= target_bytes:
+            break
+    return out
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Forking this process would copy locks held by its many threads; start clean workers
+            _process_pool = ProcessPoolExecutor(max_workers=config.IMAGE_RECOMPRESS_WORKERS,
+                                                mp_context=multiprocessing.get_context("forkserver"))
+        return _process_pool
+
+def prepare_image(image):
+    """
+    Pick the delivery for an image before upload.
+    Returns (payload, as_document, info): payloads over Telegram photo limits are
+    recompressed in a worker process when enabled (and Pillow is installed),
+    otherwise sent as a document. info carries sizes/dimensions for metrics.
+    """
+    size, head = _payload_info(image)
+    media_type = sniff_media_type(head[:SNIFF_BYTES])
+    dims = image_dimensions(head)
+    info = {"type": media_type, "dims": dims, "bytes_in": size, "bytes_out": size, "optimized": False}
+    metrics.observe("image.bytes_in", size)
+
+    wants_optimize = size > config.IMAGE_TARGET_BYTES or not fits_photo_limits(size, dims)
+    if wants_optimize and config.IMAGE_RECOMPRESS and Image is not None:
+        try:
+            data = image if isinstance(image, (bytes, bytearray)) else rewind(image).read()
+            future = _get_process_pool().submit(_recompress, bytes(data), config.IMAGE_TARGET_BYTES, config.IMAGE_MAX_SIDE)
+            out = future.result(timeout=config.IMAGE_RECOMPRESS_TIMEOUT)
+            out_dims = image_dimensions(out[:HEADER_BYTES])
+            if out and len(out) < size and fits_photo_limits(len(out), out_dims):
+                info.update(type="image/jpeg", dims=out_dims, bytes_out=len(out), optimized=True)
+                metrics.incr("image.optimized")
+                metrics.incr("image.optimized_saved_bytes", size - len(out))
+                metrics.observe("image.bytes_out", len(out))
+                return out, False, info
+        except Exception as e:
+            print(f"[DEBUG] Image recompression failed: {e}")
+        finally:
+            rewind(image)
+
+    metrics.observe("image.bytes_out", size)
+    if fits_photo_limits(size, dims):
+        return image, False, info
+    metrics.incr("image.as_document")
+    return image, True, info
+
+def image_prep_report():
+    """One-line upload summary for /debug"""
+    before = metrics.window_stats("image.bytes_in")
+    after = metrics.window_stats("image.bytes_out")
+    raw = metrics.window_stats("image.upload_ms.raw")
+    opt = metrics.window_stats("image.upload_ms.optimized")
+    return (f"avg {before['mean'] / 1024:.0f} KB in -> {after['mean'] / 1024:.0f} KB out, "
+            f"upload p50 {raw['p50']:.0f} ms raw / {opt['p50']:.0f} ms optimized, "
+            f"{metrics.get('image.optimized')} recompressed, {metrics.get('image.as_document')} as document")
+
+# ---------- Streaming uploads to Telegram ----------
+def rewind(payload):
+    """Reset a file-like payload before (re)sending it; bytes pass through"""
+    if hasattr(payload, "seek"):
+        payload.seek(0)
+    return payload
+
+def release(payload):
+    """Close a spooled payload once it is no longer needed"""
+    if hasattr(payload, "close"):
+        try:
+            payload.close()
+        except Exception:
+            pass
+
+class MultipartStream:
+    """
+    multipart/form-data body that streams file parts instead of buffering them.
+    Each part is labelled with its sniffed media type and a matching file name
+    (voice.mp3, photo.jpg), which Telegram uses to handle voice and audio.
+    """
+
+    def __init__(self, files):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self._parts = []
+        for field, value in files.items():
+            filename = None
+            if isinstance(value, tuple):
+                filename, value = value[0], value[1]
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                start, size = None, len(value)
+                head = bytes(value[:SNIFF_BYTES])
+            else:
+                start = value.tell()
+                head = value.read(SNIFF_BYTES)
+                value.seek(0, os.SEEK_END)
+                size = value.tell() - start
+                value.seek(start)
+            media_type = sniff_media_type(head)
+            if not filename:
+                filename = f"{field}.{EXTENSIONS[media_type]}" if media_type else field
+            header = (f"--{self.boundary}\r\n"
+                      f'Content-Disposition: form-data; name="{field}"; filename="{os.path.basename(str(filename))}"\r\n'
+                      f"Content-Type: {media_type or 'application/octet-stream'}\r\n\r\n").encode("utf-8")
+            self._parts.append((header, value, start, size))
+        self._trailer = f"--{self.boundary}--\r\n".encode("ascii")
+        self.length = sum(len(h) + size + 2 for h, _, _, size in self._parts) + len(self._trailer)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for header, value, start, size in self._parts:
+            yield header
+            if start is None:
+                yield bytes(value)
+            else:
+                value.seek(start)
+                while True:
+                    block = value.read(CHUNK_SIZE)
+                    if not block:
+                        break
+                    yield block
+            yield b"\r\n"
+        yield self._trailer
+
+def relay_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    """
+    telebot CUSTOM_REQUEST_SENDER: uploads stream from their source instead of
+    a buffered body. Calls without files take telebot's usual session request.
+    """
+    outbound.count_call(url.rsplit("/", 1)[-1])
+    timeout = deadline.telegram_timeout(timeout)
+    session = apihelper._get_req_session()
+    if not files:
+        return session.request(method, url, params=params, timeout=timeout, proxies=proxies)
+    body = MultipartStream(files)
+    t0 = time.perf_counter()
+    try:
+        return session.request(
+            method, url, params=params, data=body, timeout=timeout, proxies=proxies,
+            headers={"Content-Type": body.content_type, "Content-Length": str(body.length)},
+        )
+    finally:
+        metrics.incr("upload.bytes", body.length)
+        metrics.observe("upload.ms", (time.perf_counter() - t0) * 1000.0)
@@ -0,0 +1,60 @@
+import threading
+from collections import deque
+
+# In-process counters and rolling windows shown in /debug
+WINDOW_SIZE = 512
+
+_lock = threading.Lock()
+_counters = {}
+_windows = {}
+
+def incr(name, value=1):
+    """Add value to a named counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def get(name, default=0):
+    """Read a named counter"""
+    with _lock:
+        return _counters.get(name, default)
+
+def observe(name, value):
+    """Record a sample (latency, size, ...) in a rolling window"""
+    with _lock:
+        window = _windows.get(name)
+        if window is None:
+            window = _windows[name] = deque(maxlen=WINDOW_SIZE)
+        window.append(value)
+
+def percentile(name, pct, default=None):
+    """Return the pct-th percentile of a rolling window, or default if empty"""
+    with _lock:
+        samples = sorted(_windows.get(name) or ())
+    if not samples:
+        return default
+    index = min(len(samples) - 1, max(0, int(round(pct / 100.0 * (len(samples) - 1)))))
+    return samples[index]
+
+def window_stats(name):
+    """Summarize a rolling window as count/mean/p50/p95"""
+    with _lock:
+        samples = sorted(_windows.get(name) or ())
+    if not samples:
+        return {"count": 0, "mean": 0, "p50": 0, "p95": 0}
+    last = len(samples) - 1
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": samples[int(round(0.50 * last))],
+        "p95": samples[int(round(0.95 * last))],
+    }
+
+def ratio(numerator, denominator):
+    """Counter ratio in percent, 0 when nothing was counted"""
+    total = get(denominator)
+    return (100.0 * get(numerator) / total) if total else 0.0
+
+def snapshot(prefix=""):
+    """Copy of all counters whose name starts with prefix"""
+    with _lock:
+        return {k: v for k, v in _counters.items() if k.startswith(prefix)}
@@ -0,0 +1,120 @@
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+# Per-request outbound buffer. Handlers and jobs run inside a scope; Bot API
+# calls made on their behalf are counted, and side notices (quota warnings)
+# are held until they can ride along in the request's final message or
+# caption. Whatever is left is sent as one reply when the scope ends.
+
+_local = threading.local()
+
+class Outbound:
+    """Outbound state of one handler invocation or job"""
+
+    def __init__(self, kind, bot=None, message=None, notices=()):
+        self.kind = kind
+        self.bot = bot
+        self.message = message
+        self.notices = list(notices)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def notice(self, text):
+        """Hold a notice for the final message instead of sending it now"""
+        self.notices.append(text)
+
+    def take_notices(self):
+        notices, self.notices = self.notices, []
+        return notices
+
+    def merge(self, text, limit, render=None):
+        """text with the held notices appended if the result stays within limit
+        (render escapes them for the text's parse mode); they are then consumed"""
+        if not self.notices:
+            return text
+        extra = "\n\n" + "\n".join(self.notices)
+        if render is not None:
+            extra = render(extra)
+        if len(text) + len(extra) > limit:
+            return text
+        metrics.incr("outbound.merged_notices", len(self.notices))
+        self.notices = []
+        return text + extra
+
+    def flush(self):
+        """Send notices that found no final message to ride along with, as one reply"""
+        if not self.notices or self.bot is None or self.message is None:
+            return
+        text = "\n\n".join(self.take_notices())
+        try:
+            self.bot.reply_to(self.message, text, parse_mode="Markdown")
+        except Exception as e:
+            print(f"[DEBUG] Failed to send notices: {e}")
+
+def current():
+    return getattr(_local, "outbound", None)
+
+@contextmanager
+def scope(outbound):
+    """Run a handler or job with outbound as its buffer; flushes and records its call count at the end"""
+    previous = current()
+    _local.outbound = outbound
+    try:
+        yield outbound
+    finally:
+        try:
+            outbound.flush()
+        finally:
+            _local.outbound = previous
+            metrics.observe(f"outbound.calls_per_request.{outbound.kind}", outbound.calls)
+
+def bind(fn):
+    """Wrap fn so its Bot API calls count towards the caller's request (loader threads)"""
+    outbound = current()
+    if outbound is None:
+        return fn
+
+    def run(*args, **kwargs):
+        previous = current()
+        _local.outbound = outbound
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.outbound = previous
+    return run
+
+def notice(text):
+    """Hold a notice in the current request; False outside one (the caller sends it itself)"""
+    outbound = current()
+    if outbound is None:
+        return False
+    outbound.notice(text)
+    return True
+
+def merge(text, limit, render=None):
+    """Outbound.merge on the current request (text unchanged outside one)"""
+    outbound = current()
+    return outbound.merge(text, limit, render) if outbound is not None else text
+
+def count_call(method):
+    """Called for every Bot API request; only send* methods (messages the user gets) are
+    counted, not polling, health probes, edits or callback answers"""
+    if not method.startswith("send"):
+        return
+    metrics.incr("outbound.calls")
+    outbound = current()
+    if outbound is not None:
+        with outbound._lock:
+            outbound.calls += 1
+
+def outbound_report():
+    """One-line summary for /debug"""
+    parts = []
+    for kind in ("update", "image", "tts"):
+        stats = metrics.window_stats(f"outbound.calls_per_request.{kind}")
+        if stats["count"]:
+            parts.append(f"{kind} {stats['mean']:.1f}")
+    return (f"{metrics.get('outbound.calls')} messages sent, per request: {', '.join(parts) or 'no data'}; "
+            f"{metrics.get('outbound.merged_notices')} notices merged")
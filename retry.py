@@ -0,0 +1,110 @@
+import random
+import threading
+import time
+
+import requests
+
+import config
+import deadline
+import metrics
+from limiter import UpstreamOverloaded
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class RetryBudget:
+    """
+    Token bucket shared by all upstream clients. Every call deposits
+    `ratio` tokens (capped at `burst`) and every retry spends one, so
+    when an upstream is down retries add at most `ratio` extra load
+    instead of multiplying it.
+    """
+
+    def __init__(self, ratio, burst):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = float(burst)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+budget = RetryBudget(config.RETRY_BUDGET_RATIO, config.RETRY_BUDGET_BURST)
+
+def raise_for_retryable(response):
+    """Close a 429/5xx response and raise it as an HTTPError; return any other response"""
+    if response.status_code in RETRYABLE_STATUS:
+        response.close()
+        raise requests.exceptions.HTTPError(f"{response.status_code} from {response.url}", response=response)
+    return response
+
+def retryable(error, idempotent):
+    """Connect errors and 429/5xx always retry; other timeouts only for idempotent requests"""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in RETRYABLE_STATUS
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.Timeout):
+        return idempotent
+    return isinstance(error, requests.exceptions.ConnectionError)
+
+def transient(error):
+    """Could the whole request succeed later? Timeouts, connection errors, 429/5xx and load shedding"""
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, UpstreamOverloaded)):
+        return True
+    return retryable(error, idempotent=False)
+
+def backoff(retries, error=None):
+    """Full-jitter delay before retry number `retries` (0-based); honours a short Retry-After"""
+    delay = random.uniform(0, min(config.RETRY_MAX_DELAY, config.RETRY_BASE_DELAY * 2 ** retries))
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+        delay = max(delay, min(int(retry_after), config.RETRY_MAX_DELAY))
+    return delay
+
+def call(upstream, attempt, idempotent=False):
+    """
+    Run attempt() and retry it while the error is retryable, attempts and
+    the retry budget last, and the backoff fits in the current deadline.
+    The last error is raised unchanged.
+    """
+    budget.deposit()
+    metrics.incr("retry.calls")
+    retries = 0
+    while True:
+        try:
+            result = attempt()
+        except Exception as e:
+            if retries + 1 >= config.RETRY_MAX_ATTEMPTS or not retryable(e, idempotent):
+                raise
+            delay = backoff(retries, e)
+            left = deadline.remaining()
+            if left is not None and left <= delay:
+                metrics.incr("retry.deadline_denied")
+                raise
+            if not budget.withdraw():
+                metrics.incr("retry.budget_denied")
+                raise
+            retries += 1
+            metrics.incr("retry.attempts")
+            metrics.incr(f"retry.attempts.{upstream}")
+            print(f"[DEBUG] Retrying {upstream} in {delay:.2f}s (retry {retries}): {e}")
+            time.sleep(delay)
+            continue
+        if retries:
+            metrics.incr("retry.recovered")
+        return result
+
+def retry_report():
+    """One-line summary for /debug"""
+    return (f"{metrics.get('retry.attempts')} retries for {metrics.get('retry.calls')} calls "
+            f"({metrics.ratio('retry.attempts', 'retry.calls'):.1f}%), {metrics.get('retry.recovered')} recovered, "
+            f"{metrics.get('retry.budget_denied')} over budget, {budget.tokens:.1f} tokens left")
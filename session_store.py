@@ -0,0 +1,220 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import config
+import metrics
+
+# Session modes; "chat" is the sticky chat mode, the others are one-shot waits
+CHAT = "chat"
+WAITING_MODES = ("waiting_chat", "image", "tts")
+
+class Session:
+    """Ephemeral per-user state: chat mode plus at most one pending input"""
+
+    __slots__ = ("chat_until", "waiting", "waiting_until", "tick")
+
+    def __init__(self):
+        self.chat_until = 0.0
+        self.waiting = None
+        self.waiting_until = 0.0
+        self.tick = None  # wheel tick the record is scheduled to expire on
+
+    def expires_at(self):
+        return max(self.chat_until, self.waiting_until)
+
+class SessionStore:
+    """
+    User session state with per-entry TTLs. Expiry is driven by a hashed
+    timer wheel advanced every `tick` seconds, so the sweeper only visits
+    records due in the current slot; an LRU bound caps the number of records.
+    """
+
+    def __init__(self, chat_ttl, waiting_ttl, max_entries, tick):
+        self.chat_ttl = chat_ttl
+        self.waiting_ttl = waiting_ttl
+        self.max_entries = max_entries
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._records = OrderedDict()  # user_id -> Session, least recently touched first
+        self._wheel = [set() for _ in range(int(max(chat_ttl, waiting_ttl) // tick) + 2)]
+        self._swept_tick = self._tick_of(time.monotonic())
+        threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True).start()
+
+    def _tick_of(self, t):
+        return int(t // self.tick)
+
+    # ---------- timer wheel ----------
+    def _schedule(self, user_id, session):
+        tick = self._tick_of(session.expires_at()) + 1
+        if tick == session.tick:
+            return
+        if session.tick is not None:
+            self._wheel[session.tick % len(self._wheel)].discard(user_id)
+        session.tick = tick
+        self._wheel[tick % len(self._wheel)].add(user_id)
+
+    def _drop(self, user_id):
+        session = self._records.pop(user_id, None)
+        if session is not None and session.tick is not None:
+            self._wheel[session.tick % len(self._wheel)].discard(user_id)
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.tick)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[DEBUG] Session sweep error: {e}")
+
+    def sweep(self, now=None):
+        """Expire records in every wheel slot passed since the last sweep"""
+        now = time.monotonic() if now is None else now
+        started = time.perf_counter()
+        expired = 0
+        with self._lock:
+            current = self._tick_of(now)
+            for tick in range(self._swept_tick + 1, current + 1):
+                slot = self._wheel[tick % len(self._wheel)]
+                for user_id in [uid for uid in slot if self._records[uid].tick <= tick]:
+                    session = self._records[user_id]
+                    if session.expires_at() <= now:
+                        self._drop(user_id)
+                        expired += 1
+                    else:
+                        self._schedule(user_id, session)
+            self._swept_tick = max(self._swept_tick, current)
+        if expired:
+            metrics.incr("sessions.expired", expired)
+        metrics.observe("sessions.sweep_ms", (time.perf_counter() - started) * 1000)
+        return expired
+
+    # ---------- state ----------
+    def _live(self, user_id, now):
+        """Session with lapsed fields cleared, or None"""
+        session = self._records.get(user_id)
+        if session is None:
+            return None
+        if session.waiting is not None and session.waiting_until <= now:
+            session.waiting = None
+        if session.waiting is None and session.chat_until <= now:
+            self._drop(user_id)
+            return None
+        return session
+
+    def route(self, user_id):
+        """The mode that should handle this user's next message: image, tts, chat or None"""
+        now = time.monotonic()
+        with self._lock:
+            session = self._live(user_id, now)
+            if session is None:
+                return None
+            if session.waiting in ("image", "tts"):
+                return session.waiting
+            return CHAT if session.chat_until > now else None
+
+    def has(self, user_id, mode):
+        now = time.monotonic()
+        with self._lock:
+            session = self._live(user_id, now)
+            if session is None:
+                return False
+            if mode == CHAT:
+                return session.chat_until > now
+            return session.waiting == mode
+
+    def enter(self, user_id, mode):
+        """Put a user into a mode, or refresh its TTL if already there"""
+        now = time.monotonic()
+        with self._lock:
+            session = self._records.get(user_id)
+            if session is None:
+                session = self._records[user_id] = Session()
+                while len(self._records) > self.max_entries:
+                    self._drop(next(iter(self._records)))
+                    metrics.incr("sessions.evicted")
+            else:
+                self._records.move_to_end(user_id)
+            if mode == CHAT:
+                session.chat_until = now + self.chat_ttl
+            else:
+                session.waiting = mode
+                session.waiting_until = now + self.waiting_ttl
+            self._schedule(user_id, session)
+
+    def leave(self, user_id, mode):
+        """Take a user out of a mode; returns False if they were not in it"""
+        now = time.monotonic()
+        with self._lock:
+            session = self._live(user_id, now)
+            if session is None:
+                return False
+            if mode == CHAT:
+                if session.chat_until <= now:
+                    return False
+                session.chat_until = 0.0
+            elif session.waiting == mode:
+                session.waiting = None
+                session.waiting_until = 0.0
+            else:
+                return False
+            if session.expires_at() <= now:
+                self._drop(user_id)
+            return True
+
+    def count(self, mode):
+        """Users currently in a mode (linear scan, for owner stats)"""
+        now = time.monotonic()
+        with self._lock:
+            if mode == CHAT:
+                return sum(1 for s in self._records.values() if s.chat_until > now)
+            return sum(1 for s in self._records.values() if s.waiting == mode and s.waiting_until > now)
+
+    def view(self, mode):
+        return SessionView(self, mode)
+
+    def stats(self):
+        """Record count and an estimate of the memory held by the store"""
+        with self._lock:
+            entries = len(self._records)
+            approx = sys.getsizeof(self._records) + sum(sys.getsizeof(slot) for slot in self._wheel)
+            if entries:
+                user_id, session = next(iter(self._records.items()))
+                approx += entries * (sys.getsizeof(user_id) + sys.getsizeof(session))
+        return {"entries": entries, "approx_bytes": approx}
+
+class SessionView:
+    """Set-like view of one session mode, so handlers keep using add/discard/in"""
+
+    def __init__(self, store, mode):
+        self._store = store
+        self._mode = mode
+
+    def __contains__(self, user_id):
+        return self._store.has(user_id, self._mode)
+
+    def __len__(self):
+        return self._store.count(self._mode)
+
+    def add(self, user_id):
+        self._store.enter(user_id, self._mode)
+
+    def discard(self, user_id):
+        self._store.leave(user_id, self._mode)
+
+    def remove(self, user_id):
+        if not self._store.leave(user_id, self._mode):
+            raise KeyError(user_id)
+
+# Global store shared by all handlers
+sessions = SessionStore(config.SESSION_CHAT_TTL, config.SESSION_WAITING_TTL,
+                        config.SESSION_MAX_ENTRIES, config.SESSION_SWEEP_INTERVAL)
+
+def session_report():
+    """One-line summary for /debug"""
+    s = sessions.stats()
+    sweep = metrics.window_stats("sessions.sweep_ms")
+    return (f"{s['entries']} sessions (~{s['approx_bytes'] / 1024:.0f} KB), "
+            f"{metrics.get('sessions.expired')} expired, {metrics.get('sessions.evicted')} evicted, "
+            f"sweep p95 {sweep['p95']:.2f} ms")
@@ -0,0 +1,418 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+import config
+import metrics
+
+USAGE_FIELDS = ("images_used", "tts_used")
+
+def _today():
+    return date.today().isoformat()
+
+class JsonStateBackend:
+    """
+    The original file format: premium_users.json, usage_data.json and users.json.
+    Everything is held in memory; usage and the user registry are written
+    behind by a flusher thread, premium changes are written immediately.
+    """
+
+    name = "json"
+    shared = False  # state lives in this process only
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self.premium = set(self._load(config.PREMIUM_USERS_FILE, []))
+        self.users = set(self._load(config.USERS_FILE, []))
+        today = _today()
+        self.usage = {uid: data for uid, data in self._load(config.USAGE_DATA_FILE, {}).items()
+                      if data.get('date') == today}
+        self._registered_premium = len(self.users & self.premium)
+        self._dirty = {"usage": 0, "users": 0}
+        self._flush_requested = threading.Event()
+        threading.Thread(target=self._flush_loop, name="state-flush", daemon=True).start()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _load(path, default):
+        try:
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"[DEBUG] Error loading {path}: {e}")
+        return default
+
+    # ---------- write-behind ----------
+    def _mark_dirty(self, part):
+        self._dirty[part] += 1
+        if sum(self._dirty.values()) >= config.USAGE_FLUSH_DIRTY_THRESHOLD:
+            self._flush_requested.set()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_requested.wait(config.USAGE_FLUSH_INTERVAL)
+            self._flush_requested.clear()
+            self.flush()
+
+    def flush(self):
+        """Write pending usage/user changes to disk now (also called on shutdown)"""
+        from utils import atomic_write_json
+        with self._flush_lock:
+            with self._lock:
+                dirty = dict(self._dirty)
+                self._dirty = {"usage": 0, "users": 0}
+                usage = {uid: dict(data) for uid, data in self.usage.items()} if dirty["usage"] else None
+                users = list(self.users) if dirty["users"] else None
+            if usage is None and users is None:
+                return
+            t0 = time.perf_counter()
+            size = 0
+            try:
+                if usage is not None:
+                    size += atomic_write_json(config.USAGE_DATA_FILE, usage)
+                if users is not None:
+                    size += atomic_write_json(config.USERS_FILE, users)
+            except Exception as e:
+                print(f"[DEBUG] Error saving state: {e}")
+                with self._lock:
+                    for part, count in dirty.items():
+                        self._dirty[part] += count
+                return
+            metrics.incr("usage.flushes")
+            metrics.incr("usage.flushed_changes", sum(dirty.values()))
+            metrics.observe("usage.flush_ms", (time.perf_counter() - t0) * 1000.0)
+            metrics.observe("usage.flush_bytes", size)
+
+    # ---------- premium ----------
+    def _save_premium(self):
+        from utils import atomic_write_json
+        try:
+            atomic_write_json(config.PREMIUM_USERS_FILE, list(self.premium))
+        except Exception as e:
+            print(f"[DEBUG] Error saving premium users: {e}")
+
+    def is_premium(self, user_id):
+        return user_id in self.premium
+
+    def add_premium(self, user_id):
+        return self.add_premium_many([user_id]) == 1
+
+    def add_premium_many(self, user_ids):
+        """Add many premium users with a single file write; returns how many were new"""
+        with self._lock:
+            new = set(user_ids) - self.premium
+            if not new:
+                return 0
+            self.premium |= new
+            self._registered_premium += len(new & self.users)
+            self._save_premium()
+            return len(new)
+
+    def remove_premium(self, user_id):
+        return self.remove_premium_many([user_id]) == 1
+
+    def remove_premium_many(self, user_ids):
+        """Remove many premium users with a single file write; returns how many were premium"""
+        with self._lock:
+            gone = set(user_ids) & self.premium
+            if not gone:
+                return 0
+            self.premium -= gone
+            self._registered_premium -= len(gone & self.users)
+            self._save_premium()
+            return len(gone)
+
+    def premium_count(self):
+        return len(self.premium)
+
+    # ---------- user registry ----------
+    def register_user(self, user_id):
+        with self._lock:
+            if user_id in self.users:
+                return False
+            self.users.add(user_id)
+            if user_id in self.premium:
+                self._registered_premium += 1
+            self._mark_dirty("users")
+            return True
+
+    def remove_users(self, user_ids):
+        """Drop users from the registry (blocked the bot, deactivated); returns how many were registered"""
+        with self._lock:
+            gone = set(user_ids) & self.users
+            if not gone:
+                return 0
+            self.users -= gone
+            self._registered_premium -= len(gone & self.premium)
+            self._mark_dirty("users")
+            return len(gone)
+
+    def list_users(self):
+        """Registered user ids in ascending order"""
+        with self._lock:
+            return sorted(self.users)
+
+    def user_count(self):
+        return len(self.users)
+
+    def registered_premium_count(self):
+        return self._registered_premium
+
+    # ---------- usage ----------
+    def _row(self, user_id):
+        key = str(user_id)
+        today = _today()
+        row = self.usage.get(key)
+        if row is None or row.get('date') != today:
+            row = self.usage[key] = {'date': today, 'images_used': 0, 'tts_used': 0}
+        return row
+
+    def get_usage(self, user_id):
+        """Today's counters for a user as a plain dict"""
+        with self._lock:
+            row = self._row(user_id)
+            return {field: row[field] for field in USAGE_FIELDS}
+
+    def add_usage(self, user_id, field, delta):
+        """Atomically add delta (may be negative) to today's counter; returns the new value"""
+        with self._lock:
+            row = self._row(user_id)
+            row[field] = max(0, row[field] + delta)
+            self._mark_dirty("usage")
+            return row[field]
+
+    def try_add_usage(self, user_id, field, delta, limit):
+        """Add delta only if the counter stays within limit; returns True on success"""
+        with self._lock:
+            row = self._row(user_id)
+            if row[field] + delta > limit:
+                return False
+            row[field] += delta
+            self._mark_dirty("usage")
+            return True
+
+    def describe(self):
+        return f"json ({config.PREMIUM_USERS_FILE}, {config.USAGE_DATA_FILE}, {config.USERS_FILE})"
+
+class SQLiteStateBackend:
+    """
+    SQLite (WAL) backend: indexed tables, atomic increments, day-partitioned
+    usage rows and incrementally maintained aggregate counters, so every
+    per-request operation and /stats stay constant-time as users grow.
+    Safe to share between threads and processes.
+    """
+
+    name = "sqlite"
+    shared = True  # other worker processes may use the same database
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        first_seen REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS premium (
+        user_id INTEGER PRIMARY KEY,
+        added_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS usage (
+        day TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        images_used INTEGER NOT NULL DEFAULT 0,
+        tts_used INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, user_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        db = self._db()
+        db.executescript(self.SCHEMA)
+        with self._tx() as db:
+            for name in ("users", "premium", "premium_registered"):
+                db.execute("INSERT OR IGNORE INTO counters(name, value) VALUES (?, 0)", (name,))
+        self._import_json_once()
+        self._prune_usage()
+
+    def _db(self):
+        """Per-thread (and per-process) connection"""
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _tx(self):
+        return _Transaction(self._db())
+
+    def _counter(self, db, name, delta):
+        db.execute("UPDATE counters SET value = value + ? WHERE name = ?", (delta, name))
+
+    def _get_counter(self, name):
+        row = self._db().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def _import_json_once(self):
+        """Seed an empty database from the JSON files so switching backends keeps state"""
+        if self._get_counter("users") or self._get_counter("premium"):
+            return
+        premium = JsonStateBackend._load(config.PREMIUM_USERS_FILE, [])
+        users = JsonStateBackend._load(config.USERS_FILE, [])
+        usage = JsonStateBackend._load(config.USAGE_DATA_FILE, {})
+        if premium or users or usage:
+            self.add_premium_many(premium)
+            for uid in users:
+                self.register_user(uid)
+            with self._tx() as db:
+                for uid, data in usage.items():
+                    db.execute(
+                        "INSERT OR IGNORE INTO usage(day, user_id, images_used, tts_used) VALUES (?, ?, ?, ?)",
+                        (data.get('date', _today()), int(uid), data.get('images_used', 0), data.get('tts_used', 0)),
+                    )
+            print(f"[DEBUG] Imported {len(premium)} premium, {len(users)} users from JSON state")
+
+    def _prune_usage(self):
+        cutoff = (date.today() - timedelta(days=config.USAGE_RETENTION_DAYS)).isoformat()
+        self._db().execute("DELETE FROM usage WHERE day < ?", (cutoff,))
+
+    def flush(self):
+        """Writes are durable on commit; nothing is pending"""
+
+    # ---------- premium ----------
+    def is_premium(self, user_id):
+        return self._db().execute("SELECT 1 FROM premium WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def add_premium(self, user_id):
+        return self.add_premium_many([user_id]) == 1
+
+    def add_premium_many(self, user_ids):
+        """Add many premium users in one transaction; returns how many were new"""
+        added = 0
+        now = time.time()
+        with self._tx() as db:
+            for uid in user_ids:
+                if db.execute("INSERT OR IGNORE INTO premium(user_id, added_at) VALUES (?, ?)", (uid, now)).rowcount:
+                    added += 1
+                    if db.execute("SELECT 1 FROM users WHERE user_id = ?", (uid,)).fetchone():
+                        self._counter(db, "premium_registered", 1)
+            self._counter(db, "premium", added)
+        return added
+
+    def remove_premium(self, user_id):
+        return self.remove_premium_many([user_id]) == 1
+
+    def remove_premium_many(self, user_ids):
+        """Remove many premium users in one transaction; returns how many were premium"""
+        removed = 0
+        with self._tx() as db:
+            for uid in user_ids:
+                if db.execute("DELETE FROM premium WHERE user_id = ?", (uid,)).rowcount:
+                    removed += 1
+                    if db.execute("SELECT 1 FROM users WHERE user_id = ?", (uid,)).fetchone():
+                        self._counter(db, "premium_registered", -1)
+            self._counter(db, "premium", -removed)
+        return removed
+
+    def premium_count(self):
+        return self._get_counter("premium")
+
+    # ---------- user registry ----------
+    def register_user(self, user_id):
+        with self._tx() as db:
+            if not db.execute("INSERT OR IGNORE INTO users(user_id, first_seen) VALUES (?, ?)", (user_id, time.time())).rowcount:
+                return False
+            self._counter(db, "users", 1)
+            if db.execute("SELECT 1 FROM premium WHERE user_id = ?", (user_id,)).fetchone():
+                self._counter(db, "premium_registered", 1)
+            return True
+
+    def remove_users(self, user_ids):
+        """Drop users from the registry in one transaction; returns how many were registered"""
+        removed = 0
+        with self._tx() as db:
+            for uid in user_ids:
+                if db.execute("DELETE FROM users WHERE user_id = ?", (uid,)).rowcount:
+                    removed += 1
+                    if db.execute("SELECT 1 FROM premium WHERE user_id = ?", (uid,)).fetchone():
+                        self._counter(db, "premium_registered", -1)
+            self._counter(db, "users", -removed)
+        return removed
+
+    def list_users(self):
+        """Registered user ids in ascending order"""
+        return [row[0] for row in self._db().execute("SELECT user_id FROM users ORDER BY user_id")]
+
+    def user_count(self):
+        return self._get_counter("users")
+
+    def registered_premium_count(self):
+        return self._get_counter("premium_registered")
+
+    # ---------- usage ----------
+    def get_usage(self, user_id):
+        row = self._db().execute(
+            "SELECT images_used, tts_used FROM usage WHERE day = ? AND user_id = ?", (_today(), user_id)
+        ).fetchone()
+        return dict(zip(USAGE_FIELDS, row or (0, 0)))
+
+    def add_usage(self, user_id, field, delta):
+        assert field in USAGE_FIELDS
+        day = _today()
+        with self._tx() as db:
+            db.execute("INSERT OR IGNORE INTO usage(day, user_id) VALUES (?, ?)", (day, user_id))
+            db.execute(f"UPDATE usage SET {field} = MAX(0, {field} + ?) WHERE day = ? AND user_id = ?", (delta, day, user_id))
+            return db.execute(f"SELECT {field} FROM usage WHERE day = ? AND user_id = ?", (day, user_id)).fetchone()[0]
+
+    def try_add_usage(self, user_id, field, delta, limit):
+        assert field in USAGE_FIELDS
+        day = _today()
+        with self._tx() as db:
+            db.execute("INSERT OR IGNORE INTO usage(day, user_id) VALUES (?, ?)", (day, user_id))
+            return db.execute(
+                f"UPDATE usage SET {field} = {field} + ? WHERE day = ? AND user_id = ? AND {field} + ? <= ?",
+                (delta, day, user_id, delta, limit),
+            ).rowcount == 1
+
+    def describe(self):
+        return f"sqlite ({self.path}, WAL)"
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK on an autocommit connection"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_state_backend():
+    """The configured state backend (created on first use)"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if config.STATE_BACKEND == "sqlite":
+                _backend = SQLiteStateBackend(config.STATE_DB_FILE)
+            else:
+                _backend = JsonStateBackend()
+        return _backend
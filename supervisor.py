@@ -0,0 +1,210 @@
+import multiprocessing
+import queue
+import signal
+import sys
+import time
+
+import config
+
+# Updates carrying a chat are sharded by chat id; these carry only a user
+SHARD_FALLBACK_KEYS = ("from", "user", "voter_chat")
+
+def shard_key(update):
+    """Chat id of a raw update (the sender for chat-less updates, else the update id)"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        for key in SHARD_FALLBACK_KEYS:
+            if isinstance(value.get(key), dict):
+                return value[key]["id"]
+    return update["update_id"]
+
+def worker_main(index, updates, overrides):
+    """Entry point of one bot worker process: run handlers for its shard of updates"""
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    config.WORKER_INDEX = index
+    if config.STATE_BACKEND != "sqlite":
+        print(f"[DEBUG] Worker {index}: switching to the sqlite state backend so workers share state")
+        config.STATE_BACKEND = "sqlite"
+    # The supervisor coordinates shutdown and sends a sentinel when it is time to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    import brahmos
+    from telebot import types
+
+    bot = brahmos.bot
+    pool = bot.worker_pool
+    print(f"[DEBUG] Worker {index} ready (pid {multiprocessing.current_process().pid})")
+    try:
+        while True:
+            raw = updates.get()
+            if raw is None:
+                break
+            # Keep the backlog in the queue, where a restarted worker can pick it up
+            while pool.tasks.qsize() >= config.SUPERVISOR_WORKER_PREFETCH:
+                time.sleep(0.01)
+            bot.process_new_updates([types.Update.de_json(raw)])
+            try:
+                pool.raise_exceptions()
+            except Exception as e:
+                print(f"[DEBUG] Worker {index} handler error: {e}")
+                pool.clear_exceptions()
+        while not pool.tasks.empty():
+            time.sleep(0.1)
+        pool.close()
+    finally:
+        brahmos.usage_tracker.flush()
+
+class Supervisor:
+    """
+    Polls Telegram in one process and shards updates by chat id to worker
+    processes over bounded multiprocessing queues. Sharding by chat keeps a
+    chat's conversation memory and session state in one worker; premium and
+    usage state are shared through the sqlite backend. Dead workers are
+    restarted with exponential backoff and resume from their queue.
+    """
+
+    def __init__(self, workers=None, overrides=None):
+        self.workers = workers or config.SUPERVISOR_WORKERS
+        self.overrides = dict(overrides or {})
+        self.overrides["SUPERVISOR_WORKERS"] = self.workers
+        for name, value in self.overrides.items():
+            setattr(config, name, value)
+        self._ctx = multiprocessing.get_context("spawn")
+        self.queues = [self._ctx.Queue(config.SUPERVISOR_QUEUE_SIZE) for _ in range(self.workers)]
+        self.procs = [None] * self.workers
+        self.started_at = [0.0] * self.workers
+        self.crashes = [0] * self.workers
+        self.restart_at = [None] * self.workers
+        self.routed = [0] * self.workers
+        self.restarts = 0
+        self.seen_updates = None
+        if config.UPDATE_DEDUP_ENABLED:
+            from update_dedup import SeenUpdates
+            self.seen_updates = SeenUpdates(config.UPDATE_DEDUP_FILE, config.UPDATE_DEDUP_WINDOW)
+        self.running = False
+
+    def _spawn(self, index):
+        proc = self._ctx.Process(target=worker_main, args=(index, self.queues[index], self.overrides),
+                                 name=f"brahmos-worker-{index}")
+        proc.start()
+        self.procs[index] = proc
+        self.started_at[index] = time.monotonic()
+
+    def check_workers(self):
+        """Restart dead workers; a worker that crashes again soon waits longer"""
+        now = time.monotonic()
+        for index, proc in enumerate(self.procs):
+            if proc.is_alive():
+                continue
+            if self.restart_at[index] is None:
+                if now - self.started_at[index] > 60:
+                    self.crashes[index] = 0
+                self.crashes[index] += 1
+                delay = min(config.SUPERVISOR_MAX_RESTART_DELAY, 2 ** (self.crashes[index] - 1))
+                self.restart_at[index] = now + delay
+                print(f"[DEBUG] Worker {index} exited with code {proc.exitcode}, restarting in {delay}s")
+            elif now >= self.restart_at[index]:
+                self.restart_at[index] = None
+                self.restarts += 1
+                self._replace_queue(index)
+                self._spawn(index)
+
+    def _replace_queue(self, index):
+        """Give a restarted worker a fresh queue: a process killed mid-read can
+        leave the old one locked. Updates still readable are carried over."""
+        old = self.queues[index]
+        new = self.queues[index] = self._ctx.Queue(config.SUPERVISOR_QUEUE_SIZE)
+        carried = 0
+        try:
+            while True:
+                update = old.get(timeout=0.1)
+                if update is not None:
+                    new.put_nowait(update)
+                    carried += 1
+        except (queue.Empty, queue.Full):
+            pass
+        print(f"[DEBUG] Worker {index}: carried {carried} queued updates over to the restarted worker")
+
+    def dispatch(self, update):
+        """Hand one raw update to the worker owning its chat (blocks while that queue is full)"""
+        index = shard_key(update) % self.workers
+        while self.running:
+            try:
+                self.queues[index].put(update, timeout=1)
+                self.routed[index] += 1
+                return True
+            except queue.Full:
+                self.check_workers()
+        return False
+
+    def run(self):
+        """Start the workers and poll until stop() or an exit signal"""
+        from telebot import apihelper
+        if config.TELEGRAM_API_URL:
+            apihelper.API_URL = config.TELEGRAM_API_URL
+        self.running = True
+        for index in range(self.workers):
+            self._spawn(index)
+        offset = None
+        errors = 0
+        last_report = time.monotonic()
+        try:
+            while self.running:
+                self.check_workers()
+                try:
+                    updates = apihelper.get_updates(config.BOT_TOKEN, offset, limit=100, timeout=30, long_polling_timeout=20)
+                    errors = 0
+                except Exception as e:
+                    errors += 1
+                    print(f"[DEBUG] getUpdates failed ({errors}): {e}")
+                    time.sleep(min(30, 2 ** errors))
+                    continue
+                if updates:
+                    offset = max(update["update_id"] for update in updates) + 1
+                    if self.seen_updates is not None:
+                        updates = self.seen_updates.filter(updates, key=lambda update: update["update_id"])
+                for update in updates:
+                    if not self.dispatch(update):
+                        break
+                if time.monotonic() - last_report > 60:
+                    last_report = time.monotonic()
+                    print(f"[DEBUG] Supervisor: {self.report()}")
+        finally:
+            self.stop()
+
+    def stop(self, timeout=25):
+        """Let workers drain their queues, then stop them"""
+        self.running = False
+        for index, proc in enumerate(self.procs):
+            if proc is not None and proc.is_alive():
+                try:
+                    self.queues[index].put(None, timeout=1)
+                except queue.Full:
+                    pass
+        deadline = time.monotonic() + timeout
+        for proc in self.procs:
+            if proc is not None:
+                proc.join(max(0, deadline - time.monotonic()))
+                if proc.is_alive():
+                    proc.terminate()
+
+    def report(self):
+        alive = sum(1 for proc in self.procs if proc is not None and proc.is_alive())
+        return f"{alive}/{self.workers} workers alive, {self.restarts} restarts, routed {self.routed}"
+
+if __name__ == "__main__":
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    supervisor = Supervisor(workers)
+    print(f"🚀 BrahMos AI Supervisor starting {supervisor.workers} workers...")
+    # Dynos stop with SIGTERM: turn it into a normal exit so workers are drained
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        print("\n🛑 Supervisor stopped by user.")
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# The bot's modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import state_backend
+from utils import UsageTracker
+
+LIMIT = 20
+USER = 4242
+
+@pytest.fixture(params=["json", "sqlite"])
+def tracker(request, tmp_path, monkeypatch):
+    """A UsageTracker on a fresh state backend of each kind, FREE_TTS_LIMIT = LIMIT"""
+    monkeypatch.setattr(config, "STATE_BACKEND", request.param)
+    monkeypatch.setattr(config, "STATE_DB_FILE", str(tmp_path / "brahmos.db"))
+    monkeypatch.setattr(config, "PREMIUM_USERS_FILE", str(tmp_path / "premium_users.json"))
+    monkeypatch.setattr(config, "USAGE_DATA_FILE", str(tmp_path / "usage_data.json"))
+    monkeypatch.setattr(config, "USERS_FILE", str(tmp_path / "users.json"))
+    monkeypatch.setattr(config, "FREE_TTS_LIMIT", LIMIT)
+    monkeypatch.setattr(state_backend, "_backend", None)
+    tracker = UsageTracker()
+    yield tracker
+    tracker.flush()  # nothing left for the write-behind thread once config is restored
@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+from telebot import apihelper
+
+import config
+from broadcast import Broadcaster
+
+TEXT = {"type": "text", "text": "hello", "entities": []}
+
+def api_error(code, description, retry_after=None):
+    result_json = {"ok": False, "error_code": code, "description": description}
+    if retry_after is not None:
+        result_json["parameters"] = {"retry_after": retry_after}
+    return apihelper.ApiTelegramException("sendMessage", None, result_json)
+
+class FakeBot:
+    """Records deliveries; scripted errors are raised per chat id, once each"""
+
+    def __init__(self, errors=None, delay=0.0):
+        self.errors = {chat_id: list(queued) for chat_id, queued in (errors or {}).items()}
+        self.delay = delay
+        self.delivered = []
+        self.throttled_at = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, entities=None):
+        time.sleep(self.delay)
+        with self._lock:
+            queued = self.errors.get(chat_id)
+            if queued:
+                error = queued.pop(0)
+                if error.error_code == 429:
+                    self.throttled_at.append(time.monotonic())
+                raise error
+            self.delivered.append((chat_id, time.monotonic()))
+
+    def edit_message_text(self, text, chat_id, message_id):
+        pass
+
+class FakeState:
+    def __init__(self, users):
+        self.users = list(users)
+
+    def user_count(self):
+        return len(self.users)
+
+    def list_users(self):
+        return list(self.users)
+
+    def remove_users(self, user_ids):
+        self.users = [uid for uid in self.users if uid not in user_ids]
+
+    def flush(self):
+        pass
+
+@pytest.fixture(autouse=True)
+def pacing(monkeypatch):
+    monkeypatch.setattr(config, "BROADCAST_RATE", 200)
+    monkeypatch.setattr(config, "BROADCAST_WORKERS", 4)
+    monkeypatch.setattr(config, "BROADCAST_CHECKPOINT_INTERVAL", 0.05)
+    monkeypatch.setattr(config, "BROADCAST_MAX_ATTEMPTS", 2)
+
+def make_broadcaster(tmp_path, bot, state, resume=False):
+    broadcaster = Broadcaster(str(tmp_path / "broadcast_state.json"))
+    broadcaster.start(bot, state, resume=resume)
+    return broadcaster
+
+def finish(broadcaster):
+    broadcaster._thread.join(10)
+    assert not broadcaster.running()
+    return broadcaster.job
+
+def test_throttled_user_is_retried_and_gone_users_are_pruned(tmp_path):
+    bot = FakeBot({
+        3: [api_error(429, "Too Many Requests: retry after 1", retry_after=1)],
+        5: [api_error(403, "Forbidden: bot was blocked by the user")],
+        7: [api_error(400, "Bad Request: message is too long")],
+    })
+    state = FakeState(range(20))
+    broadcaster = make_broadcaster(tmp_path, bot, state)
+    assert broadcaster.send(TEXT, owner_chat_id=1)
+    assert not broadcaster.send(TEXT, owner_chat_id=1)  # one at a time
+
+    job = finish(broadcaster)
+    assert job["finished"] == "done"
+    assert (job["sent"], job["failed"], job["pruned"], job["total"]) == (18, 1, 1, 20)
+    assert sorted(chat_id for chat_id, _ in bot.delivered) == [uid for uid in range(20) if uid not in (5, 7)]
+    assert 5 not in state.users and 7 in state.users
+    # retry_after paused every sender, not just the throttled one (slots already taken may still go out)
+    throttled = bot.throttled_at[0]
+    assert not [sent_at for _, sent_at in bot.delivered if 0.1 < sent_at - throttled < 0.9]
+
+def test_interrupted_broadcast_resumes_with_the_users_not_reached(tmp_path):
+    state = FakeState(range(10))
+    first = make_broadcaster(tmp_path, FakeBot(), state)
+    first.job = {"payload": TEXT, "owner_chat_id": 1, "status_message_id": None, "total": 10,
+                 "sent": 3, "failed": 0, "pruned": 0, "elapsed": 1.0, "started": time.time(), "finished": None}
+    first._save()
+    with open(first.path + ".log", "w") as journal:
+        journal.write("0 sent\n1 sent\n2 pruned\n3 sent\n")  # the last checkpoint lagged behind
+
+    bot = FakeBot()
+    resumed = make_broadcaster(tmp_path, bot, state, resume=True)
+    job = finish(resumed)
+    assert sorted(chat_id for chat_id, _ in bot.delivered) == list(range(4, 10))
+    assert (job["sent"], job["pruned"], job["total"], job["finished"]) == (9, 1, 10, "done")
+    assert 2 not in state.users  # pruned before the crash, removed on resume
+    assert not make_broadcaster(tmp_path, FakeBot(), state, resume=True).running()
+
+def test_cancel_from_another_process_stops_the_broadcast(tmp_path):
+    bot = FakeBot(delay=0.01)
+    state = FakeState(range(1000))
+    sender = make_broadcaster(tmp_path, bot, state)
+    other = make_broadcaster(tmp_path, FakeBot(), state)
+    assert not other.cancel()
+
+    sender.send(TEXT, owner_chat_id=1)
+    time.sleep(0.2)
+    assert other.cancel()
+    job = finish(sender)
+    assert job["finished"] == "cancelled"
+    assert len(bot.delivered) < 1000
+    assert not other.cancel()
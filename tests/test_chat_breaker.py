@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+import config
+import chat_handler
+from chat_handler import ChatEndpoint
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    monkeypatch.setattr(config, "CHAT_BREAKER_FAILURES", 3)
+    monkeypatch.setattr(config, "CHAT_BREAKER_COOLDOWN", 30)
+    return ChatEndpoint("https://chat.example/v1/chat/completions", "test-model")
+
+def cool_down(endpoint):
+    endpoint.opened_at -= config.CHAT_BREAKER_COOLDOWN + 1
+
+def test_consecutive_failures_open_the_breaker(endpoint):
+    for _ in range(config.CHAT_BREAKER_FAILURES - 1):
+        assert endpoint.allow()
+        endpoint.record(False)
+    assert endpoint.state == "closed"
+    endpoint.record(True, 100)  # a success resets the count
+    assert endpoint.failures == 0
+
+    for _ in range(config.CHAT_BREAKER_FAILURES):
+        endpoint.record(False)
+    assert endpoint.state == "open"
+    assert not endpoint.allow()
+    assert endpoint.describe().startswith("chat.example: open")
+
+def test_half_open_lets_exactly_one_probe_through(endpoint):
+    for _ in range(config.CHAT_BREAKER_FAILURES):
+        endpoint.record(False)
+    cool_down(endpoint)
+
+    results = []
+    barrier = threading.Barrier(8)
+
+    def request():
+        barrier.wait()
+        results.append(endpoint.allow())
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert endpoint.state == "half-open"
+    assert results.count(True) == 1
+
+def test_successful_probe_closes_and_failed_probe_reopens(endpoint):
+    for _ in range(config.CHAT_BREAKER_FAILURES):
+        endpoint.record(False)
+    cool_down(endpoint)
+    assert endpoint.allow()
+    endpoint.record(False)  # one failure is enough while half-open
+    assert endpoint.state == "open"
+    assert not endpoint.allow()
+
+    cool_down(endpoint)
+    assert endpoint.allow()
+    endpoint.record(True, 250)
+    assert endpoint.state == "closed"
+    assert endpoint.failures == 0
+    assert endpoint.allow() and endpoint.allow()
+    assert endpoint.describe() == "chat.example: closed, 250 ms"
+
+def test_route_prefers_healthy_then_fast_endpoints(monkeypatch):
+    slow = ChatEndpoint("https://slow.example/v1/chat/completions", "m")
+    fast = ChatEndpoint("https://fast.example/v1/chat/completions", "m")
+    failing = ChatEndpoint("https://failing.example/v1/chat/completions", "m")
+    slow.record(True, 900)
+    fast.record(True, 100)
+    failing.record(True, 10)
+    failing.record(False)
+    monkeypatch.setattr(chat_handler, "chat_endpoints", [failing, slow, fast])
+    assert chat_handler._route() == [fast, slow, failing]
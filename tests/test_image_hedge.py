@@ -0,0 +1,81 @@
+import io
+import threading
+import time
+
+import pytest
+import requests
+
+import config
+import image_handler
+import metrics
+
+class FakeAttempts:
+    """Stands in for image_handler._attempt: each planned name maps to (delay, outcome)"""
+
+    def __init__(self, behaviours):
+        self.behaviours = behaviours
+        self.started = []
+        self.queue_timeouts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, provider, method, params, queue_timeout=None):
+        with self._lock:
+            self.started.append(provider)
+            self.queue_timeouts[provider] = queue_timeout
+        delay, outcome = self.behaviours[provider]
+        time.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+@pytest.fixture
+def attempts(monkeypatch):
+    def install(behaviours, hedge_delay=0.05):
+        fake = FakeAttempts(behaviours)
+        monkeypatch.setattr(image_handler, "_attempt", fake)
+        monkeypatch.setattr(image_handler, "_plan_attempts", lambda: [(name, "GET") for name in behaviours])
+        monkeypatch.setattr(image_handler, "_hedge_delay", lambda: hedge_delay)
+        return fake
+    monkeypatch.setattr(config, "IMAGE_HEDGE_ENABLED", True)
+    return install
+
+def test_slow_primary_is_hedged_and_the_hedge_wins(attempts):
+    primary = io.BytesIO(b"late")
+    fake = attempts({"primary": (0.5, primary), "hedge": (0.01, b"hedge")})
+    hedges, wins = metrics.get("image.hedges"), metrics.get("image.hedge_wins")
+
+    t0 = time.perf_counter()
+    assert image_handler._fetch_hedged({}) == b"hedge"
+    assert time.perf_counter() - t0 < 0.4
+    assert fake.started == ["primary", "hedge"]
+    assert fake.queue_timeouts["hedge"] == 0  # a hedge never queues for a busy provider
+    assert metrics.get("image.hedges") == hedges + 1
+    assert metrics.get("image.hedge_wins") == wins + 1
+    time.sleep(0.6)
+    assert primary.closed  # the losing body is released
+
+def test_fast_primary_sends_no_hedge(attempts):
+    fake = attempts({"primary": (0.0, b"image"), "hedge": (0.0, b"hedge")})
+    assert image_handler._fetch_hedged({}) == b"image"
+    time.sleep(0.1)
+    assert fake.started == ["primary"]
+
+def test_failed_attempt_falls_back_without_waiting_for_the_hedge_delay(attempts):
+    fake = attempts({"primary": (0.0, None), "second": (0.0, b"image")}, hedge_delay=10)
+    t0 = time.perf_counter()
+    assert image_handler._fetch_hedged({}) == b"image"
+    assert time.perf_counter() - t0 < 1
+    assert fake.started == ["primary", "second"]
+
+def test_hedging_can_be_disabled(attempts, monkeypatch):
+    monkeypatch.setattr(config, "IMAGE_HEDGE_ENABLED", False)
+    fake = attempts({"primary": (0.2, b"image"), "hedge": (0.0, b"hedge")})
+    assert image_handler._fetch_hedged({}) == b"image"
+    assert fake.started == ["primary"]
+
+def test_transient_failure_is_raised_only_when_asked(attempts):
+    down = requests.exceptions.ConnectionError("upstream down")
+    attempts({"primary": (0.0, down), "second": (0.0, down)})
+    assert image_handler._fetch_hedged({}) is None
+    with pytest.raises(requests.exceptions.ConnectionError):
+        image_handler._fetch_hedged({}, raise_transient=True)
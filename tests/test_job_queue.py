@@ -0,0 +1,131 @@
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+from telebot import types
+
+import config
+from conftest import LIMIT, USER
+from job_queue import JobQueue
+
+class FakeBot:
+    def __init__(self):
+        self.replies = []
+
+    def reply_to(self, message, text, **kwargs):
+        self.replies.append(text)
+
+def make_message(message_id=1, chat_id=100):
+    return types.Message.de_json({"message_id": message_id, "date": 0, "text": "/say hi",
+                                  "chat": {"id": chat_id, "type": "private"},
+                                  "from": {"id": USER, "is_bot": False, "first_name": "Test"}})
+
+@pytest.fixture
+def queue(tmp_path, tracker, monkeypatch):
+    monkeypatch.setattr(config, "JOB_RETRY_DELAY", 0)
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    queue.bot = FakeBot()
+    queue.usage_tracker = tracker
+    return queue
+
+def restarted(queue, owner=None):
+    """Another process on the same database, with the same runners"""
+    other = JobQueue(queue.path)
+    other.bot, other.usage_tracker, other._runners = queue.bot, queue.usage_tracker, queue._runners
+    if owner:
+        other.owner = owner
+    return other
+
+def used(tracker):
+    return tracker.backend.get_usage(USER)["tts_used"]
+
+def run_next(queue):
+    job = queue._claim()
+    assert job is not None
+    queue._run(*job)
+    return job
+
+def row(queue):
+    return queue._db().execute("SELECT idempotency_key, status, attempts FROM jobs").fetchone()
+
+def test_redelivered_update_is_a_noop_and_releases_its_hold(queue, tracker):
+    queue.register("tts", lambda bot, payload, reservation, usage_tracker: reservation.commit())
+    assert queue.submit("tts", make_message(), {"text": "hi"}, tracker.reserve(USER, "tts", 2))
+    assert not queue.submit("tts", make_message(), {"text": "hi"}, tracker.reserve(USER, "tts", 2))
+    assert queue.submit("tts", make_message(message_id=2), {"text": "hi"}, tracker.reserve(USER, "tts", 1))
+    assert tracker.get_remaining_tts(USER) == LIMIT - 3
+
+    run_next(queue)
+    run_next(queue)
+    assert queue._claim() is None
+    assert used(tracker) == 3
+    keys = [key for (key,) in queue._db().execute("SELECT idempotency_key FROM jobs ORDER BY id")]
+    assert keys == ["tts:100:1", "tts:100:2"]
+
+def test_expired_lease_is_claimed_again(queue, tracker):
+    runs = []
+    queue.register("tts", lambda bot, payload, reservation, usage_tracker: runs.append(reservation) or reservation.commit())
+    queue.submit("tts", make_message(), {"text": "hi"}, tracker.reserve(USER, "tts", 2))
+
+    assert queue._claim() is not None  # this worker then "crashes"
+    other = restarted(queue, "elsewhere:1")
+    assert other._claim() is None  # the lease still holds it
+    queue._db().execute("UPDATE jobs SET lease_until = ?", (time.time() - 1,))
+    run_next(other)
+
+    assert row(queue) == ("tts:100:1", "done", 2)
+    assert len(runs) == 1 and runs[0].count == 2
+    assert used(tracker) == 2
+    assert tracker.get_remaining_tts(USER) == LIMIT - 2 - (0 if tracker.shared else 2)  # the dead process's hold
+
+def test_jobs_of_a_dead_process_are_reclaimed_at_start(queue, tracker):
+    queue.register("tts", lambda bot, payload, reservation, usage_tracker: reservation.commit())
+    queue.submit("tts", make_message(), {"text": "hi"}, tracker.reserve(USER, "tts", 1))
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    queue.owner = f"{socket.gethostname()}:{dead.pid}"
+    assert queue._claim() is not None
+
+    replacement = restarted(queue)
+    replacement._reclaim_orphans()
+    run_next(replacement)
+    assert row(queue)[1:] == ("done", 2)
+
+def test_transient_failures_retry_until_max_attempts(queue, tracker):
+    attempts = []
+
+    def runner(bot, payload, reservation, usage_tracker):
+        attempts.append(payload["final_attempt"])
+        with reservation:
+            raise requests.exceptions.ConnectionError("upstream down")
+    queue.register("tts", runner)
+    queue.submit("tts", make_message(), {"text": "hi"}, tracker.reserve(USER, "tts", 3))
+
+    for _ in range(config.JOB_MAX_ATTEMPTS):
+        run_next(queue)
+    assert queue._claim() is None
+    assert attempts == [False] * (config.JOB_MAX_ATTEMPTS - 1) + [True]
+    assert row(queue)[1:] == ("failed", config.JOB_MAX_ATTEMPTS)
+    assert len(queue.bot.replies) == 1  # only the last failure reaches the user
+    assert used(tracker) == 0
+    assert tracker.get_remaining_tts(USER) == LIMIT
+
+def test_crash_on_the_last_attempt_gives_the_quota_back(queue, tracker):
+    runs = []
+    queue.register("tts", lambda bot, payload, reservation, usage_tracker: runs.append(payload))
+    queue.submit("tts", make_message(), {"text": "hi"}, tracker.reserve(USER, "tts", 4))
+    for _ in range(config.JOB_MAX_ATTEMPTS):
+        assert queue._claim() is not None  # the worker dies with the lease held
+        queue._db().execute("UPDATE jobs SET lease_until = ?", (time.time() - 1,))
+    queue._reservations.clear()  # in-process holds die with the process
+    if not tracker.shared:
+        tracker._pending.clear()
+
+    run_next(queue)
+    assert not runs
+    assert row(queue)[1:] == ("failed", config.JOB_MAX_ATTEMPTS + 1)
+    assert used(tracker) == 0
+    assert tracker.get_remaining_tts(USER) == LIMIT
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+import config
+from limiter import ConcurrencyLimiter, UpstreamOverloaded
+
+@pytest.fixture(autouse=True)
+def aimd(monkeypatch):
+    monkeypatch.setattr(config, "LIMITER_BACKOFF", 0.5)
+    monkeypatch.setattr(config, "LIMITER_LATENCY_TOLERANCE", 2.0)
+    monkeypatch.setattr(config, "LIMITER_MAX_QUEUE", 100)
+
+def call(limiter, ok, latency_ms):
+    assert limiter.acquire(0)
+    limiter.release(ok, latency_ms)
+
+def test_fast_calls_add_about_one_per_round():
+    limiter = ConcurrencyLimiter("test", initial=4, min_limit=1, max_limit=64)
+    for _ in range(4):
+        call(limiter, True, 100)
+    assert 4.9 < limiter.limit < 5
+    for _ in range(3000):  # L grows like sqrt(2 x calls)
+        call(limiter, True, 100)
+    assert limiter.limit == 64
+
+def test_error_halves_the_limit_once_per_round_trip():
+    limiter = ConcurrencyLimiter("test", initial=16, min_limit=2, max_limit=64)
+    call(limiter, True, 100)
+    limit = limiter.limit
+    call(limiter, False, 1000)
+    call(limiter, False, 1000)  # in flight alongside the first: same congestion
+    assert limiter.limit == limit * 0.5
+    for _ in range(10):
+        limiter._last_drop = 0.0
+        call(limiter, False, 100)
+    assert limiter.limit == 2
+
+def test_queueing_latency_counts_as_congestion():
+    limiter = ConcurrencyLimiter("test", initial=10, min_limit=1, max_limit=64)
+    call(limiter, True, 100)
+    limit = limiter.limit
+    call(limiter, True, 150)  # within the tolerance
+    assert limiter.limit > limit
+    limit = limiter.limit
+    call(limiter, True, 250)
+    assert limiter.limit == limit * 0.5
+    assert limiter.baseline_ms < 105  # the no-load estimate rises only slowly
+
+def test_answers_that_say_nothing_about_load_leave_the_limit_alone():
+    limiter = ConcurrencyLimiter("test", initial=10, min_limit=1, max_limit=64)
+    call(limiter, None, 5000)
+    assert limiter.limit == 10 and limiter.in_flight == 0
+
+def test_calls_over_the_limit_queue_or_are_shed():
+    limiter = ConcurrencyLimiter("test", initial=1, min_limit=1, max_limit=1)
+    permit = limiter.hold(0)
+    with pytest.raises(UpstreamOverloaded):
+        limiter.hold(0)
+
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(limiter.acquire(5)))
+    waiter.start()
+    while limiter.waiting == 0:
+        time.sleep(0.01)
+    permit.release(True)
+    permit.release(True)  # a second release is a no-op
+    waiter.join()
+    assert acquired == [True]
+    assert limiter.in_flight == 1
+
+def test_full_queue_sheds_at_once(monkeypatch):
+    monkeypatch.setattr(config, "LIMITER_MAX_QUEUE", 0)
+    limiter = ConcurrencyLimiter("test", initial=1, min_limit=1, max_limit=1)
+    assert limiter.acquire(0)
+    t0 = time.perf_counter()
+    assert not limiter.acquire(5)
+    assert time.perf_counter() - t0 < 1
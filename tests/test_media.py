@@ -0,0 +1,78 @@
+import pytest
+
+from media import AUDIO_TYPES, IMAGE_TYPES, read_media, sniff_media_type
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00\x00\x00\rIHDR" + b"\x00" * 100
+MP3 = b"\xff\xfb\x90\x64" + b"\x00" * 100
+
+class FakeResponse:
+    """Just enough of requests.Response for read_media, recording how much was read"""
+
+    def __init__(self, chunks, headers=None):
+        self.chunks = chunks
+        self.headers = headers or {}
+        self.read = 0
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+@pytest.mark.parametrize("data, media_type", [
+    (PNG, "image/png"),
+    (b"\xff\xd8\xff\xe0" + b"\x00" * 20, "image/jpeg"),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "image/webp"),
+    (b"OggS\x00\x02" + b"\x00" * 20, "audio/ogg"),
+    (b"ID3\x04\x00" + b"\x00" * 20, "audio/mpeg"),
+    (MP3, "audio/mpeg"),
+    (b"<!DOCTYPE html><html>", None),
+    (b'{"error": "rate limited"}', None),
+])
+def test_sniff_media_type(data, media_type):
+    assert sniff_media_type(data[:16]) == media_type
+
+def test_type_is_sniffed_across_small_chunks():
+    resp = FakeResponse(split(PNG, 5))
+    body, media_type = read_media(resp, "test", IMAGE_TYPES, 1024)
+    assert (body, media_type) == (PNG, "image/png")
+    assert resp.closed
+
+def test_error_page_is_rejected_before_the_rest_is_read():
+    resp = FakeResponse(split(b"<html><body>502 Bad Gateway</body></html>" * 50, 16))
+    assert read_media(resp, "test", IMAGE_TYPES, 1 << 20) == (None, None)
+    assert resp.read == 1
+    assert resp.closed
+
+def test_media_of_another_kind_is_rejected():
+    assert read_media(FakeResponse([PNG]), "test", AUDIO_TYPES, 1024) == (None, None)
+    assert read_media(FakeResponse([MP3]), "test", AUDIO_TYPES, 1024) == (MP3, "audio/mpeg")
+
+def test_declared_size_over_the_cap_is_not_downloaded():
+    resp = FakeResponse([PNG], headers={"Content-Length": "5000"})
+    assert read_media(resp, "test", IMAGE_TYPES, 4096) == (None, None)
+    assert resp.read == 0
+    assert resp.closed
+
+def test_body_over_the_cap_is_aborted_mid_stream():
+    resp = FakeResponse(split(PNG + b"\x00" * 10000, 1024))
+    assert read_media(resp, "test", IMAGE_TYPES, 4096) == (None, None)
+    assert resp.read == 5  # stops at the chunk that crosses the cap
+    assert read_media(FakeResponse([PNG]), "test", IMAGE_TYPES, len(PNG))[1] == "image/png"
+
+def test_short_unknown_payload_is_rejected():
+    assert read_media(FakeResponse([b"oops"]), "test", IMAGE_TYPES, 1024) == (None, None)
+    assert read_media(FakeResponse([]), "test", IMAGE_TYPES, 1024) == (None, None)
+
+def test_spooled_body_is_a_rewound_file():
+    body, media_type = read_media(FakeResponse(split(PNG, 7)), "test", IMAGE_TYPES, 1024, spool=True)
+    assert media_type == "image/png"
+    assert body.tell() == 0
+    assert body.read() == PNG
+    body.close()
@@ -0,0 +1,43 @@
+import state_backend
+from conftest import USER
+from utils import add_premium_users, is_premium_user, parse_user_ids, remove_premium_users
+
+def test_parse_user_ids_splits_dedupes_and_reports_invalid_tokens():
+    text = "123, 456;789 123\n\t42 abc -5 0 1234567890123456 7.5"
+    assert parse_user_ids(text) == ([123, 456, 789, 42], ["abc", "-5", "0", "1234567890123456", "7.5"])
+    assert parse_user_ids("") == ([], [])
+    assert parse_user_ids(None) == ([], [])
+    assert parse_user_ids(" ,; ") == ([], [])
+
+def test_bulk_premium_changes_count_only_real_changes(tracker):
+    backend = tracker.backend
+    for user_id in (1, 2, 3):
+        backend.register_user(user_id)
+
+    assert add_premium_users([1, 2, 99]) == 3
+    assert add_premium_users([1, 2, 100]) == 1  # 1 and 2 are already premium
+    assert backend.premium_count() == 4
+    assert backend.registered_premium_count() == 2
+
+    assert remove_premium_users([2, 99, 5]) == 2  # 5 was never premium
+    assert not is_premium_user(2) and not is_premium_user(99)
+    assert is_premium_user(1) and is_premium_user(100)
+    assert backend.premium_count() == 2
+    assert backend.registered_premium_count() == 1
+    assert add_premium_users([]) == 0 and remove_premium_users([]) == 0
+
+def test_premium_users_survive_a_restart(tracker):
+    add_premium_users([7, 8, 9])
+    remove_premium_users([8])
+    tracker.flush()
+
+    state_backend._backend = None  # the next process loads the state from disk
+    assert [is_premium_user(user_id) for user_id in (7, 8, 9)] == [True, False, True]
+    assert state_backend.get_state_backend().premium_count() == 2
+
+def test_premium_users_are_not_charged_quota(tracker):
+    add_premium_users([USER])
+    reservation = tracker.reserve(USER, "tts", 1000)
+    assert reservation is not None and reservation.unlimited
+    reservation.commit()
+    assert tracker.backend.get_usage(USER)["tts_used"] == 0
@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+
+from conftest import LIMIT, USER
+from utils import QuotaReservation
+
+def used(tracker):
+    return tracker.backend.get_usage(USER)["tts_used"]
+
+def test_concurrent_reservations_never_exceed_limit(tracker):
+    charged = []
+    over_limit = []
+    stop = threading.Event()
+
+    def client(seed):
+        rng = random.Random(seed)
+        for _ in range(200):
+            count = rng.randint(1, 3)
+            reservation = tracker.reserve(USER, "tts", count)
+            if reservation is None:
+                continue
+            action = rng.choice(["commit", "partial", "oversized", "refund"])
+            if action == "commit":
+                reservation.commit()
+                charged.append(count)
+            elif action == "partial":
+                reservation.commit(count - 1)
+                charged.append(count - 1)
+            elif action == "oversized":
+                reservation.commit(count + 5)
+                charged.append(count)
+            else:
+                reservation.refund()
+            if used(tracker) >= LIMIT - 3:
+                reservation = tracker.reserve(USER, "tts", 1)
+                if reservation is not None:
+                    reservation.refund()
+
+    def monitor():
+        while not stop.is_set():
+            if used(tracker) > LIMIT:
+                over_limit.append(used(tracker))
+
+    watcher = threading.Thread(target=monitor)
+    watcher.start()
+    clients = [threading.Thread(target=client, args=(seed,)) for seed in range(16)]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    stop.set()
+    watcher.join()
+
+    assert not over_limit
+    assert used(tracker) == sum(charged) <= LIMIT
+    assert tracker.get_remaining_tts(USER) == LIMIT - sum(charged)
+
+def test_commit_larger_than_reservation_is_capped(tracker):
+    tracker.backend.add_usage(USER, "tts_used", LIMIT - 1)
+    reservation = tracker.reserve(USER, "tts", 1)
+    assert reservation is not None
+    reservation.commit(6)
+    assert used(tracker) == LIMIT
+    assert tracker.reserve(USER, "tts", 1) is None
+
+def test_refund_and_context_exit_release_the_hold(tracker):
+    with tracker.reserve(USER, "tts", LIMIT):
+        assert tracker.reserve(USER, "tts", 1) is None
+    assert used(tracker) == 0
+    assert tracker.get_remaining_tts(USER) == LIMIT
+
+class SlowFlag(QuotaReservation):
+    """Yields between reading and setting settled, as a preempted thread would"""
+
+    @property
+    def settled(self):
+        value = self._settled
+        time.sleep(0.001)
+        return value
+
+    @settled.setter
+    def settled(self, value):
+        self._settled = value
+
+def test_racing_commit_and_refund_settle_once(tracker, monkeypatch):
+    settles = []
+    settle = tracker._settle
+    monkeypatch.setattr(tracker, "_settle", lambda reservation, count: settles.append(count) or settle(reservation, count))
+
+    for _ in range(20):
+        reservation = tracker.reserve(USER, "tts", 1)
+        reservation.__class__ = SlowFlag
+        reservation.settled = False
+        racers = [threading.Thread(target=action) for action in (reservation.commit, reservation.refund)]
+        for t in racers:
+            t.start()
+        for t in racers:
+            t.join()
+
+    assert len(settles) == 20
+    assert used(tracker) == sum(settles)
+    assert tracker.get_remaining_tts(USER) == LIMIT - used(tracker)
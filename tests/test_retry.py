@@ -0,0 +1,104 @@
+import pytest
+import requests
+
+import config
+import deadline
+import retry
+from retry import RetryBudget
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.url = "https://upstream.example/"
+
+    def close(self):
+        pass
+
+def http_error(status):
+    return requests.exceptions.HTTPError(str(status), response=FakeResponse(status))
+
+class Upstream:
+    """attempt() callable that raises the queued errors, then returns "ok" """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        return "ok"
+
+@pytest.fixture
+def budget(monkeypatch):
+    monkeypatch.setattr(config, "RETRY_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(config, "RETRY_BASE_DELAY", 0)
+    budget = RetryBudget(ratio=0.1, burst=2)
+    monkeypatch.setattr(retry, "budget", budget)
+    return budget
+
+def test_budget_refills_by_ratio_up_to_burst():
+    budget = RetryBudget(ratio=0.5, burst=2)
+    assert budget.withdraw() and budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    for _ in range(10):
+        budget.deposit()
+    assert budget.tokens == 2
+
+def test_outage_retries_stay_within_the_budget(budget):
+    down = Upstream(*[http_error(503)] * 1000)
+    calls = 100
+    for _ in range(calls):
+        with pytest.raises(requests.exceptions.HTTPError):
+            retry.call("test", down)
+    retries = down.calls - calls
+    assert retries <= calls * budget.ratio + budget.burst
+    assert retries >= calls * budget.ratio  # the budget is spent, not ignored
+
+def test_transient_error_is_retried_until_it_succeeds(budget):
+    flaky = Upstream(http_error(502), requests.exceptions.ConnectionError("reset"))
+    assert retry.call("test", flaky) == "ok"
+    assert flaky.calls == 3
+
+def test_attempts_are_capped(budget):
+    down = Upstream(*[http_error(500)] * 10)
+    with pytest.raises(requests.exceptions.HTTPError):
+        retry.call("test", down)
+    assert down.calls == config.RETRY_MAX_ATTEMPTS
+
+@pytest.mark.parametrize("error, idempotent, calls", [
+    (http_error(404), True, 1),
+    (requests.exceptions.ReadTimeout("slow"), False, 1),  # a POST may already be running upstream
+    (requests.exceptions.ReadTimeout("slow"), True, 2),
+    (requests.exceptions.ConnectTimeout("no route"), False, 2),
+])
+def test_only_retryable_errors_are_retried(budget, error, idempotent, calls):
+    upstream = Upstream(error)
+    try:
+        retry.call("test", upstream, idempotent=idempotent)
+    except requests.exceptions.RequestException as e:
+        assert e is error
+    assert upstream.calls == calls
+
+def test_no_retry_when_the_backoff_outlasts_the_deadline(budget, monkeypatch):
+    monkeypatch.setattr(retry, "backoff", lambda retries, error=None: 5.0)
+    upstream = Upstream(http_error(503))
+    with deadline.scope(deadline.Deadline(1.0)):
+        with pytest.raises(requests.exceptions.HTTPError):
+            retry.call("test", upstream)
+    assert upstream.calls == 1
+
+def test_backoff_honours_a_short_retry_after(monkeypatch):
+    monkeypatch.setattr(config, "RETRY_MAX_DELAY", 4)
+    error = requests.exceptions.HTTPError("429", response=FakeResponse(429, {"Retry-After": "3"}))
+    assert retry.backoff(0, error) >= 3
+    error.response.headers["Retry-After"] = "120"
+    assert retry.backoff(0, error) <= config.RETRY_MAX_DELAY
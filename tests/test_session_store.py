@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+import session_store
+from session_store import CHAT, SessionStore
+
+CHAT_TTL = 600
+WAITING_TTL = 60
+TICK = 10
+
+class FakeClock:
+    """Replaces the time module inside session_store; tests move now by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.perf_counter = time.perf_counter
+        self.sleep = time.sleep
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(session_store, "time", clock)
+    return clock
+
+def make_store(max_entries=100):
+    return SessionStore(CHAT_TTL, WAITING_TTL, max_entries, TICK)
+
+def test_waiting_mode_lapses_before_chat_mode(clock):
+    store = make_store()
+    store.enter(1, CHAT)
+    store.enter(1, "image")
+    assert store.route(1) == "image"
+
+    clock.now += WAITING_TTL + 1
+    assert store.route(1) == CHAT
+    assert not store.has(1, "image")
+
+    clock.now += CHAT_TTL
+    assert store.route(1) is None
+    assert store.stats()["entries"] == 0
+
+def test_enter_refreshes_the_ttl(clock):
+    store = make_store()
+    store.enter(1, "tts")
+    clock.now += WAITING_TTL - 5
+    store.enter(1, "tts")
+    clock.now += 10
+    assert store.has(1, "tts")
+
+def test_sweep_drops_only_expired_records(clock):
+    store = make_store()
+    for user_id in range(10):
+        store.enter(user_id, "image")
+    store.enter(99, CHAT)
+
+    clock.now += WAITING_TTL / 2
+    store.enter(0, "image")  # refreshed: rescheduled on a later slot
+    clock.now += WAITING_TTL / 2 + 2 * TICK
+    assert store.sweep() == 9
+    assert store.stats()["entries"] == 2
+    assert store.has(0, "image") and store.has(99, CHAT)
+
+    clock.now += CHAT_TTL + 2 * TICK
+    assert store.sweep() == 2
+    assert store.stats()["entries"] == 0
+
+def test_least_recently_touched_user_is_evicted(clock):
+    store = make_store(max_entries=3)
+    for user_id in (1, 2, 3):
+        store.enter(user_id, CHAT)
+    store.enter(1, "image")  # touching moves user 1 to the back
+    store.enter(4, CHAT)
+
+    assert store.stats()["entries"] == 3
+    assert not store.has(2, CHAT)
+    assert all(store.has(user_id, CHAT) for user_id in (1, 3, 4))
+
+def test_leave_and_view(clock):
+    store = make_store()
+    image = store.view("image")
+    image.add(1)
+    assert 1 in image and len(image) == 1
+    assert not store.leave(1, CHAT)
+    image.discard(1)
+    assert 1 not in image
+    assert store.stats()["entries"] == 0
+    with pytest.raises(KeyError):
+        image.remove(1)
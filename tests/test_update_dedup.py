@@ -0,0 +1,37 @@
+import struct
+import time
+
+import config
+from update_dedup import SeenUpdates
+
+def ids(seen, update_ids):
+    return seen.filter(list(update_ids), key=lambda update_id: update_id)
+
+def test_replays_are_dropped_across_restarts(tmp_path):
+    path = str(tmp_path / "seen.bin")
+    assert ids(SeenUpdates(path, 1000), [10, 11, 12]) == [10, 11, 12]
+    assert ids(SeenUpdates(path, 1000), [11, 12, 13]) == [13]
+
+def test_id_reset_rebases_instead_of_dropping(tmp_path):
+    seen = SeenUpdates(str(tmp_path / "seen.bin"), 1000)
+    assert ids(seen, [900000000]) == [900000000]
+    assert ids(seen, [123456, 123457]) == [123456, 123457]
+    assert ids(seen, [123457, 123458]) == [123458]
+
+def test_old_index_is_discarded(tmp_path):
+    path = str(tmp_path / "seen.bin")
+    seen = SeenUpdates(path, 1000)
+    ids(seen, [500])
+    # Last update more than UPDATE_DEDUP_MAX_AGE ago: the saved mark is not trusted
+    with open(path, "r+b") as f:
+        f.write(struct.pack("<qId", 500, 1000, time.time() - config.UPDATE_DEDUP_MAX_AGE - 60))
+    reloaded = SeenUpdates(path, 1000)
+    assert reloaded.high == 0
+    assert ids(reloaded, [200]) == [200]
+
+def test_idle_gap_rebases_a_running_index(tmp_path):
+    seen = SeenUpdates(str(tmp_path / "seen.bin"), 1000)
+    ids(seen, [5000])
+    seen.last_seen -= config.UPDATE_DEDUP_MAX_AGE + 1
+    assert ids(seen, [4500]) == [4500]
+    assert seen.high == 4500
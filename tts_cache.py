@@ -0,0 +1,155 @@
+import hashlib
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import config
+import metrics
+
+def normalize_tts_text(text):
+    """Normalize TTS input so trivially different spellings share a cache entry"""
+    text = unicodedata.normalize("NFC", text or "")
+    return " ".join(text.split())
+
+def make_cache_key(text, voice, model, response_format, speed):
+    """Cache key for one synthesis request"""
+    raw = "\x00".join([model, voice, response_format, f"{float(speed):.2f}", normalize_tts_text(text)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class TTSCache:
+    """Two-tier (memory + disk) LRU cache of synthesized audio, bounded by total bytes"""
+
+    def __init__(self, cache_dir, memory_max_bytes, disk_max_bytes):
+        self.cache_dir = cache_dir
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> audio bytes
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> (filename, size)
+        self._disk_bytes = 0
+        self._load_disk_index()
+
+    def _load_disk_index(self):
+        """Rebuild the disk LRU from the cache directory, oldest access first"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                key, _, ext = name.partition(".")
+                if len(key) != 64 or not ext or ext.endswith(".tmp"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, key, name, st.st_size))
+            for _, key, name, size in sorted(entries):
+                self._disk[key] = (name, size)
+                self._disk_bytes += size
+            self._evict_disk()
+        except Exception as e:
+            print(f"[DEBUG] Error loading TTS cache index: {e}")
+
+    def get(self, key):
+        """Return cached audio bytes or None; a hit refreshes recency in both tiers"""
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+                return audio
+            entry = self._disk.get(key)
+            if entry is None:
+                return None
+            self._disk.move_to_end(key)
+        path = os.path.join(self.cache_dir, entry[0])
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)  # recency survives restarts via mtime
+        except OSError:
+            with self._lock:
+                if self._disk.pop(key, None):
+                    self._disk_bytes -= entry[1]
+            return None
+        with self._lock:
+            self._put_memory(key, audio)
+        return audio
+
+    def put(self, key, audio, response_format="mp3"):
+        """Store audio in both tiers and evict least recently used entries"""
+        if not audio:
+            return
+        name = f"{key}.{response_format}"
+        path = os.path.join(self.cache_dir, name)
+        try:
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[DEBUG] Error writing TTS cache entry: {e}")
+            name = None
+        with self._lock:
+            self._put_memory(key, audio)
+            if name:
+                old = self._disk.pop(key, None)
+                if old:
+                    self._disk_bytes -= old[1]
+                self._disk[key] = (name, len(audio))
+                self._disk_bytes += len(audio)
+                evicted = self._evict_disk()
+            else:
+                evicted = []
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.cache_dir, old_name))
+            except OSError:
+                pass
+
+    def _put_memory(self, key, audio):
+        if len(audio) > self.memory_max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = audio
+        self._memory_bytes += len(audio)
+        while self._memory_bytes > self.memory_max_bytes and self._memory:
+            _, dropped = self._memory.popitem(last=False)
+            self._memory_bytes -= len(dropped)
+
+    def _evict_disk(self):
+        """Drop oldest disk entries over budget; returns file names to delete"""
+        evicted = []
+        while self._disk_bytes > self.disk_max_bytes and self._disk:
+            _, (name, size) = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(name)
+        return evicted
+
+    def stats(self):
+        """Entry counts and sizes per tier"""
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+# Global cache shared by all TTS handlers
+tts_cache = TTSCache(config.TTS_CACHE_DIR, config.TTS_CACHE_MEMORY_BYTES, config.TTS_CACHE_DISK_BYTES) if config.TTS_CACHE_ENABLED else None
+
+def cache_report():
+    """One-line summary for /debug"""
+    if tts_cache is None:
+        return "disabled"
+    s = tts_cache.stats()
+    hits = metrics.get("tts_cache.hits")
+    lookups = hits + metrics.get("tts_cache.misses")
+    hit_rate = (100.0 * hits / lookups) if lookups else 0.0
+    saved_kb = metrics.get("tts_cache.bytes_saved") / 1024
+    return (f"{hit_rate:.1f}% hits ({hits}/{lookups}), {saved_kb:.0f} KB saved, "
+            f"{s['disk_entries']} entries / {s['disk_bytes'] // 1024} KB on disk")
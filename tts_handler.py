@@ -1,12 +1,47 @@
 import requests
 import config
-import io
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from telebot import types
+import deadline
+import metrics
+import outbound
+import retry
+from limiter import limiter, UpstreamOverloaded
+from media import read_media, sniff_media_type, AUDIO_TYPES, SNIFF_BYTES
 from utils import AnimatedLoader
+from tts_cache import tts_cache, make_cache_key
+from job_queue import jobs
 
-def generate_tts(text, voice="nova", bot=None, chat_id=None):
-    """Generate TTS using ReflexAI endpoint"""
+TTS_UPSTREAM = urlparse(config.TTS_API_ENDPOINT).netloc
+
+# Audio accepted for each requested response_format: asking for mp3 and getting Ogg back is a failure
+FORMAT_TYPES = {"mp3": ("audio/mpeg",), "opus": ("audio/ogg",)}
+
+def generate_tts(text, voice="nova", bot=None, chat_id=None, response_format="mp3", speed=1.0, raise_transient=False):
+    """Generate TTS using ReflexAI endpoint, serving repeated phrases from the audio cache.
+    raise_transient=True raises timeouts, 429/5xx and shedding instead of returning None."""
     loader = None
+    cache_key = None
+    permit = None  # limiter slot of the current attempt
+
+    # Consult the cache before any loader or upstream request is started
+    if tts_cache is not None:
+        cache_key = make_cache_key(text, voice, config.TTS_MODEL, response_format, speed)
+        cached = tts_cache.get(cache_key)
+        if cached:
+            metrics.incr("tts_cache.hits")
+            metrics.incr("tts_cache.bytes_saved", len(cached))
+            print(f"[DEBUG] TTS cache hit ({len(cached)} bytes)")
+            return cached
+        metrics.incr("tts_cache.misses")
     
+    if deadline.expired():
+        print("[DEBUG] TTS skipped: request deadline already passed")
+        return None
+
     try:
         # Start animated loading if bot and chat_id provided
         if bot and chat_id:
@@ -23,52 +58,336 @@ def generate_tts(text, voice="nova", bot=None, chat_id=None):
             "model": config.TTS_MODEL,
             "input": text,
             "voice": voice,
-            "response_format": "mp3",
-            "speed": 1.0
+            "response_format": response_format,
+            "speed": speed
         }
         
         print(f"[DEBUG] Sending TTS request to: {config.TTS_API_ENDPOINT}")
-        response = requests.post(
-            config.TTS_API_ENDPOINT,
-            json=payload,
-            headers=headers,
-            timeout=60
-        )
+        t0 = time.perf_counter()
+
+        def send():
+            # The limiter slot stays held until the body is read below
+            nonlocal t0, permit
+            permit = limiter(TTS_UPSTREAM).hold()
+            t0 = time.perf_counter()
+            try:
+                response = retry.raise_for_retryable(requests.post(
+                    config.TTS_API_ENDPOINT,
+                    json=payload,
+                    headers=headers,
+                    timeout=deadline.timeouts(TTS_UPSTREAM, config.UPSTREAM_CONNECT_TIMEOUT, config.TTS_READ_TIMEOUT),
+                    stream=True
+                ))
+            except Exception:
+                permit.release(False)
+                raise
+            if response.status_code != 200:
+                permit.release(None)
+            return response
+
+        response = retry.call(TTS_UPSTREAM, send)
+        ttfb_ms = (time.perf_counter() - t0) * 1000.0
         
         print(f"[DEBUG] TTS response: {response.status_code}")
         
         if response.status_code == 200:
-            content_type = response.headers.get('Content-Type', '').lower()
-            print(f"[DEBUG] TTS Content-Type: {content_type}")
-            
-            # Check if response is audio
-            if content_type.startswith('audio/') or len(response.content) > 1000:
-                print(f"[DEBUG] TTS success: Audio received ({len(response.content)} bytes)")
-                return response.content
+            # Stream with a size cap; only real audio of the requested format is accepted
+            allowed = FORMAT_TYPES.get(response_format, AUDIO_TYPES)
+            audio, media_type = read_media(response, TTS_UPSTREAM, allowed, config.TTS_MAX_BYTES)
+            permit.release(audio is not None)
+            deadline.observe(TTS_UPSTREAM, ttfb_ms=ttfb_ms, total_ms=(time.perf_counter() - t0) * 1000.0)
+            if audio:
+                print(f"[DEBUG] TTS success: {media_type} received ({len(audio)} bytes)")
+                if cache_key:
+                    tts_cache.put(cache_key, audio, response_format)
+                return audio
             else:
-                print(f"[DEBUG] TTS returned non-audio data: {content_type}")
+                print("[DEBUG] TTS returned non-audio data")
                 return None
         else:
             print(f"[DEBUG] TTS failed with status: {response.status_code}")
+            response.close()
             return None
             
     except requests.exceptions.Timeout:
         print("[DEBUG] TTS generation timeout")
+        if deadline.expired():
+            metrics.incr("deadline.expired.ttfb")
+        if raise_transient:
+            raise
         return None
     except requests.exceptions.ConnectionError:
         print("[DEBUG] TTS generation connection error")
+        if raise_transient:
+            raise
+        return None
+    except UpstreamOverloaded as e:
+        print(f"[DEBUG] TTS request shed: {e}")
+        if raise_transient:
+            raise
         return None
     except Exception as e:
         print(f"[DEBUG] TTS generation error: {e}")
+        if raise_transient and retry.transient(e):
+            raise
         return None
     finally:
+        if permit is not None:
+            permit.release(False)  # the body read failed; no-op once released
         # Stop the loader
         if loader:
             loader.stop()
 
+# ---------- Long-form synthesis ----------
+_SENTENCE_END = re.compile(r'(?<=[.!?…。])\s+')
+_CLAUSE_END = re.compile(r'(?<=[,;:])\s+')
+
+def _pack(pieces, limit, sep=" "):
+    """Greedily join pieces into chunks no longer than limit"""
+    chunks, current = [], ""
+    for piece in pieces:
+        candidate = f"{current}{sep}{piece}" if current else piece
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            chunks.append(current)
+        current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def split_tts_text(text, limit=None):
+    """Split text at sentence boundaries into chunks within the upstream input limit"""
+    limit = limit or config.TTS_CHUNK_CHARS
+    text = " ".join(text.split())
+    if len(text) <= limit:
+        return [text] if text else []
+    pieces = []
+    for sentence in _SENTENCE_END.split(text):
+        if len(sentence) <= limit:
+            pieces.append(sentence)
+            continue
+        # Oversized sentence: fall back to clause, then word boundaries
+        for clause in _pack(_CLAUSE_END.split(sentence), limit):
+            if len(clause) <= limit:
+                pieces.append(clause)
+            else:
+                pieces.extend(_pack(clause.split(" "), limit))
+    # Words longer than the limit are hard-cut as a last resort
+    pieces = [p[i:i + limit] for p in pieces for i in range(0, len(p), limit)]
+    return _pack(pieces, limit)
+
+def _strip_id3(audio, keep_head, keep_tail):
+    """Remove ID3v2 header / ID3v1 trailer so MP3 frames concatenate cleanly"""
+    start, end = 0, len(audio)
+    if not keep_head and audio[:3] == b"ID3" and len(audio) >= 10:
+        size = (audio[6] << 21) | (audio[7] << 14) | (audio[8] << 7) | audio[9]
+        start = 10 + size + (10 if audio[5] & 0x10 else 0)
+    if not keep_tail and end - start > 128 and audio[end - 128:end - 125] == b"TAG":
+        end -= 128
+    return audio[start:end]
+
+def concat_audio(parts):
+    """Concatenate MP3 segments in order into a single stream; None if any part is not
+    MP3 (Ogg pages cannot be joined this way)"""
+    if any(sniff_media_type(part[:SNIFF_BYTES]) != "audio/mpeg" for part in parts):
+        print("[DEBUG] Not joining audio: a segment is not MP3")
+        return None
+    last = len(parts) - 1
+    return b"".join(_strip_id3(part, i == 0, i == last) for i, part in enumerate(parts))
+
+def generate_long_tts(chunks, voice="nova", bot=None, chat_id=None, raise_transient=False):
+    """Synthesize chunks concurrently with bounded fan-out and join them in order"""
+    loader = None
+    try:
+        if bot and chat_id:
+            loader = AnimatedLoader(bot, chat_id, "Converting to speech", "tts")
+            loader.start()
+        t0 = time.perf_counter()
+        workers = max(1, min(len(chunks), config.TTS_MAX_PARALLEL_CHUNKS))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts-chunk") as pool:
+            parts = list(pool.map(deadline.bind(lambda chunk: generate_tts(chunk, voice, raise_transient=raise_transient)), chunks))
+        print(f"[DEBUG] Long TTS: {len(chunks)} chunks in {time.perf_counter() - t0:.1f}s")
+        if not all(parts):
+            print("[DEBUG] Long TTS failed: at least one chunk returned no audio")
+            return None
+        metrics.incr("tts.long_jobs")
+        metrics.incr("tts.long_chunks", len(chunks))
+        return concat_audio(parts)
+    finally:
+        if loader:
+            loader.stop()
+
+# ---------- Pipelined speech for streamed text ----------
+_MARKDOWN_NOISE = re.compile(r'[*_`#>|~\[\]]+')
+
+def speakable(text):
+    """Strip Markdown decoration that would otherwise be read aloud"""
+    return " ".join(_MARKDOWN_NOISE.sub("", text or "").split())
+
+class SpeechPipeline:
+    """Turns streamed text into sentence-level TTS jobs while the text is still arriving.
+    At most max_segments are synthesized; text after that is left unvoiced (capped)."""
+
+    def __init__(self, voice="nova", min_chars=None, max_segments=None):
+        self.voice = voice
+        self.min_chars = min_chars or config.VOICE_REPLY_MIN_SEGMENT_CHARS
+        self.max_segments = max_segments
+        self.capped = False
+        self._buffer = ""
+        self._futures = []
+        self._pool = ThreadPoolExecutor(max_workers=config.TTS_MAX_PARALLEL_CHUNKS, thread_name_prefix="tts-pipe")
+
+    def _submit(self, text):
+        text = speakable(text)
+        for chunk in split_tts_text(text):
+            if self.max_segments is not None and len(self._futures) >= self.max_segments:
+                self.capped = True
+                metrics.incr("voice_reply.capped")
+                return
+            self._futures.append(self._pool.submit(deadline.bind(generate_tts), chunk, self.voice))
+
+    def feed(self, delta):
+        """Accept a streamed piece of text; complete sentences are sent to TTS right away"""
+        if self.capped:
+            return
+        self._buffer += delta
+        cut = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            cut = match.end()
+        if cut and (cut >= self.min_chars or len(self._buffer) >= config.TTS_CHUNK_CHARS):
+            segment, self._buffer = self._buffer[:cut], self._buffer[cut:]
+            self._submit(segment)
+        elif len(self._buffer) >= config.TTS_CHUNK_CHARS:
+            # No sentence boundary in sight; hand over what the upstream can take
+            segment, _, rest = self._buffer.rpartition(" ")
+            if not segment:
+                segment, rest = self._buffer, ""
+            self._buffer = rest
+            self._submit(segment)
+
+    @property
+    def segments(self):
+        return len(self._futures)
+
+    def finish(self):
+        """Flush the tail, wait for all segments and return the joined audio (or None)"""
+        try:
+            if self._buffer.strip() and not self.capped:
+                self._submit(self._buffer)
+            self._buffer = ""
+            parts = [f.result() for f in self._futures]
+        finally:
+            self._pool.shutdown(wait=False)
+        if not parts or not all(parts):
+            return None
+        return concat_audio(parts)
+
+def tts_cost(chunks):
+    """Quota units charged for one synthesis job"""
+    return len(chunks) if config.TTS_QUOTA_MODE == "chunk" else 1
+
+# ---------- Handlers ----------
+TTS_LIMIT_TEXT = """🚫 **Daily TTS Limit Reached**
+
+You've used all 100 free TTS generations for today!
+
+💎 **Upgrade to Premium for:**
+• Unlimited TTS generations
+• All voice options
+• Priority processing
+
+Contact @Rystrix to upgrade!"""
+
+def _check_tts_request(bot, message, text_to_speak, usage_tracker):
+    """Validate length and reserve quota; returns (chunks, reservation) or None after replying"""
+    if len(text_to_speak) > config.TTS_LONG_MAX_CHARS:
+        bot.reply_to(message, f"❌ **Text too long!** Please keep your text under {config.TTS_LONG_MAX_CHARS} characters.", parse_mode="Markdown")
+        return None
+
+    chunks = split_tts_text(text_to_speak)
+    cost = tts_cost(chunks)
+
+    # Reserve quota before any upstream work (premium users get an unlimited slot)
+    user_id = message.from_user.id
+    reservation = usage_tracker.reserve(user_id, "tts", cost)
+    if reservation is None:
+        remaining = usage_tracker.get_remaining_tts(user_id)
+        if remaining and remaining < cost:
+            bot.reply_to(message, f"🚫 **Not enough TTS credits:** this text needs {cost} but only {remaining} are left today. Try a shorter text!", parse_mode="Markdown")
+        else:
+            bot.reply_to(message, TTS_LIMIT_TEXT, parse_mode="Markdown")
+        return None
+    return chunks, reservation
+
+def _synthesize_and_send(bot, message, text_to_speak, chunks, reservation, usage_tracker, final=True):
+    """Generate speech (chunked when long), send one voice message and settle the reservation.
+    Unless this is the final attempt, transient upstream errors are raised for the job queue to retry."""
+    user_id = message.from_user.id
+    with reservation:
+        # The loader is ours, not generate_tts's: on failure it turns into the error message
+        loader = AnimatedLoader(bot, message.chat.id, "Converting to speech", "tts")
+        loader.start()
+        try:
+            try:
+                if len(chunks) > 1:
+                    audio_data = generate_long_tts(chunks, "nova", raise_transient=not final)
+                else:
+                    audio_data = generate_tts(text_to_speak, "nova", raise_transient=not final)
+            except Exception:
+                loader.stop()
+                raise
+            
+            if audio_data:
+                loader.stop()
+                if not reservation.unlimited:
+                    # The reserved credits already count as used
+                    remaining = usage_tracker.get_remaining_tts(user_id)
+                    remaining_text = f"\n\n📊 **Remaining today:** {remaining}/100"
+                else:
+                    remaining_text = "\n\n💎 **Premium User - Unlimited Access!**"
+                
+                shown = text_to_speak if len(text_to_speak) <= 700 else text_to_speak[:697] + "..."
+                caption = f"🎤 **Text-to-Speech**\n\n**Text:** `{shown}`\n**Voice:** Nova\n\n✨ **Generated by BrahMos AI**{remaining_text}"
+                caption = outbound.merge(caption, config.MAX_CAPTION_LENGTH)
+                
+                # Send the audio
+                bot.send_voice(
+                    message.chat.id,
+                    audio_data,
+                    caption=caption,
+                    parse_mode="Markdown",
+                    reply_to_message_id=message.message_id
+                )
+                reservation.commit()
+            else:
+                failure = outbound.merge("❌ **TTS Generation Failed**\n\nSorry, I couldn't convert your text to speech. Please try again.",
+                                         config.MAX_MESSAGE_LENGTH)
+                if not loader.stop(final_message=failure, parse_mode="Markdown"):
+                    bot.reply_to(message, failure, parse_mode="Markdown")
+                
+        except Exception as e:
+            if not final and retry.transient(e):
+                raise  # the queue runs the job again; the user only hears about the last failure
+            print(f"[DEBUG] TTS error: {e}")
+            bot.reply_to(message, "💥 **Error:** Something went wrong while generating speech. Please try again!")
+
+def run_tts_job(bot, payload, reservation, usage_tracker):
+    """Job runner: synthesize and send a queued TTS request"""
+    message = types.Message.de_json(payload["message"])
+    if reservation is None:
+        bot.reply_to(message, TTS_LIMIT_TEXT, parse_mode="Markdown")
+        return
+    text = payload["text"]
+    _synthesize_and_send(bot, message, text, split_tts_text(text), reservation, usage_tracker,
+                         final=payload.get("final_attempt", True))
+
+jobs.register("tts", run_tts_job)
+
 def handle_say_command(bot, message, usage_tracker):
     """Handle /say command with usage tracking"""
-    from utils import log_user_interaction, is_premium_user
+    from utils import log_user_interaction
     
     user_id = message.from_user.id
     log_user_interaction(message.from_user, "/say", "DM" if message.chat.type == "private" else "Group")
@@ -76,7 +395,7 @@ def handle_say_command(bot, message, usage_tracker):
     # Check if user provided text
     text_input = message.text.strip()
     if len(text_input.split()) <= 1:
-        bot.reply_to(message, """🎤 **Text-to-Speech Help**
+        bot.reply_to(message, f"""🎤 **Text-to-Speech Help**
 
 **Usage:** `/say [text]`
 
@@ -87,71 +406,29 @@ def handle_say_command(bot, message, usage_tracker):
 
 **🎵 Available Voices:** alloy, echo, fable, onyx, nova, shimmer
 
-**💡 Tip:** Keep text under 500 characters for best results!""", parse_mode="Markdown")
+**💡 Tip:** Long texts (up to {config.TTS_LONG_MAX_CHARS} characters) are split and voiced automatically!""", parse_mode="Markdown")
         return
 
     # Extract text (remove "/say ")
     text_to_speak = text_input[4:].strip()
     
-    # Validate text length
-    if len(text_to_speak) > 500:
-        bot.reply_to(message, "❌ **Text too long!** Please keep your text under 500 characters.", parse_mode="Markdown")
+    checked = _check_tts_request(bot, message, text_to_speak, usage_tracker)
+    if not checked:
         return
-    
-    # Check usage limits for free users
-    if not is_premium_user(user_id):
-        if not usage_tracker.can_use_tts(user_id):
-            bot.reply_to(message, """🚫 **Daily TTS Limit Reached**
-
-You've used all 100 free TTS generations for today!
-
-💎 **Upgrade to Premium for:**
-• Unlimited TTS generations
-• All voice options
-• Priority processing
+    chunks, reservation = checked
 
-Contact @Rystrix to upgrade!""", parse_mode="Markdown")
-            return
-        
-        # Warning when approaching limit
+    # Warning when approaching limit
+    if not reservation.unlimited:
         remaining = usage_tracker.get_remaining_tts(user_id)
         if remaining <= 10:
-            bot.reply_to(message, f"⚠️ **Usage Warning:** Only {remaining} TTS generations left today!", parse_mode="Markdown")
+            warning = f"⚠️ **Usage Warning:** Only {remaining} TTS generations left today!"
+            if not outbound.notice(warning):  # rides along with the voice message when possible
+                bot.reply_to(message, warning, parse_mode="Markdown")
 
-    try:
-        # Generate TTS
-        audio_data = generate_tts(text_to_speak, "nova", bot, message.chat.id)
-        
-        if audio_data:
-            # Track usage for free users
-            if not is_premium_user(user_id):
-                usage_tracker.use_tts(user_id)
-                remaining = usage_tracker.get_remaining_tts(user_id)
-                remaining_text = f"\n\n📊 **Remaining today:** {remaining}/100"
-            else:
-                remaining_text = "\n\n💎 **Premium User - Unlimited Access!**"
-            
-            caption = f"🎤 **Text-to-Speech**\n\n**Text:** `{text_to_speak}`\n**Voice:** Nova\n\n✨ **Generated by BrahMos AI**{remaining_text}"
-            
-            # Send the audio
-            bot.send_voice(
-                message.chat.id,
-                io.BytesIO(audio_data),
-                caption=caption,
-                parse_mode="Markdown",
-                reply_to_message_id=message.message_id
-            )
-        else:
-            bot.reply_to(message, "❌ **TTS Generation Failed**\n\nSorry, I couldn't convert your text to speech. Please try again.", parse_mode="Markdown")
-            
-    except Exception as e:
-        print(f"[DEBUG] TTS error: {e}")
-        bot.reply_to(message, "💥 **Error:** Something went wrong while generating speech. Please try again!")
+    jobs.submit("tts", message, {"text": text_to_speak}, reservation)
 
 def handle_tts_input(bot, message, user_waiting_for_tts, usage_tracker):
     """Handle TTS text input when user is in TTS waiting mode"""
-    from utils import is_premium_user
-    
     user_id = message.from_user.id
     
     if user_id in user_waiting_for_tts:
@@ -160,52 +437,9 @@ def handle_tts_input(bot, message, user_waiting_for_tts, usage_tracker):
         # Use the message text for TTS
         text_to_speak = message.text.strip()
         
-        # Validate text length
-        if len(text_to_speak) > 500:
-            bot.reply_to(message, "❌ **Text too long!** Please keep your text under 500 characters.", parse_mode="Markdown")
+        checked = _check_tts_request(bot, message, text_to_speak, usage_tracker)
+        if not checked:
             return
-        
-        # Check usage limits for free users
-        if not is_premium_user(user_id):
-            if not usage_tracker.can_use_tts(user_id):
-                bot.reply_to(message, """🚫 **Daily TTS Limit Reached**
-
-You've used all 100 free TTS generations for today!
-
-💎 **Upgrade to Premium for:**
-• Unlimited TTS generations
-• All voice options  
-• Priority processing
+        chunks, reservation = checked
 
-Contact @Rystrix to upgrade!""", parse_mode="Markdown")
-                return
-        
-        try:
-            # Generate TTS
-            audio_data = generate_tts(text_to_speak, "nova", bot, message.chat.id)
-            
-            if audio_data:
-                # Track usage for free users
-                if not is_premium_user(user_id):
-                    usage_tracker.use_tts(user_id)
-                    remaining = usage_tracker.get_remaining_tts(user_id)
-                    remaining_text = f"\n\n📊 **Remaining today:** {remaining}/100"
-                else:
-                    remaining_text = "\n\n💎 **Premium User - Unlimited Access!**"
-                
-                caption = f"🎤 **Text-to-Speech**\n\n**Text:** `{text_to_speak}`\n**Voice:** Nova\n\n✨ **Generated by BrahMos AI**{remaining_text}"
-                
-                # Send the audio
-                bot.send_voice(
-                    message.chat.id,
-                    io.BytesIO(audio_data),
-                    caption=caption,
-                    parse_mode="Markdown",
-                    reply_to_message_id=message.message_id
-                )
-            else:
-                bot.reply_to(message, "❌ **TTS Generation Failed**\n\nSorry, I couldn't convert your text to speech. Please try again.", parse_mode="Markdown")
-                
-        except Exception as e:
-            print(f"[DEBUG] TTS error: {e}")
-            bot.reply_to(message, "💥 **Error:** Something went wrong while generating speech. Please try again!")
\ No newline at end of file
+        jobs.submit("tts", message, {"text": text_to_speak}, reservation)
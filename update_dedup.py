@@ -0,0 +1,175 @@
+import os
+import struct
+import threading
+import time
+
+import telebot
+
+import config
+import deadline
+import metrics
+import outbound
+
+_HEADER = struct.Struct("<qId")  # high-water update_id, window size, wall time of the last update
+
+class SeenUpdates:
+    """
+    Persisted index of recently processed update_ids. Telegram's ids only
+    grow, so the index is a high-water mark plus a ring bitmap covering the
+    last `window` ids; anything older than the window counts as already seen.
+    After a week without updates Telegram starts again from a random id, so
+    an index idle for UPDATE_DEDUP_MAX_AGE, or an id more than a window
+    below the mark, re-bases it on the new id instead of dropping it.
+    The file is a few KB and rewritten atomically once per batch.
+    """
+
+    def __init__(self, path, window):
+        self.path = path
+        self.window = window
+        self._lock = threading.Lock()
+        self.high = 0
+        self.last_seen = 0.0
+        self._bits = bytearray((window + 7) // 8)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            high, window, last_seen = _HEADER.unpack_from(data)
+            bits = data[_HEADER.size:]
+            if not 0 <= time.time() - last_seen <= config.UPDATE_DEDUP_MAX_AGE:
+                # Telegram redelivers nothing this old, and ids may have been reset since
+                # (this also drops files from before the timestamp was saved)
+                return
+            self.last_seen = last_seen
+            if window == self.window and len(bits) == len(self._bits):
+                self.high = high
+                self._bits[:] = bits
+            else:
+                # Window changed: keep the high-water mark, forget the bitmap
+                self.high = high
+                self._bits = bytearray((self.window + 7) // 8)
+                for update_id in range(max(high - self.window, 0) + 1, high + 1):
+                    self._set(update_id)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[DEBUG] Error loading {self.path}: {e}")
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(self.high, self.window, self.last_seen))
+            f.write(self._bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _slot(self, update_id):
+        index = update_id % self.window
+        return index >> 3, 1 << (index & 7)
+
+    def _set(self, update_id):
+        byte, bit = self._slot(update_id)
+        self._bits[byte] |= bit
+
+    def _advance(self, update_id):
+        """Move the high-water mark up, clearing the ring slots being reused"""
+        if update_id - self.high >= self.window:
+            self._bits[:] = bytes(len(self._bits))
+        else:
+            for reused in range(self.high + 1, update_id + 1):
+                byte, bit = self._slot(reused)
+                self._bits[byte] &= ~bit
+        self.high = update_id
+
+    def _rebase(self, update_id):
+        """Start the index over at update_id (Telegram reset its ids)"""
+        print(f"[DEBUG] update_id jumped from {self.high} to {update_id}: re-basing the dedup index")
+        metrics.incr("updates.id_resets")
+        self._bits[:] = bytes(len(self._bits))
+        self.high = update_id
+        self._set(update_id)
+
+    def _mark(self, update_id, now):
+        """True if update_id is new (and records it), False for a replay"""
+        idle = self.high and now - self.last_seen > config.UPDATE_DEDUP_MAX_AGE
+        self.last_seen = now
+        if idle or update_id <= self.high - self.window:
+            self._rebase(update_id)
+            return True
+        if update_id > self.high:
+            self._advance(update_id)
+            self._set(update_id)
+            return True
+        byte, bit = self._slot(update_id)
+        if self._bits[byte] & bit:
+            return False
+        self._bits[byte] |= bit
+        return True
+
+    def filter(self, updates, key=lambda update: update.update_id):
+        """Drop updates that were already processed; persists the index before returning"""
+        if not updates:
+            return updates
+        with self._lock:
+            now = time.time()
+            fresh = [u for u in updates if self._mark(key(u), now)]
+            if fresh:
+                try:
+                    self._save()
+                except OSError as e:
+                    print(f"[DEBUG] Error saving {self.path}: {e}")
+        dropped = len(updates) - len(fresh)
+        metrics.incr("updates.received", len(updates))
+        if dropped:
+            metrics.incr("updates.duplicates", dropped)
+        return fresh
+
+class DedupTeleBot(telebot.TeleBot):
+    """TeleBot that skips redelivered updates before any handler runs and
+    runs each handler under the deadline stamped on its update at ingestion,
+    with its own outbound buffer"""
+
+    def __init__(self, *args, seen_updates=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seen_updates = seen_updates
+
+    def process_new_updates(self, updates):
+        if not updates:
+            return super().process_new_updates(updates)
+        for update in updates:
+            _stamp_deadline(update)
+        if self.seen_updates is None:
+            return super().process_new_updates(updates)
+        # Polling asks for last_update_id + 1 next, so advance it even if every update is dropped
+        self.last_update_id = max(self.last_update_id, max(u.update_id for u in updates))
+        fresh = self.seen_updates.filter(updates)
+        if fresh:
+            super().process_new_updates(fresh)
+
+    def _exec_task(self, task, *args, **kwargs):
+        request = args[0] if args else None
+        request_deadline = getattr(request, "deadline", None)
+        if request_deadline is None:
+            return super()._exec_task(task, *args, **kwargs)
+        # Leftover notices are sent as a reply to the message (or the callback's message)
+        message = request if hasattr(request, "chat") else getattr(request, "message", None)
+
+        def run(*task_args, **task_kwargs):
+            with deadline.scope(request_deadline), outbound.scope(outbound.Outbound("update", self, message)):
+                return task(*task_args, **task_kwargs)
+        return super()._exec_task(run, *args, **kwargs)
+
+def _stamp_deadline(update):
+    """Attach one REQUEST_DEADLINE to the message/callback/... carried by update"""
+    request_deadline = deadline.Deadline(config.REQUEST_DEADLINE)
+    for value in vars(update).values():
+        if hasattr(value, "__dict__"):
+            value.deadline = request_deadline
+
+def dedup_report():
+    """One-line summary for /debug"""
+    return (f"{metrics.get('updates.duplicates')} duplicates dropped of {metrics.get('updates.received')} updates "
+            f"({metrics.get('updates.id_resets')} update_id resets)")
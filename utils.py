@@ -3,7 +3,11 @@ import time
 import threading
 import json
 import os
-from datetime import datetime, date
+import re
+from datetime import datetime
+import metrics
+import outbound
+from state_backend import get_state_backend
 
 class AnimatedLoader:
     """Class to handle animated loading messages with emojis"""
@@ -56,7 +60,7 @@ class AnimatedLoader:
                     initial_text,
                     parse_mode="Markdown"
                 )
-                self.thread = threading.Thread(target=self._animate)
+                self.thread = threading.Thread(target=outbound.bind(self._animate))
                 self.thread.daemon = True
                 self.thread.start()
             except Exception as e:
@@ -87,8 +91,9 @@ class AnimatedLoader:
                 # Silently handle edit failures (message too old, etc.)
                 break
                 
-    def stop(self, final_message=None):
-        """Stop the animation and optionally update with final message"""
+    def stop(self, final_message=None, parse_mode=None):
+        """Stop the animation and optionally update with final message.
+        Returns True if the loader message now shows final_message."""
         self.is_running = False
         if self.thread:
             self.thread.join(timeout=1)
@@ -98,8 +103,10 @@ class AnimatedLoader:
                 self.bot.edit_message_text(
                     final_message,
                     chat_id=self.chat_id,
-                    message_id=self.message.message_id
+                    message_id=self.message.message_id,
+                    parse_mode=parse_mode
                 )
+                return True
             except Exception as e:
                 print(f"[DEBUG] Failed to update final message: {e}")
         elif self.message:
@@ -124,7 +131,7 @@ def safe_send_photo_with_caption(bot, chat_id, photo_path, caption, reply_markup
                 bot.send_photo(chat_id, photo_file, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode)
         return True
     except FileNotFoundError:
-        bot.send_message(chat_id, f"🖼️ *[Image: {photo_path}]*\n\n{caption}", reply_markup=reply_markup, parse_mode=parse_mode)
+        # The caller sends the caption as a plain message instead
         return False
 
 def safe_edit_message(bot, chat_id, message_id, text, reply_markup=None, parse_mode=None):
@@ -182,94 +189,185 @@ def log_user_interaction(user, command, chat_type):
         user_info += f" @{user.username}"
     print(f"[{timestamp}] {chat_type}: {user_info} used {command}")
 
-# Premium user management functions
-def load_premium_users():
-    """Load premium users from JSON file"""
-    import config
-    try:
-        if os.path.exists(config.PREMIUM_USERS_FILE):
-            with open(config.PREMIUM_USERS_FILE, 'r') as f:
-                return set(json.load(f))
-        return set()
-    except Exception as e:
-        print(f"[DEBUG] Error loading premium users: {e}")
-        return set()
-
-def save_premium_users(premium_users):
-    """Save premium users to JSON file"""
-    import config
-    try:
-        with open(config.PREMIUM_USERS_FILE, 'w') as f:
-            json.dump(list(premium_users), f)
-    except Exception as e:
-        print(f"[DEBUG] Error saving premium users: {e}")
-
-# Global premium users set
-premium_users = load_premium_users()
+def atomic_write_json(path, data):
+    """Write JSON to a temp file and rename it over path; returns bytes written"""
+    payload = json.dumps(data).encode("utf-8")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(payload)
 
+# Premium user management functions (persisted by the configured state backend)
 def is_premium_user(user_id):
     """Check if user is premium"""
-    return user_id in premium_users
+    return get_state_backend().is_premium(user_id)
 
 def add_premium_user(user_id):
     """Add user to premium"""
-    premium_users.add(user_id)
-    save_premium_users(premium_users)
+    return get_state_backend().add_premium(user_id)
 
 def remove_premium_user(user_id):
     """Remove user from premium"""
-    premium_users.discard(user_id)
-    save_premium_users(premium_users)
+    return get_state_backend().remove_premium(user_id)
+
+def add_premium_users(user_ids):
+    """Add many users to premium with one write; returns how many were new"""
+    return get_state_backend().add_premium_many(user_ids)
+
+def remove_premium_users(user_ids):
+    """Remove many users from premium with one write; returns how many were premium"""
+    return get_state_backend().remove_premium_many(user_ids)
+
+def parse_user_ids(text):
+    """
+    User ids in text separated by spaces, commas or semicolons, without
+    duplicates and in order, plus the tokens that are not valid ids
+    """
+    user_ids, invalid, seen = [], [], set()
+    for token in re.split(r"[\s,;]+", text or ""):
+        if not token:
+            continue
+        if not re.fullmatch(r"[0-9]{1,15}", token) or int(token) == 0:
+            invalid.append(token)
+            continue
+        user_id = int(token)
+        if user_id not in seen:
+            seen.add(user_id)
+            user_ids.append(user_id)
+    return user_ids, invalid
 
 # Usage tracking class
+QUOTA_FIELDS = {"image": ("images_used", "FREE_IMAGE_LIMIT"), "tts": ("tts_used", "FREE_TTS_LIMIT")}
+
+class QuotaReservation:
+    """Quota held for one job: commit() on delivery, refund() on failure"""
+    
+    def __init__(self, tracker, user_id, kind, count, unlimited=False):
+        self.tracker = tracker
+        self.user_id = user_id
+        self.kind = kind
+        self.count = count
+        self.unlimited = unlimited
+        self.settled = False
+        self._lock = threading.Lock()  # a job runner's commit can race the refund of a with-block
+    
+    def commit(self, count=None):
+        """Charge count units (default: all reserved, never more); any unused remainder is released"""
+        if count is None:
+            count = self.count
+        elif count > self.count:
+            # Only what was held can be charged, or the daily limit could be overrun
+            print(f"[DEBUG] Quota commit of {count} {self.kind} units capped at the {self.count} reserved")
+            metrics.incr("quota.capped")
+            count = self.count
+        if self._claim():
+            self.tracker._settle(self, count)
+    
+    def refund(self):
+        """Release the reservation without charging anything"""
+        if self._claim():
+            self.tracker._settle(self, 0)
+    
+    def _claim(self):
+        """True for the one caller allowed to settle"""
+        with self._lock:
+            if self.settled:
+                return False
+            self.settled = True
+            return True
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        # A job that dies before settling never charges the user
+        self.refund()
+        return False
+
 class UsageTracker:
-    """Track daily usage for images and TTS"""
+    """Track daily usage for images and TTS on top of the state backend.
+
+    Quota is taken with reserve() before any upstream work and settled with
+    commit()/refund(). Reservations are counted per user under one of
+    QUOTA_LOCK_STRIPES locks, so concurrent requests from the same user
+    cannot overspend and different users never contend on a global lock.
+    With a backend shared between processes the units are charged up front
+    in the backend itself and the unused part is credited back on settle.
+    """
     
     def __init__(self):
         import config
-        self.usage_file = config.USAGE_DATA_FILE
-        self.usage_data = self.load_usage_data()
-        
-    def load_usage_data(self):
-        """Load usage data from JSON file"""
-        try:
-            if os.path.exists(self.usage_file):
-                with open(self.usage_file, 'r') as f:
-                    data = json.load(f)
-                    # Clean old data (older than today)
-                    today = date.today().isoformat()
-                    cleaned_data = {}
-                    for user_id, user_data in data.items():
-                        if user_data.get('date') == today:
-                            cleaned_data[user_id] = user_data
-                    return cleaned_data
-            return {}
-        except Exception as e:
-            print(f"[DEBUG] Error loading usage data: {e}")
-            return {}
+        self.backend = get_state_backend()
+        self.shared = getattr(self.backend, "shared", False)
+        self._stripes = [threading.Lock() for _ in range(config.QUOTA_LOCK_STRIPES)]
+        self._pending = {}  # (user_id, field) -> units reserved but not yet committed
     
-    def save_usage_data(self):
-        """Save usage data to JSON file"""
-        try:
-            with open(self.usage_file, 'w') as f:
-                json.dump(self.usage_data, f)
-        except Exception as e:
-            print(f"[DEBUG] Error saving usage data: {e}")
+    def _stripe(self, user_id):
+        return self._stripes[hash(user_id) % len(self._stripes)]
+    
+    def flush(self):
+        """Persist pending counters now (also called on shutdown)"""
+        self.backend.flush()
+    
+    def reserve(self, user_id, kind, count=1):
+        """Hold count units of "image" or "tts" quota; None if the user has not enough left"""
+        import config
+        if is_premium_user(user_id):
+            return QuotaReservation(self, user_id, kind, count, unlimited=True)
+        field, limit_name = QUOTA_FIELDS[kind]
+        limit = getattr(config, limit_name)
+        key = (user_id, field)
+        if self.shared:
+            if not self.backend.try_add_usage(user_id, field, count, limit):
+                metrics.incr("quota.rejected")
+                return None
+            metrics.incr("quota.reserved")
+            return QuotaReservation(self, user_id, kind, count)
+        with self._stripe(user_id):
+            used = self.backend.get_usage(user_id)[field]
+            pending = self._pending.get(key, 0)
+            if used + pending + count > limit:
+                metrics.incr("quota.rejected")
+                return None
+            self._pending[key] = pending + count
+        metrics.incr("quota.reserved")
+        return QuotaReservation(self, user_id, kind, count)
+    
+    def adopt(self, user_id, kind, count):
+        """Take over units already charged in a shared backend (a job recovered after a crash)"""
+        return QuotaReservation(self, user_id, kind, count)
+    
+    def _settle(self, reservation, charged):
+        if reservation.unlimited:
+            return
+        field, _ = QUOTA_FIELDS[reservation.kind]
+        key = (reservation.user_id, field)
+        if self.shared:
+            unused = reservation.count - charged
+            if unused:
+                self.backend.add_usage(reservation.user_id, field, -unused)
+            metrics.incr("quota.committed" if charged else "quota.refunded")
+            return
+        with self._stripe(reservation.user_id):
+            pending = self._pending.get(key, 0) - reservation.count
+            if pending > 0:
+                self._pending[key] = pending
+            else:
+                self._pending.pop(key, None)
+            if charged:
+                self.backend.add_usage(reservation.user_id, field, charged)
+        metrics.incr("quota.committed" if charged else "quota.refunded")
+    
+    def _used(self, user_id, field):
+        """Committed plus reserved units for today"""
+        return self.backend.get_usage(user_id)[field] + self._pending.get((user_id, field), 0)
     
     def get_user_data(self, user_id):
         """Get user usage data for today"""
-        user_id_str = str(user_id)
-        today = date.today().isoformat()
-        
-        if user_id_str not in self.usage_data or self.usage_data[user_id_str].get('date') != today:
-            self.usage_data[user_id_str] = {
-                'date': today,
-                'images_used': 0,
-                'tts_used': 0
-            }
-            self.save_usage_data()
-        
-        return self.usage_data[user_id_str]
+        return self.backend.get_usage(user_id)
     
     def can_use_image(self, user_id):
         """Check if user can generate an image"""
@@ -277,8 +375,7 @@ class UsageTracker:
             return True
         
         import config
-        user_data = self.get_user_data(user_id)
-        return user_data['images_used'] < config.FREE_IMAGE_LIMIT
+        return self._used(user_id, 'images_used') < config.FREE_IMAGE_LIMIT
     
     def can_use_tts(self, user_id):
         """Check if user can use TTS"""
@@ -286,35 +383,28 @@ class UsageTracker:
             return True
         
         import config
-        user_data = self.get_user_data(user_id)
-        return user_data['tts_used'] < config.FREE_TTS_LIMIT
+        return self._used(user_id, 'tts_used') < config.FREE_TTS_LIMIT
     
     def use_image(self, user_id):
         """Use one image generation"""
-        user_data = self.get_user_data(user_id)
-        user_data['images_used'] += 1
-        self.save_usage_data()
+        self.backend.add_usage(user_id, 'images_used', 1)
     
-    def use_tts(self, user_id):
-        """Use one TTS generation"""
-        user_data = self.get_user_data(user_id)
-        user_data['tts_used'] += 1
-        self.save_usage_data()
+    def use_tts(self, user_id, count=1):
+        """Use count TTS generations (one per job, or one per chunk for long text)"""
+        self.backend.add_usage(user_id, 'tts_used', count)
     
     def get_remaining_images(self, user_id):
-        """Get remaining image generations for today"""
+        """Get remaining image generations for today (reserved ones count as used)"""
         if is_premium_user(user_id):
             return 999999  # Large number to represent unlimited
         
         import config
-        user_data = self.get_user_data(user_id)
-        return max(0, config.FREE_IMAGE_LIMIT - user_data['images_used'])
+        return max(0, config.FREE_IMAGE_LIMIT - self._used(user_id, 'images_used'))
     
     def get_remaining_tts(self, user_id):
-        """Get remaining TTS generations for today"""
+        """Get remaining TTS generations for today (reserved ones count as used)"""
         if is_premium_user(user_id):
             return 999999  # Large number to represent unlimited
         
         import config
-        user_data = self.get_user_data(user_id)
-        return max(0, config.FREE_TTS_LIMIT - user_data['tts_used'])
\ No newline at end of file
+        return max(0, config.FREE_TTS_LIMIT - self._used(user_id, 'tts_used'))